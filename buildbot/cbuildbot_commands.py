@@ -900,7 +900,8 @@ def GenerateDebugTarball(buildroot, board, archive_path, gdb_symbols):
 
   result = cros_build_lib.CreateTarball(
       debug_tgz, board_dir, sudo=True, compression=cros_build_lib.COMP_GZIP,
-      chroot=chroot, inputs=inputs, extra_args=extra_args, error_code_ok=True)
+      chroot=chroot, inputs=inputs, extra_args=extra_args, error_code_ok=True,
+      parallel=True)
 
   # Emerging the factory kernel while this is running installs different debug
   # symbols. When tar spots this, it flags this and returns status code 1.
@@ -951,8 +952,59 @@ def UpdateUploadedList(last_uploaded, archive_path, upload_url, debug):
                      update_list=False)
 
 
+class UploadedList(object):
+  """Batches updates of the list of files uploaded to Google Storage.
+
+  Uploaded files are added to the local list right away, but the list is only
+  uploaded again once every |flush_interval| seconds, so readers still see
+  progress without every upload paying for a re-upload of the list.  Flush
+  must be called once the uploads are done to publish the final list.
+
+  The object may be shared by forked upload processes; they all append to the
+  same local file, and share the time and size of the last upload.  Uploads
+  of the list are serialized with a lock file next to it, so an older copy of
+  the list can't replace a newer one.
+  """
+
+  def __init__(self, archive_path, upload_url, debug, flush_interval=30):
+    """Initializes the list.
+
+    Args:
+      archive_path: Path to archive dir.
+      upload_url: Location where the list should be uploaded.
+      debug: Whether we are in debug mode.
+      flush_interval: Upload the list at most this often, in seconds.
+    """
+    self.archive_path = archive_path
+    self.upload_url = upload_url
+    self.debug = debug
+    self.flush_interval = flush_interval
+    self._path = os.path.join(archive_path, UPLOADED_LIST_FILENAME)
+    self._last_flush = multiprocessing.RawValue('d', time.time())
+    self._flushed_size = multiprocessing.RawValue('l', 0)
+
+  def Add(self, filename):
+    """Records |filename| as uploaded, uploading the list if it is time."""
+    AppendToFile(self._path, filename + '\n')
+    if time.time() - self._last_flush.value >= self.flush_interval:
+      self.Flush()
+
+  def Flush(self):
+    """Uploads the list of uploaded files, if it changed since last time."""
+    self._last_flush.value = time.time()
+    if not os.path.exists(self._path):
+      return
+    with locking.FileLock('%s.lock' % self._path, verbose=False).write_lock():
+      size = os.path.getsize(self._path)
+      if size != self._flushed_size.value:
+        UploadArchivedFile(self.archive_path, self.upload_url,
+                           UPLOADED_LIST_FILENAME, self.debug)
+        self._flushed_size.value = size
+
+
 def UploadArchivedFile(archive_path, upload_url, filename, debug,
-                       update_list=False, timeout=30 * 60, acl=None):
+                       update_list=False, timeout=30 * 60, acl=None,
+                       uploaded_list=None):
   """Upload the specified tarball from the archive dir to Google Storage.
 
   Args:
@@ -964,6 +1016,8 @@ def UploadArchivedFile(archive_path, upload_url, filename, debug,
     timeout: Raise an exception if the upload takes longer than this timeout.
     acl: Canned gsutil acl to use (e.g. 'public-read'), otherwise the internal
          (private) one is used.
+    uploaded_list: UploadedList to record the upload in.  Unlike update_list,
+                   this doesn't upload the list on every call.
   """
 
   if upload_url:
@@ -987,7 +1041,9 @@ def UploadArchivedFile(archive_path, upload_url, filename, debug,
           cros_build_lib.RunCommandCaptureOutput(cmd, debug_level=logging.DEBUG)
 
     # Update the list of uploaded files.
-    if update_list:
+    if uploaded_list is not None:
+      uploaded_list.Add(filename)
+    elif update_list:
       UpdateUploadedList(filename, archive_path, upload_url, debug)
 
 
@@ -1125,7 +1181,8 @@ def BuildTarball(buildroot, input_list, tarball_output, cwd=None,
     input_list: A list of files and directories to be archived.
     tarball_output: Path of output tar archive file.
     cwd: Current working directory when tar command is executed.
-    compressed: Whether or not the tarball should be compressed with pbzip2.
+    compressed: Whether or not the tarball should be compressed with bzip2,
+      using all CPUs.
   """
   compressor = cros_build_lib.COMP_NONE
   chroot = None
@@ -1134,7 +1191,7 @@ def BuildTarball(buildroot, input_list, tarball_output, cwd=None,
     chroot = os.path.join(buildroot, 'chroot')
   cros_build_lib.CreateTarball(
       tarball_output, cwd, compression=compressor, chroot=chroot,
-      inputs=input_list)
+      inputs=input_list, parallel=True)
 
 
 def FindFilesWithPattern(pattern, target='./', cwd=os.curdir):
@@ -1238,7 +1295,7 @@ def BuildStandaloneImageTarball(archive_dir, image_bin):
   filename = '%s.tar.xz' % os.path.splitext(image_filename)[0]
   archive_filename = os.path.join(archive_dir, filename)
   cros_build_lib.CreateTarball(archive_filename, image_dir,
-                               inputs=[image_filename])
+                               inputs=[image_filename], parallel=True)
   return filename
 
 
@@ -17,6 +17,7 @@ from chromite.lib import cros_build_lib_unittest
 from chromite.lib import cros_test_lib
 from chromite.lib import git
 from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.lib import partial_mock
 
 # TODO(build): Finish test wrapper (http://crosbug.com/37517).
@@ -351,5 +352,52 @@ class UnmockedTests(cros_test_lib.TempDirTestCase):
     # Verify the tarball contents.
     cros_test_lib.VerifyTarball(tarball, fw_archived_files)
 
+
+class UploadedListTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for batching updates of the uploaded list."""
+
+  def setUp(self):
+    self.upload = self.StartPatcher(
+        mock.patch.object(commands, 'UploadArchivedFile', autospec=True))
+    self.list_path = os.path.join(self.tempdir, commands.UPLOADED_LIST_FILENAME)
+
+  def testBatched(self):
+    """The list is only uploaded once the interval passes, and on Flush."""
+    uploaded = commands.UploadedList(self.tempdir, 'gs://url', False,
+                                     flush_interval=3600)
+    uploaded.Flush()
+    self.assertFalse(self.upload.called)
+    uploaded.Add('a')
+    uploaded.Add('b')
+    self.assertFalse(self.upload.called)
+    self.assertEqual(osutils.ReadFile(self.list_path), 'a\nb\n')
+    uploaded.Flush()
+    self.upload.assert_called_once_with(
+        self.tempdir, 'gs://url', commands.UPLOADED_LIST_FILENAME, False)
+
+  def testInterval(self):
+    """Every addition is uploaded once the interval has passed."""
+    uploaded = commands.UploadedList(self.tempdir, 'gs://url', False,
+                                     flush_interval=0)
+    uploaded.Add('a')
+    uploaded.Add('b')
+    self.assertEqual(self.upload.call_count, 2)
+    # Nothing was added since the last upload.
+    uploaded.Flush()
+    self.assertEqual(self.upload.call_count, 2)
+
+  def testForkedFlush(self):
+    """Uploads done by forked processes are seen by the others."""
+    uploaded = commands.UploadedList(self.tempdir, 'gs://url', False,
+                                     flush_interval=3600)
+    uploaded.Add('a')
+    parallel.RunParallelSteps([uploaded.Flush])
+    # The upload happened in the child, so there is nothing left to upload.
+    uploaded.Flush()
+    self.assertFalse(self.upload.called)
+    uploaded.Add('b')
+    uploaded.Flush()
+    self.assertEqual(self.upload.call_count, 1)
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -426,6 +426,8 @@ class SyncStage(bs.BuilderStage):
 
   option_name = 'sync'
   output_manifest_sha1 = True
+  # Whether to only sync the projects that differ from the checkout.
+  incremental_sync = False
 
   def __init__(self, options, build_config):
     super(SyncStage, self).__init__(options, build_config)
@@ -450,6 +452,7 @@ class SyncStage(bs.BuilderStage):
       manifest_url = self._build_config['manifest_repo_url']
 
     kwds.setdefault('referenced_repo', self._options.reference_repo)
+    kwds.setdefault('mirror_root', repository.GetMirrorRoot())
     kwds.setdefault('branch', self._target_manifest_branch)
 
     self.repo = repository.RepoRepository(manifest_url, build_root, **kwds)
@@ -465,7 +468,7 @@ class SyncStage(bs.BuilderStage):
                            'NEXT MANIFEST: %s' % next_manifest]))
 
     if not self.skip_sync:
-      self.repo.Sync(next_manifest)
+      self.repo.Sync(next_manifest, incremental=self.incremental_sync)
     print >> sys.stderr, self.repo.ExportManifest(
         mark_revision=self.output_manifest_sha1)
 
@@ -527,6 +530,7 @@ class ManifestVersionedSyncStage(SyncStage):
 
   manifest_manager = None
   output_manifest_sha1 = False
+  incremental_sync = True
 
   def __init__(self, options, build_config):
     # Perform the sync at the end of the stage to the given manifest.
@@ -1295,13 +1299,22 @@ class VMTestStage(BoardSpecificBuilderStage):
 
     cros_build_lib.Info('Uploading artifacts to Google Storage...')
     download_url = self._archive_stage.GetDownloadUrl()
-    for filename in filenames:
+    uploaded_list = commands.UploadedList(archive_path, upload_url,
+                                          self._archive_stage.debug)
+    try:
+      for filename in filenames:
+        try:
+          commands.UploadArchivedFile(archive_path, upload_url, filename,
+                                      self._archive_stage.debug,
+                                      uploaded_list=uploaded_list)
+          self.PrintBuildbotLink(download_url, filename)
+        except cros_build_lib.RunCommandError as e:
+          # Treat gsutil flake as a warning if it's the only problem.
+          self._HandleExceptionAsWarning(e)
+    finally:
       try:
-        commands.UploadArchivedFile(archive_path, upload_url, filename,
-                                    self._archive_stage.debug, update_list=True)
-        self.PrintBuildbotLink(download_url, filename)
+        uploaded_list.Flush()
       except cros_build_lib.RunCommandError as e:
-        # Treat gsutil flake as a warning if it's the only problem.
         self._HandleExceptionAsWarning(e)
 
   def _PerformStage(self):
@@ -1847,6 +1860,7 @@ class ArchiveStage(BoardSpecificBuilderStage):
     upload_symbols_queue = self._upload_symbols_queue
     hw_test_upload_queue = self._hw_test_upload_queue
     bg_task_runner = parallel.BackgroundTaskRunner
+    uploaded_list = commands.UploadedList(archive_path, upload_url, debug)
 
     extra_env = {}
     if config['useflags']:
@@ -2039,16 +2053,21 @@ class ArchiveStage(BoardSpecificBuilderStage):
       """Upload generated artifact to Google Storage."""
       acl = None if config['internal'] else 'public-read'
       commands.UploadArchivedFile(archive_path, upload_url, filename, debug,
-                                  update_list=True, acl=acl)
+                                  acl=acl, uploaded_list=uploaded_list)
 
     def ArchiveArtifactsForHWTesting(num_upload_processes=6):
       """Archives artifacts required for HWTest stage."""
       success = False
       try:
-        with bg_task_runner(UploadArtifact, queue=hw_test_upload_queue,
-                            processes=num_upload_processes):
-          steps = [ArchiveAutotestTarballs, ArchivePayloads]
-          parallel.RunParallelSteps(steps)
+        try:
+          with bg_task_runner(UploadArtifact, queue=hw_test_upload_queue,
+                              processes=num_upload_processes):
+            steps = [ArchiveAutotestTarballs, ArchivePayloads]
+            parallel.RunParallelSteps(steps)
+        finally:
+          # Make sure the test artifacts are listed before tests look for
+          # them, and that whatever did get uploaded is listed on failure.
+          uploaded_list.Flush()
         success = True
       finally:
         self._hw_test_uploads_status_queue.put(success)
@@ -2058,7 +2077,8 @@ class ArchiveStage(BoardSpecificBuilderStage):
       target = os.path.join(archive_path, constants.IMAGE_SCRIPTS_TAR)
       files = glob.glob(os.path.join(image_dir, '*.sh'))
       files = [os.path.basename(f) for f in files]
-      cros_build_lib.CreateTarball(target, image_dir, inputs=files)
+      cros_build_lib.CreateTarball(target, image_dir, inputs=files,
+                                   parallel=True)
       upload_queue.put([constants.IMAGE_SCRIPTS_TAR])
 
     def PushImage():
@@ -2098,11 +2118,14 @@ class ArchiveStage(BoardSpecificBuilderStage):
             [self.ArchiveStrippedChrome, self.BuildAndArchiveChromeSysroot,
              self.ArchiveChromeEbuildEnv, ArchiveImageScripts])
 
-      with bg_task_runner(UploadSymbols, queue=upload_symbols_queue,
-                          processes=1):
-        with bg_task_runner(UploadArtifact, queue=upload_queue,
-                            processes=num_upload_processes):
-          parallel.RunParallelSteps(steps)
+      try:
+        with bg_task_runner(UploadSymbols, queue=upload_symbols_queue,
+                            processes=1):
+          with bg_task_runner(UploadArtifact, queue=upload_queue,
+                              processes=num_upload_processes):
+            parallel.RunParallelSteps(steps)
+      finally:
+        uploaded_list.Flush()
 
     def MarkAsLatest():
       # Update and upload LATEST file.
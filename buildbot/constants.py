@@ -54,6 +54,7 @@ MANIFEST_INT_URL = '%s/%s' % (GERRIT_INT_SSH_URL, MANIFEST_INT_PROJECT)
 
 DEFAULT_MANIFEST = 'default.xml'
 SHARED_CACHE_ENVVAR = 'CROS_CACHEDIR'
+GIT_MIRROR_ENVVAR = 'CROS_GIT_MIRROR_DIR'
 
 # CrOS remotes specified in the manifests.
 EXTERNAL_REMOTE = 'cros'
@@ -274,5 +275,8 @@ METADATA_JSON = 'metadata.json'
 # Global configuration constants.
 CHROMITE_CONFIG_DIR = os.path.expanduser('~/.chromite')
 CHROME_SDK_BASHRC = os.path.join(CHROMITE_CONFIG_DIR, 'chrome_sdk.bashrc')
+# Where the project mirrors shared by all buildroots of a host live, unless
+# overridden via GIT_MIRROR_ENVVAR.
+GIT_MIRROR_DEFAULT_DIR = os.path.join(CHROMITE_CONFIG_DIR, 'git-mirrors')
 SYNC_RETRIES = 2
 SLEEP_TIMEOUT = 30
@@ -113,6 +113,8 @@ class LKGMManager(manifest_version.BuildSpecsManager):
   MAX_TIMEOUT_SECONDS = 300
   # Polling timeout for checking git repo for other build statuses.
   SLEEP_TIMEOUT = constants.SLEEP_TIMEOUT
+  # Longest polling timeout, when backing off while nothing changes.
+  MAX_SLEEP_TIMEOUT = 2 * constants.SLEEP_TIMEOUT
 
   # Sub-directories for LKGM and Chrome LKGM's.
   LKGM_SUBDIR = 'LKGM-candidates'
@@ -148,8 +150,13 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       assert cbuildbot_config.IsPFQType(self.build_type)
       self.rel_working_dir = self.LKGM_SUBDIR
 
-  def _RunLambdaWithTimeout(self, function_to_run, use_long_timeout=False):
-    """Runs function_to_run until it returns a value or timeout is reached."""
+  def _RunLambdaWithTimeout(self, function_to_run, use_long_timeout=False,
+                            get_sleep_timeout=None):
+    """Runs function_to_run until it returns a value or timeout is reached.
+
+    Between runs, sleeps for SLEEP_TIMEOUT seconds, or for as long as
+    get_sleep_timeout() returns if given.
+    """
     function_success = False
     start_time = time.time()
     max_timeout = self.MAX_TIMEOUT_SECONDS
@@ -164,6 +171,8 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       function_success = function_to_run()
       if function_success:
         break
+      elif get_sleep_timeout:
+        time.sleep(get_sleep_timeout())
       else:
         time.sleep(self.SLEEP_TIMEOUT)
 
@@ -363,36 +372,47 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       self.SetInFlight(version_to_build)
       self.current_version = version_to_build
 
-      # Actually perform the sync.
+      # Actually perform the sync.  The candidate usually only differs from
+      # the tip we just checked out in a handful of projects.
       manifest = self.GetLocalManifest(version_to_build)
-      self.cros_source.Sync(manifest)
+      self.cros_source.Sync(manifest, incremental=True)
       self._GenerateBlameListSinceLKGM()
       return manifest
     else:
       return None
 
   def GetBuildersStatus(self, builders_array):
-    """Returns a build-names->status dictionary of build statuses."""
+    """Returns a build-names->status dictionary of build statuses.
+
+    The statuses of all builders still running are fetched at once each
+    round.  While the status of no builder changes, rounds are spaced further
+    apart, up to MAX_SLEEP_TIMEOUT.
+    """
     builders_completed = set()
     builder_statuses = {}
+    idle_rounds = [0]
 
     def _CheckStatusOfBuildersArray():
       """Helper function that iterates through current statuses."""
-      for b in builders_array:
-        cached_status = builder_statuses.get(b)
-        if not cached_status or not cached_status.Completed():
-          logging.debug("Checking for builder %s's status", b)
-          builder_status = self.GetBuildStatus(b, self.current_version)
-          builder_statuses[b] = builder_status
-          if builder_status is None:
-            logging.warn('No status found for builder %s.', b)
-          elif builder_status.Passed():
-            builders_completed.add(b)
-            logging.info('Builder %s completed with status passed', b)
-          elif builder_status.Failed():
-            builders_completed.add(b)
-            logging.info('Builder %s completed with status failed', b)
-
+      pending = [b for b in builders_array if b not in builders_completed]
+      logging.debug('Checking the status of builders %r', pending)
+      statuses = self.GetBuildStatuses(pending, self.current_version)
+      idle_rounds[0] += 1
+      for b in pending:
+        # Any news, including the first status seen, ends the backoff.
+        if (b not in builder_statuses or
+            getattr(builder_statuses[b], 'status', None) !=
+            getattr(statuses[b], 'status', None)):
+          idle_rounds[0] = 0
+        builder_status = builder_statuses[b] = statuses[b]
+        if builder_status is None:
+          logging.warn('No status found for builder %s.', b)
+        elif builder_status.Passed():
+          builders_completed.add(b)
+          logging.info('Builder %s completed with status passed', b)
+        elif builder_status.Failed():
+          builders_completed.add(b)
+          logging.info('Builder %s completed with status failed', b)
 
       if len(builders_completed) < len(builders_array):
         logging.info('Still waiting for the following builds to complete: %r',
@@ -401,9 +421,15 @@ class LKGMManager(manifest_version.BuildSpecsManager):
       else:
         return 'Builds completed.'
 
+    def _GetSleepTimeout():
+      """Back off exponentially while no builder changes status."""
+      return min(self.SLEEP_TIMEOUT * 2 ** idle_rounds[0],
+                 self.MAX_SLEEP_TIMEOUT)
+
     # Check for build completion until all builders report in.
-    builds_succeeded = self._RunLambdaWithTimeout(_CheckStatusOfBuildersArray,
-                                                  use_long_timeout=True)
+    builds_succeeded = self._RunLambdaWithTimeout(
+        _CheckStatusOfBuildersArray, use_long_timeout=True,
+        get_sleep_timeout=_GetSleepTimeout)
     if not builds_succeeded:
       logging.error('Not all builds finished before MAX_TIMEOUT reached.')
 
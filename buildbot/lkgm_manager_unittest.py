@@ -10,6 +10,7 @@ import mox
 import os
 import sys
 import tempfile
+import time
 from xml.dom import minidom
 
 if __name__ == '__main__':
@@ -270,7 +271,7 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
     lkgm_manager.LKGMManager.SetInFlight(most_recent_candidate.VersionString())
     repository.RepoRepository.Sync(
-        self._GetPathToManifest(most_recent_candidate))
+        self._GetPathToManifest(most_recent_candidate), incremental=True)
 
     self.manager.latest_unprocessed = '1.2.3-rc12'
     self.mox.ReplayAll()
@@ -301,7 +302,7 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
     lkgm_manager.LKGMManager.SetInFlight(most_recent_candidate.VersionString())
     repository.RepoRepository.Sync(
-        self._GetPathToManifest(most_recent_candidate))
+        self._GetPathToManifest(most_recent_candidate), incremental=True)
 
     self.manager.latest_unprocessed = '1.2.4-rc12'
     self.mox.ReplayAll()
@@ -346,16 +347,20 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
     Args:
       builders: List of builders to get status for.
-      status_runs: List of expected (builder, status) tuples.
+      status_runs: List of polling rounds, each a list of the expected
+        (builder, status) tuples fetched in that round.
     """
-    self.mox.StubOutWithMock(lkgm_manager.LKGMManager, 'GetBuildStatus')
-    for builder, status in status_runs:
-      # GetBuildStatus returns None if the builder has not even started yet
-      # (e.g. because the builder is down.)
-      if status is not None:
-        status = manifest_version.BuilderStatus(status, None)
-      lkgm_manager.LKGMManager.GetBuildStatus(
-          builder, mox.IgnoreArg()).AndReturn(status)
+    self.mox.StubOutWithMock(lkgm_manager.LKGMManager, 'GetBuildStatuses')
+    for statuses in status_runs:
+      results = {}
+      for builder, status in statuses:
+        # GetBuildStatus returns None if the builder has not even started yet
+        # (e.g. because the builder is down.)
+        if status is not None:
+          status = manifest_version.BuilderStatus(status, None)
+        results[builder] = status
+      lkgm_manager.LKGMManager.GetBuildStatuses(
+          [b for b, _ in statuses], mox.IgnoreArg()).AndReturn(results)
 
     self.mox.ReplayAll()
     statuses = self.manager.GetBuildersStatus(builders)
@@ -364,20 +369,34 @@ class LKGMManagerTest(cros_test_lib.MoxTempDirTestCase):
 
   def testGetBuildersStatusBothFinished(self):
     """Tests GetBuilderStatus where both builds have finished."""
-    status_runs = [('build1', 'fail'), ('build2', 'pass')]
+    status_runs = [[('build1', 'fail'), ('build2', 'pass')]]
     statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
     self.assertTrue(statuses['build1'].Failed())
     self.assertTrue(statuses['build2'].Passed())
 
   def testGetBuildersStatusLoop(self):
     """Tests GetBuilderStatus where builds are inflight."""
-    status_runs = [('build1', 'inflight'), ('build2', None),
-                   ('build1', 'fail'), ('build2', 'inflight'),
-                   ('build2', 'pass')]
+    status_runs = [[('build1', 'inflight'), ('build2', None)],
+                   [('build1', 'fail'), ('build2', 'inflight')],
+                   [('build2', 'pass')]]
     statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
     self.assertTrue(statuses['build1'].Failed())
     self.assertTrue(statuses['build2'].Passed())
 
+  def testGetBuildersStatusBackoff(self):
+    """Tests GetBuilderStatus backs off only while no status changes."""
+    sleeps = []
+    self.mox.stubs.Set(time, 'sleep', sleeps.append)
+    self.manager.SLEEP_TIMEOUT = 10
+    self.manager.MAX_SLEEP_TIMEOUT = 20
+    status_runs = [[('build1', 'inflight'), ('build2', None)]] * 3 + [
+                   [('build1', 'inflight'), ('build2', 'inflight')],
+                   [('build1', 'pass'), ('build2', 'fail')]]
+    statuses = self._GetBuildersStatus(['build1', 'build2'], status_runs)
+    self.assertTrue(statuses['build1'].Passed())
+    self.assertTrue(statuses['build2'].Failed())
+    self.assertEqual(sleeps, [10, 20, 20, 10])
+
   def testGenerateBlameListSinceLKGM(self):
     """Tests that we can generate a blamelist from two commit messages.
 
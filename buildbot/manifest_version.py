@@ -6,9 +6,13 @@
 A library to generate and store the manifests for cros builders to use.
 """
 
+import bisect
 import cPickle
 import fnmatch
+import functools
+import json
 import logging
+import multiprocessing
 import os
 import re
 import shutil
@@ -19,12 +23,17 @@ from chromite.lib import cros_build_lib
 from chromite.lib import git
 from chromite.lib import gs
 from chromite.lib import osutils
+from chromite.lib import parallel
 
 
 MANIFEST_VERSIONS_URL = 'gs://chromeos-manifest-versions'
 BUILD_STATUS_URL = '%s/builder-status' % MANIFEST_VERSIONS_URL
 PUSH_BRANCH = 'temp_auto_checkin_branch'
 NUM_RETRIES = 20
+# Most gsutil processes to run at once when fetching many build statuses.
+STATUS_FETCH_PROCESSES = 16
+# Where SpecIndex saves its state, relative to the git dir.
+SPEC_INDEX_STATE = 'cros-spec-index.json'
 
 
 class VersionUpdateException(Exception):
@@ -42,6 +51,22 @@ class GenerateBuildSpecException(Exception):
   pass
 
 
+def _FetchBuildStatus(results, builder, version, retries):
+  """Process pool helper for BuildSpecsManager.GetBuildStatuses.
+
+  Puts a (builder, success, status) tuple on the |results| queue.  Errors
+  aren't passed back; the caller fetches the status again itself to raise
+  them.
+  """
+  try:
+    status = BuildSpecsManager.GetBuildStatus(builder, version,
+                                              retries=retries)
+  except Exception:
+    results.put((builder, False, None))
+  else:
+    results.put((builder, True, status))
+
+
 def RefreshManifestCheckout(manifest_dir, manifest_repo):
   """Checks out manifest-versions into the manifest directory.
 
@@ -352,6 +377,189 @@ class BuilderStatus(object):
       return cls.STATUS_FAILED
 
 
+class SpecIndex(object):
+  """Index of the buildspecs checked into a manifest-versions checkout.
+
+  Rather than listing and sorting a spec directory on every lookup, the spec
+  names in each directory are indexed from the git tree once, and brought up
+  to date from the commits that landed since whenever the checkout changes.
+  The index is saved in the git dir, so later runs only look at new commits.
+
+  Specs written to the checkout but not yet refreshed from git are recorded
+  with Add.
+  """
+
+  def __init__(self, manifest_dir):
+    self.manifest_dir = manifest_dir
+    self._commit = None
+    # Maps a directory relative to manifest_dir to the spec names in it.
+    self._specs = {}
+    # Specs added with Add since the last Update.
+    self._pending = {}
+    # Maps (directory, key_fn) to sorted ([keys], [names]) lists.
+    self._sorted = {}
+    self._loaded = False
+
+  def _GetStatePath(self):
+    git_dir = git.RunGit(self.manifest_dir,
+                         ['rev-parse', '--git-dir']).output.strip()
+    return os.path.join(self.manifest_dir, git_dir, SPEC_INDEX_STATE)
+
+  def _RelPath(self, directory):
+    """Returns |directory| relative to the checkout, or None if outside it."""
+    rel = os.path.relpath(directory, self.manifest_dir)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+      return None
+    return '' if rel == os.curdir else rel
+
+  def _Index(self, path, specs):
+    """Adds the spec at |path| to |specs| if it is one."""
+    directory, name = os.path.split(path)
+    spec, ext = os.path.splitext(name)
+    if ext == '.xml':
+      specs.setdefault(directory, set()).add(spec)
+      return directory
+
+  def _Unindex(self, path):
+    directory, name = os.path.split(path)
+    spec, ext = os.path.splitext(name)
+    if ext == '.xml':
+      self._specs.get(directory, set()).discard(spec)
+      return directory
+
+  def _Invalidate(self, directories):
+    """Drops the sorted lists of |directories|."""
+    for key in self._sorted.keys():
+      if key[0] in directories:
+        del self._sorted[key]
+
+  def _Load(self):
+    """Loads the saved index, if it is still usable."""
+    self._loaded = True
+    try:
+      state = json.loads(osutils.ReadFile(self._GetStatePath()))
+      self._commit = str(state['commit'])
+      self._specs = dict((str(d), set(str(x) for x in specs))
+                         for d, specs in state['specs'].iteritems())
+    except (EnvironmentError, ValueError, KeyError, TypeError):
+      self._commit = None
+      self._specs = {}
+
+  def _Save(self):
+    state = {
+        'commit': self._commit,
+        'specs': dict((d, sorted(specs))
+                      for d, specs in self._specs.iteritems() if specs),
+    }
+    osutils.WriteFile(self._GetStatePath(), json.dumps(state), atomic=True)
+
+  def Update(self):
+    """Brings the index up to date with HEAD of the checkout.
+
+    Returns:
+      True if the index is usable, False if the checkout is not a git
+      repository and the spec directories must be scanned instead.
+    """
+    if not git.IsGitRepo(self.manifest_dir):
+      return False
+    if not self._loaded:
+      self._Load()
+
+    result = git.RunGit(self.manifest_dir, ['rev-parse', 'HEAD'],
+                        error_code_ok=True)
+    if result.returncode:
+      return False
+    head = result.output.strip()
+
+    # Whatever was added since the last update is either in HEAD now, or was
+    # cleaned out of the checkout.
+    stale = set(self._pending)
+    self._pending = {}
+    if head == self._commit:
+      self._Invalidate(stale)
+      return True
+
+    changed = None
+    if self._commit:
+      result = git.RunGit(self.manifest_dir,
+                          ['diff', '--name-status', '--no-renames', '-z',
+                           self._commit, head, '--'], error_code_ok=True)
+      if not result.returncode:
+        changed = set()
+        fields = result.output.split('\0')
+        for status, path in zip(fields[0::2], fields[1::2]):
+          if status == 'D':
+            changed.add(self._Unindex(path))
+          else:
+            changed.add(self._Index(path, self._specs))
+
+    if changed is None:
+      self._specs = {}
+      output = git.RunGit(self.manifest_dir,
+                          ['ls-tree', '-r', '--name-only', '-z', head]).output
+      for path in output.split('\0'):
+        self._Index(path, self._specs)
+      self._sorted = {}
+    else:
+      self._Invalidate(stale | changed)
+
+    self._commit = head
+    self._Save()
+    return True
+
+  def Add(self, path):
+    """Records the spec file at |path| as present in the checkout."""
+    rel = self._RelPath(path)
+    if rel is not None:
+      self._Invalidate([self._Index(rel, self._pending)])
+
+  def GetSpecs(self, directory):
+    """Returns the set of spec names in |directory|, or None if not indexed."""
+    if self._commit is None and not self.Update():
+      return None
+    rel = self._RelPath(directory)
+    if rel is None:
+      return None
+    return self._specs.get(rel, set()) | self._pending.get(rel, set())
+
+  def GetLatest(self, directory, key_fn, prefix=''):
+    """Returns the latest spec in |directory|.
+
+    Args:
+      directory: Directory of the buildspecs.
+      key_fn: Function returning the comparable version of a spec name, as a
+        list of numbers.
+      prefix: Only consider specs whose name starts with this many leading
+        version numbers, e.g. '13.' or '13.2.'.
+
+    Returns:
+      The latest spec, or None if there are none.
+
+    Raises:
+      ValueError if |directory| is not indexed.
+    """
+    specs = self.GetSpecs(directory)
+    if specs is None:
+      raise ValueError('%s is not indexed' % directory)
+
+    cache_key = (self._RelPath(directory), key_fn)
+    entry = self._sorted.get(cache_key)
+    if entry is None:
+      entry = sorted((key_fn(spec), spec) for spec in specs)
+      entry = self._sorted[cache_key] = ([k for k, _ in entry],
+                                         [spec for _, spec in entry])
+    keys, names = entry
+
+    lo, hi = 0, len(keys)
+    if prefix:
+      start = [int(x) for x in prefix.rstrip('.').split('.')]
+      end = start[:-1] + [start[-1] + 1]
+      lo = bisect.bisect_left(keys, start)
+      hi = bisect.bisect_left(keys, end)
+    if hi > lo:
+      return names[hi - 1]
+
+
 class BuildSpecsManager(object):
   """A Class to manage buildspecs and their states."""
 
@@ -399,6 +607,7 @@ class BuildSpecsManager(object):
 
     self.current_version = None
     self.rel_working_dir = ''
+    self._spec_index = None
 
   def _LatestSpecFromList(self, specs):
     """Find the latest spec in a list of specs.
@@ -412,19 +621,37 @@ class BuildSpecsManager(object):
     if specs:
       return max(specs, key=self.compare_versions_fn)
 
+  def _GetSpecIndex(self):
+    """Returns the SpecIndex of the manifest-versions checkout."""
+    if (self._spec_index is None or
+        self._spec_index.manifest_dir != self.manifest_dir):
+      self._spec_index = SpecIndex(self.manifest_dir)
+    return self._spec_index
+
   def _LatestSpecFromDir(self, version_info, directory):
     """Returns the latest buildspec that match '*.xml' in a directory.
+
+    Uses the spec index when the manifest-versions checkout is a git
+    repository, and scans the directory otherwise.
+
     Args:
       directory: Directory of the buildspecs.
     """
+    prefix = version_info.BuildPrefix()
+    spec_index = self._GetSpecIndex()
+    if spec_index.GetSpecs(directory) is not None:
+      return spec_index.GetLatest(directory, self.compare_versions_fn,
+                                  prefix=prefix)
+
     if os.path.exists(directory):
-      match_string = version_info.BuildPrefix() + '*.xml'
+      match_string = prefix + '*.xml'
       specs = fnmatch.filter(os.listdir(directory), match_string)
       return self._LatestSpecFromList([os.path.splitext(m)[0] for m in specs])
 
   def RefreshManifestCheckout(self):
     """Checks out manifest versions into the manifest directory."""
     RefreshManifestCheckout(self.manifest_dir, self.manifest_repo)
+    self._GetSpecIndex().Update()
 
   def InitializeManifestVariables(self, version_info):
     """Initializes manifest-related instance variables.
@@ -503,6 +730,7 @@ class BuildSpecsManager(object):
     osutils.SafeMakedirs(os.path.dirname(spec_file))
 
     shutil.copyfile(manifest, spec_file)
+    self._GetSpecIndex().Add(spec_file)
 
     # Actually push the manifest.
     self.PushSpecChanges(commit_message)
@@ -538,6 +766,43 @@ class BuildSpecsManager(object):
       raise
     return BuilderStatus(**cPickle.loads(result.output))
 
+  @staticmethod
+  def GetBuildStatuses(builders, version, retries=3):
+    """Returns the BuilderStatus of many builders, fetched concurrently.
+
+    Args:
+      builders: Builders to look at.
+      version: Version string.
+      retries: Number of retries for getting each status.
+
+    Returns:
+      A dictionary mapping each builder to its status; see GetBuildStatus.
+    """
+    builders = list(builders)
+    results = dict.fromkeys(builders)
+    failed = builders
+    if len(builders) > 1:
+      queue = multiprocessing.Queue()
+      task = functools.partial(_FetchBuildStatus, queue)
+      processes = min(len(builders), STATUS_FETCH_PROCESSES)
+      with parallel.BackgroundTaskRunner(task, processes=processes) as tasks:
+        for builder in builders:
+          tasks.put([builder, version, retries])
+        # Drain the results before the workers are joined, lest they block
+        # on a full pipe.
+        fetched = [queue.get() for _ in builders]
+      failed = []
+      for builder, success, status in fetched:
+        if success:
+          results[builder] = status
+        else:
+          failed.append(builder)
+
+    for builder in failed:
+      results[builder] = BuildSpecsManager.GetBuildStatus(builder, version,
+                                                          retries=retries)
+    return results
+
   def GetLatestPassingSpec(self):
     """Get the last spec file that passed in the current branch."""
     version_info = self.GetCurrentVersionInfo()
@@ -684,6 +949,7 @@ class BuildSpecsManager(object):
     src_file = os.path.join(self.all_specs_dir, filename)
     logging.debug('Setting build to failed  %s: %s', src_file, dest_file)
     CreateSymlink(src_file, dest_file)
+    self._GetSpecIndex().Add(dest_file)
 
   def _SetPassed(self):
     """Marks the buildspec as passed by creating a symlink in passed dir."""
@@ -691,6 +957,7 @@ class BuildSpecsManager(object):
     src_file = '%s.xml' % os.path.join(self.all_specs_dir, self.current_version)
     logging.debug('Setting build to passed  %s: %s', src_file, dest_file)
     CreateSymlink(src_file, dest_file)
+    self._GetSpecIndex().Add(dest_file)
 
   def PushSpecChanges(self, commit_message):
     """Pushes any changes you have in the manifest directory."""
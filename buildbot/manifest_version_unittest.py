@@ -73,6 +73,72 @@ class HelperMethodsTest(cros_test_lib.TempDirTestCase):
                                      dry_run=True)
 
 
+class SpecIndexTest(cros_test_lib.TempDirTestCase):
+  """Tests for the git-backed buildspec index."""
+
+  def setUp(self):
+    self.specs_dir = os.path.join(self.tempdir, 'buildspecs', CHROME_BRANCH)
+    git.RunGit(self.tempdir, ['init'])
+    for key, value in (('user.name', 'Test'),
+                       ('user.email', 'test@example.com')):
+      git.RunGit(self.tempdir, ['config', key, value])
+
+  def _Commit(self, add=(), remove=()):
+    """Commits specs named in |add| and removes those in |remove|."""
+    for spec in add:
+      osutils.Touch(os.path.join(self.specs_dir, spec + '.xml'), makedirs=True)
+    for spec in remove:
+      os.unlink(os.path.join(self.specs_dir, spec + '.xml'))
+    git.RunGit(self.tempdir, ['add', '-A'])
+    git.RunGit(self.tempdir, ['commit', '-m', 'specs'])
+
+  def _GetLatest(self, index, prefix=''):
+    return index.GetLatest(self.specs_dir,
+                           manifest_version.VersionInfo.VersionCompare,
+                           prefix=prefix)
+
+  def testNotGitRepo(self):
+    """Tests that an index outside a git checkout is not used."""
+    index = manifest_version.SpecIndex(self.specs_dir)
+    self.assertEqual(index.GetSpecs(self.specs_dir), None)
+    self.assertRaises(ValueError, self._GetLatest, index)
+
+  def testGetLatest(self):
+    """Tests latest spec lookups, with and without a prefix."""
+    self._Commit(add=['99.1.5', '99.1.10', '99.3.3', '100.0.0'])
+    index = manifest_version.SpecIndex(self.tempdir)
+    self.assertEqual(self._GetLatest(index), '100.0.0')
+    self.assertEqual(self._GetLatest(index, prefix='99.'), '99.3.3')
+    self.assertEqual(self._GetLatest(index, prefix='99.1.'), '99.1.10')
+    self.assertEqual(self._GetLatest(index, prefix='98.'), None)
+    self.assertEqual(index.GetSpecs(os.path.join(self.tempdir, 'other')),
+                     set())
+
+  def testIncrementalUpdate(self):
+    """Tests that new commits and added specs are picked up."""
+    self._Commit(add=['99.1.5', '99.1.10'])
+    index = manifest_version.SpecIndex(self.tempdir)
+    self.assertEqual(self._GetLatest(index), '99.1.10')
+
+    self._Commit(add=['99.1.11'], remove=['99.1.10'])
+    self.assertTrue(index.Update())
+    self.assertEqual(index.GetSpecs(self.specs_dir),
+                     set(['99.1.5', '99.1.11']))
+    self.assertEqual(self._GetLatest(index), '99.1.11')
+
+    # A new instance picks up the saved index.
+    self._Commit(add=['99.1.12'])
+    index = manifest_version.SpecIndex(self.tempdir)
+    self.assertTrue(index.Update())
+    self.assertEqual(self._GetLatest(index), '99.1.12')
+
+    # Uncommitted specs are only seen until the next update.
+    index.Add(os.path.join(self.specs_dir, '99.1.13.xml'))
+    self.assertEqual(self._GetLatest(index), '99.1.13')
+    self.assertTrue(index.Update())
+    self.assertEqual(self._GetLatest(index), '99.1.12')
+
+
 class VersionInfoTest(cros_test_lib.MoxTempDirTestCase):
   """Test methods testing methods in VersionInfo class."""
 
@@ -252,6 +318,28 @@ class BuildSpecsManagerTest(cros_test_lib.MoxTempDirTestCase):
     self.mox.VerifyAll()
     self.assertEqual(FAKE_VERSION_STRING_NEXT, version)
 
+  def testGetBuildStatusesRetriesFailures(self):
+    """Tests that statuses the workers failed to fetch are fetched again."""
+    passed = manifest_version.BuilderStatus('pass', None)
+    failed = manifest_version.BuilderStatus('fail', None)
+    parent = os.getpid()
+
+    def _GetBuildStatus(builder, version, retries=3):
+      self.assertEqual((version, retries), (FAKE_VERSION_STRING, 3))
+      if builder == 'build1':
+        return passed
+      if os.getpid() == parent:
+        return failed
+      raise cros_build_lib.RunCommandError('flaky gsutil', None)
+
+    self.mox.stubs.Set(manifest_version.BuildSpecsManager, 'GetBuildStatus',
+                       staticmethod(_GetBuildStatus))
+    statuses = self.manager.GetBuildStatuses(['build1', 'build2'],
+                                             FAKE_VERSION_STRING)
+    # The statuses fetched by the workers come back as copies.
+    self.assertEqual(dict((k, v.status) for k, v in statuses.iteritems()),
+                     {'build1': 'pass', 'build2': 'fail'})
+
   def NotestGetNextBuildSpec(self):
     """Meta test.  Re-enable if you want to use it to do a big test."""
     print self.manager.GetNextBuildSpec(retries=0)
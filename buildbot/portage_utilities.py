@@ -5,21 +5,27 @@
 """Routines and classes for working with Portage overlays and ebuilds."""
 
 import collections
+import cPickle
 import filecmp
 import fileinput
+import functools
 import glob
+import json
 import logging
 import multiprocessing
 import os
 import re
 import shutil
+import stat
 import sys
+import traceback
 
 from chromite.buildbot import constants
 from chromite.lib import cros_build_lib
 from chromite.lib import gerrit
 from chromite.lib import git
 from chromite.lib import osutils
+from chromite.lib import parallel
 
 _PRIVATE_PREFIX = '%(buildroot)s/src/private-overlays'
 _GLOBAL_OVERLAYS = [
@@ -29,13 +35,46 @@ _GLOBAL_OVERLAYS = [
   '%(buildroot)s/src/third_party/portage',
 ]
 
+# Records, in an overlay's git dir, the commits the md5-cache was last
+# regenerated at.  See RegenCache.
+_REGEN_CACHE_STATE = 'cros-regen-cache.json'
+_REGEN_CACHE_INDEX = 'cros-regen-cache.index'
+# Changes to any of these files invalidate the whole md5-cache.
+_REGEN_CACHE_GLOBAL_FILES = frozenset([
+  'metadata/layout.conf',
+  'profiles/categories',
+  'profiles/repo_name',
+])
+
 # Takes two strings, package_name and commit_id.
 _GIT_COMMIT_MESSAGE = 'Marking 9999 ebuild for %s with commit(s) %s as stable.'
 
 # Define datastructures for holding PV and CPV objects.
 _PV_FIELDS = ['pv', 'package', 'version', 'version_no_rev', 'rev']
-PV = collections.namedtuple('PV', _PV_FIELDS)
-CPV = collections.namedtuple('CPV', ['category'] + _PV_FIELDS)
+
+
+class PV(collections.namedtuple('PV', _PV_FIELDS)):
+  """A parsed $PV.  See SplitPV."""
+  __slots__ = ()
+
+  @property
+  def version_key(self):
+    """A key that sorts versions the way Portage compares them."""
+    return GetVersionKey(self.version)
+
+
+class CPV(collections.namedtuple('CPV', ['category'] + _PV_FIELDS)):
+  """A parsed $CATEGORY/$PV.  See SplitCPV."""
+  __slots__ = ()
+
+  @property
+  def cp(self):
+    return '%s/%s' % (self.category, self.package)
+
+  @property
+  def version_key(self):
+    """A key that sorts versions the way Portage compares them."""
+    return GetVersionKey(self.version)
 
 # Package matching regexp, as dictated by package manager specification:
 # http://www.gentoo.org/proj/en/qa/pms.xml
@@ -45,6 +84,18 @@ _ver = '(?P<version>' + \
        '((_(pre|p|beta|alpha|rc)\d*)*))' + \
        '(-(?P<rev>r(\d+)))?)'
 _pvr_re = re.compile('^(?P<pv>%s-%s)$' % (_pkg, _ver), re.VERBOSE)
+_version_re = re.compile(r'^(\d+(?:\.\d+)*)([a-z]?)'
+                         r'((?:_(?:alpha|beta|pre|rc|p)\d*)*)(?:-r(\d+))?$')
+_suffix_re = re.compile(r'_([a-z]+)(\d*)')
+# Order of version suffixes; the empty string stands for "no more suffixes".
+_SUFFIX_ORDER = dict((suffix, i) for i, suffix in
+                     enumerate(('alpha', 'beta', 'pre', 'rc', '', 'p')))
+
+# Parsed versions, PVs and CPVs, keyed by the string they were parsed from.
+# The parsed values are immutable, so they are shared between callers.
+_version_key_cache = {}
+_pv_cache = {}
+_cpv_cache = {}
 
 # This regex matches blank lines, commented lines, and the EAPI line.
 _blank_or_eapi_re = re.compile(r'^\s*(?:#|EAPI=|$)')
@@ -139,6 +190,50 @@ def GetOverlayName(overlay):
     return None
 
 
+def GetOverlayMasters(overlay):
+  """Returns the repo names listed as masters in the overlay's layout.conf."""
+  layout = cros_build_lib.LoadKeyValueFile('%s/metadata/layout.conf' % overlay,
+                                           ignore_missing=True)
+  return layout.get('masters', '').split()
+
+
+def SortOverlaysByDependency(overlays, key=None):
+  """Order overlays so that every overlay comes after its masters.
+
+  Args:
+    overlays: The overlay directories to order.
+    key: Optional sort key; among the overlays whose masters have all been
+      placed, the one with the lowest key goes first.  Defaults to the path.
+
+  Returns:
+    A list of the overlays.  Overlays caught in a dependency cycle are placed
+    last, in key order.
+  """
+  if key is None:
+    key = lambda overlay: overlay
+  by_name = dict((GetOverlayName(x), x) for x in overlays)
+  by_name.pop(None, None)
+  pending = {}
+  for overlay in overlays:
+    pending[overlay] = set(by_name[m] for m in GetOverlayMasters(overlay)
+                           if by_name.get(m, overlay) != overlay)
+
+  ordered = []
+  while pending:
+    ready = [x for x, masters in pending.iteritems() if not masters]
+    if not ready:
+      cros_build_lib.Warning('Overlay masters form a cycle: %s' %
+                             ' '.join(sorted(pending)))
+      ordered.extend(sorted(pending, key=key))
+      break
+    overlay = min(ready, key=key)
+    ordered.append(overlay)
+    del pending[overlay]
+    for masters in pending.itervalues():
+      masters.discard(overlay)
+  return ordered
+
+
 class EBuildVersionFormatException(Exception):
   def __init__(self, filename):
     self.filename = filename
@@ -170,7 +265,7 @@ class EBuild(object):
   @classmethod
   def _RunCommand(cls, command, **kwargs):
     return cros_build_lib.RunCommandCaptureOutput(
-        command, print_cmd=cls.VERBOSE, **kwargs).output
+        command, print_cmd=cls.VERBOSE, use_pipes=True, **kwargs).output
 
   def IsSticky(self):
     """Returns True if the ebuild is sticky."""
@@ -251,8 +346,15 @@ class EBuild(object):
     cros_build_lib.RunCommand(git_commit_cmd, cwd=overlay,
                               print_cmd=cls.VERBOSE)
 
-  def __init__(self, path):
-    """Sets up data about an ebuild from its path."""
+  def __init__(self, path, metadata=None):
+    """Sets up data about an ebuild from its path.
+
+    Args:
+      path: Path to the ebuild.
+      metadata: If given, the (is_workon, is_stable, is_blacklisted) settings
+        of the ebuild, as returned by _ReadEBuildMetadata; the ebuild itself
+        is then not read.
+    """
     self._overlay, self._category, self._pkgname, filename = path.rsplit('/', 3)
     m = self._PACKAGE_VERSION_PATTERN.match(filename)
     if not m:
@@ -271,32 +373,26 @@ class EBuild(object):
     self._unstable_ebuild_path = '%s-9999.ebuild' % (
         self._ebuild_path_no_version)
     self.ebuild_path = path
+    self._source_paths = {}
 
     self.is_workon = False
     self.is_stable = False
     self.is_blacklisted = False
-    self._ReadEBuild(path)
+    if metadata is None:
+      self._ReadEBuild(path)
+    else:
+      self.is_workon, self.is_stable, self.is_blacklisted = metadata
 
   def _ReadEBuild(self, path):
     """Determine the settings of `is_workon` and `is_stable`.
 
-    `is_workon` is determined by whether the ebuild inherits from
-    the 'cros-workon' eclass.  `is_stable` is determined by whether
-    there's a '~' in the KEYWORDS setting in the ebuild.
+    See _ReadEBuildMetadata for how these are determined.
 
     This function is separate from __init__() to allow unit tests to
     stub it out.
     """
-    for line in fileinput.input(path):
-      if line.startswith('inherit ') and 'cros-workon' in line:
-        self.is_workon = True
-      elif line.startswith('KEYWORDS='):
-        for keyword in line.split('=', 1)[1].strip("\"'").split():
-          if not keyword.startswith('~') and keyword != '-*':
-            self.is_stable = True
-      elif line.startswith('CROS_WORKON_BLACKLIST='):
-        self.is_blacklisted = True
-    fileinput.close()
+    self.is_workon, self.is_stable, self.is_blacklisted = (
+        _ReadEBuildMetadata(path))
 
   def GetGitProjectName(self, path):
     """Read the project variable from a git repository at given path."""
@@ -308,7 +404,11 @@ class EBuild(object):
     """Get the project and path for this ebuild.
 
     The path is guaranteed to exist, be a directory, and be absolute.
+    The result is remembered, as it costs a git call per source directory.
     """
+    if srcroot in self._source_paths:
+      return self._source_paths[srcroot]
+
     workon_vars = (
         'CROS_WORKON_LOCALNAME',
         'CROS_WORKON_PROJECT',
@@ -362,6 +462,7 @@ class EBuild(object):
                            '(found %s, expected %s)' % (subdir_path,
                                                         real_project,
                                                         project))
+    self._source_paths[srcroot] = (projects, subdir_paths)
     return projects, subdir_paths
 
   def GetCommitId(self, srcdir):
@@ -430,7 +531,7 @@ class EBuild(object):
     else:
       return '"%s"' % unformatted_list[0]
 
-  def RevWorkOnEBuild(self, srcroot, redirect_file=None):
+  def RevWorkOnEBuild(self, srcroot, redirect_file=None, source_ids=None):
     """Revs a workon ebuild given the git commit hash.
 
     By default this class overwrites a new ebuild given the normal
@@ -443,6 +544,9 @@ class EBuild(object):
         redirect_file: Optional file to write the new ebuild.  By default
           it is written using the standard rev'ing logic.  This file must be
           opened and closed by the caller.
+        source_ids: Optional dictionary mapping source directories to their
+          (commit id, tree id), as returned by ResolveSourceIds.  Any source
+          directory not in it is looked up individually.
 
     Raises:
         OSError: Error occurred while creating a new ebuild.
@@ -468,9 +572,14 @@ class EBuild(object):
       cros_build_lib.Die('Missing unstable ebuild: %s' %
                          self._unstable_ebuild_path)
 
+    if source_ids is None:
+      source_ids = {}
     srcdirs = self.GetSourcePath(srcroot)[1]
-    commit_ids = map(self.GetCommitId, srcdirs)
-    tree_ids = map(self.GetTreeId, srcdirs)
+    commit_ids, tree_ids = [], []
+    for srcdir in srcdirs:
+      commit_id, tree_id = source_ids.get(srcdir, (None, None))
+      commit_ids.append(commit_id or self.GetCommitId(srcdir))
+      tree_ids.append(tree_id or self.GetTreeId(srcdir))
     variables = dict(CROS_WORKON_COMMIT=self.FormatBashArray(commit_ids),
                      CROS_WORKON_TREE=self.FormatBashArray(tree_ids))
     self.MarkAsStable(self._unstable_ebuild_path, new_stable_ebuild_path,
@@ -539,7 +648,8 @@ class EBuild(object):
     """
     directory_src = os.path.join(buildroot, 'src')
     overlay_dict = dict((o, []) for o in overlay_list)
-    BuildEBuildDictionary(overlay_dict, True, None)
+    BuildEBuildDictionary(overlay_dict, True, None,
+                          processes=multiprocessing.cpu_count())
     changed_projects = set(c.project for c in changes)
     ebuild_projects = {}
     for ebuilds in overlay_dict.itervalues():
@@ -587,7 +697,32 @@ def BestEBuild(ebuilds):
   return winner
 
 
-def _FindUprevCandidates(files):
+def _ReadEBuildMetadata(path):
+  """Read the settings of an ebuild relevant to uprevving.
+
+  `is_workon` is determined by whether the ebuild inherits from
+  the 'cros-workon' eclass.  `is_stable` is determined by whether
+  there's a '~' in the KEYWORDS setting in the ebuild.  `is_blacklisted`
+  is determined by whether CROS_WORKON_BLACKLIST is set.
+
+  Returns:
+    An (is_workon, is_stable, is_blacklisted) tuple.
+  """
+  is_workon = is_stable = is_blacklisted = False
+  for line in fileinput.input(path):
+    if line.startswith('inherit ') and 'cros-workon' in line:
+      is_workon = True
+    elif line.startswith('KEYWORDS='):
+      for keyword in line.split('=', 1)[1].strip("\"'").split():
+        if not keyword.startswith('~') and keyword != '-*':
+          is_stable = True
+    elif line.startswith('CROS_WORKON_BLACKLIST='):
+      is_blacklisted = True
+  fileinput.close()
+  return is_workon, is_stable, is_blacklisted
+
+
+def _FindUprevCandidates(files, metadata=None):
   """Return the uprev candidate ebuild from a specified list of files.
 
   Usually an uprev candidate is a the stable ebuild in a cros_workon
@@ -598,13 +733,17 @@ def _FindUprevCandidates(files):
 
   Args:
     files: List of files in a package directory.
+    metadata: Optional dictionary mapping ebuild paths to their already
+      known metadata; see _ReadEBuildMetadata.
   """
+  if metadata is None:
+    metadata = {}
   stable_ebuilds = []
   unstable_ebuilds = []
   for path in files:
     if not path.endswith('.ebuild') or os.path.islink(path):
       continue
-    ebuild = EBuild(path)
+    ebuild = EBuild(path, metadata=metadata.get(path))
     if not ebuild.is_workon or ebuild.is_blacklisted:
       continue
     if ebuild.is_stable:
@@ -650,7 +789,173 @@ def _FindUprevCandidates(files):
   return uprev_ebuild
 
 
-def BuildEBuildDictionary(overlays, use_all, packages):
+class EBuildMetadataCache(object):
+  """On-disk cache of ebuild metadata, keyed by path, mtime and size.
+
+  Entries are stored beneath the shared cache dir; if none is configured,
+  the cache only lives as long as this instance.
+  """
+
+  _FILENAME = 'ebuild-metadata.pickle'
+
+  def __init__(self, cache_dir=None):
+    if cache_dir is None:
+      cache_dir = os.environ.get(constants.SHARED_CACHE_ENVVAR)
+    self.path = None
+    if cache_dir:
+      self.path = os.path.join(cache_dir, self._FILENAME)
+    self._entries = {}
+    self._dirty = False
+    if self.path is not None:
+      try:
+        with open(self.path, 'rb') as f:
+          self._entries = cPickle.load(f)
+      except (EnvironmentError, EOFError, ValueError, cPickle.UnpicklingError):
+        pass
+
+  def Get(self, path, mtime, size):
+    """Returns the cached metadata of an ebuild, or None if stale/missing."""
+    entry = self._entries.get(path)
+    if entry is not None and entry[:2] == (mtime, size):
+      return entry[2]
+    return None
+
+  def Set(self, path, mtime, size, metadata):
+    self._entries[path] = (mtime, size, metadata)
+    self._dirty = True
+
+  def Prune(self, roots, seen):
+    """Drop the entries of ebuilds that are gone, e.g. after an uprev.
+
+    Args:
+      roots: The directories that were scanned.  Entries beneath them that
+        aren't in |seen| are dropped.  Others may belong to another checkout
+        sharing the cache, and are only dropped once the ebuild is deleted.
+      seen: The paths of the ebuilds found beneath |roots|.
+    """
+    roots = tuple(os.path.join(x, '') for x in roots)
+    for path in self._entries.keys():
+      if path not in seen and (path.startswith(roots) or
+                               not os.path.exists(path)):
+        del self._entries[path]
+        self._dirty = True
+
+  def Save(self):
+    """Write the cache back to disk; failures are ignored."""
+    if self.path is None or not self._dirty:
+      return
+    try:
+      osutils.WriteFile(self.path, cPickle.dumps(self._entries,
+                                                 cPickle.HIGHEST_PROTOCOL),
+                        mode='wb', atomic=True, makedirs=True)
+      self._dirty = False
+    except EnvironmentError as e:
+      logging.debug('Failed saving the ebuild metadata cache: %s', e)
+
+
+def _WalkEBuilds(directory):
+  """Find the ebuilds beneath a directory.
+
+  Returns:
+    A list of (package_dir, [(path, mtime, size), ...]) for every directory
+    holding ebuilds; symlinked ebuilds are skipped.
+  """
+  results = []
+  for package_dir, _dirs, files in os.walk(directory):
+    ebuilds = []
+    for filename in files:
+      if filename.endswith('.ebuild'):
+        path = os.path.join(package_dir, filename)
+        st = os.lstat(path)
+        if not stat.S_ISLNK(st.st_mode):
+          ebuilds.append((path, st.st_mtime, st.st_size))
+    if ebuilds:
+      results.append((package_dir, sorted(ebuilds)))
+  return results
+
+
+def _PutTaskResult(results, task, index, arg):
+  """Put (index, traceback, task(arg)) on |results|, even if |task| fails."""
+  try:
+    results.put((index, None, task(arg)))
+  except Exception:
+    results.put((index, traceback.format_exc(), None))
+
+
+def _MapInProcessPool(task, inputs, processes=None):
+  """Return [task(x) for x in inputs], computed in a pool of processes.
+
+  The results are collected while the pool is still running so that large
+  results can't fill up the result queue and stall the workers.
+
+  Raises:
+    parallel.BackgroundFailure if any of the calls failed.
+  """
+  if not inputs:
+    return []
+  results = multiprocessing.Queue()
+  output = [None] * len(inputs)
+  tracebacks = []
+  with parallel.BackgroundTaskRunner(
+      functools.partial(_PutTaskResult, results, task),
+      processes=processes) as queue:
+    for index, arg in enumerate(inputs):
+      queue.put((index, arg))
+    for _ in inputs:
+      index, tb, result = results.get()
+      if tb is not None:
+        tracebacks.append(tb)
+      output[index] = result
+  if tracebacks:
+    raise parallel.BackgroundFailure('\n' + ''.join(tracebacks))
+  return output
+
+
+def _ScanOverlays(overlays, processes):
+  """Find and read the ebuilds in the given overlays using a process pool.
+
+  The top level directories of every overlay are walked in parallel, and
+  any ebuild whose metadata isn't in the EBuildMetadataCache is then read in
+  parallel as well.
+
+  Returns:
+    A dictionary mapping each overlay to a list of (paths, metadata) tuples,
+    one per package directory.  See _FindUprevCandidates.
+  """
+  tops = []
+  for overlay in overlays:
+    for entry in sorted(os.listdir(overlay)):
+      path = os.path.join(overlay, entry)
+      if not entry.startswith('.') and os.path.isdir(path):
+        tops.append((overlay, path))
+
+  cache = EBuildMetadataCache()
+  walked = _MapInProcessPool(_WalkEBuilds, [path for _overlay, path in tops],
+                             processes)
+  metadata = {}
+  stale = []
+  for package_dirs in walked:
+    for _package_dir, ebuilds in package_dirs:
+      for path, mtime, size in ebuilds:
+        metadata[path] = cache.Get(path, mtime, size)
+        if metadata[path] is None:
+          stale.append((path, mtime, size))
+  for (path, mtime, size), result in zip(
+      stale, _MapInProcessPool(_ReadEBuildMetadata, [x[0] for x in stale],
+                               processes)):
+    metadata[path] = result
+    cache.Set(path, mtime, size, result)
+  cache.Prune(overlays, metadata)
+  cache.Save()
+
+  results = dict((overlay, []) for overlay in overlays)
+  for (overlay, _path), package_dirs in zip(tops, walked):
+    for _package_dir, ebuilds in package_dirs:
+      results[overlay].append(([x[0] for x in ebuilds], metadata))
+  return results
+
+
+def BuildEBuildDictionary(overlays, use_all, packages, processes=None):
   """Build a dictionary of the ebuilds in the specified overlays.
 
   overlays: A map which maps overlay directories to arrays of stable EBuilds
@@ -660,23 +965,203 @@ def BuildEBuildDictionary(overlays, use_all, packages):
     of whether they are in our set of packages.
   packages: A set of the packages we want to gather.  If use_all is
     True, this argument is ignored, and should be None.
+  processes: If given, scan the overlays with this many worker processes,
+    reusing cached ebuild metadata for unchanged ebuilds.
   """
+  scanned = None
+  if processes:
+    scanned = _ScanOverlays(overlays, processes)
+
   for overlay in overlays:
-    for package_dir, _dirs, files in os.walk(overlay):
-      # Add stable ebuilds to overlays[overlay].
-      paths = [os.path.join(package_dir, path) for path in files]
-      ebuild = _FindUprevCandidates(paths)
+    if scanned is not None:
+      candidates = (_FindUprevCandidates(paths, metadata=metadata)
+                    for paths, metadata in scanned[overlay])
+    else:
+      candidates = (
+          _FindUprevCandidates([os.path.join(package_dir, path)
+                                for path in files])
+          for package_dir, _dirs, files in os.walk(overlay))
 
+    for ebuild in candidates:
       # If the --all option isn't used, we only want to update packages that
       # are in packages.
       if ebuild and (use_all or ebuild.package in packages):
         overlays[overlay].append(ebuild)
 
 
-def RegenCache(overlay):
+def _ResolveRepoHead(git_repo):
+  """Returns the (commit id, tree id) of HEAD in |git_repo|, or None."""
+  reader = git.ObjectReader(git_repo)
+  try:
+    commit = reader.GetCommit('HEAD')
+  finally:
+    reader.Close()
+  if commit is None:
+    return None
+  return commit.sha1, commit.tree
+
+
+def ResolveSourceIds(ebuilds, srcroot, processes=None):
+  """Look up the HEAD commit and tree ids of the sources of many ebuilds.
+
+  The source directories of all |ebuilds| are gathered first and grouped by
+  the git checkout they live in; each checkout is then queried once, with
+  the checkouts spread over a process pool.
+
+  Args:
+    ebuilds: The workon EBuild objects that are going to be uprevved.
+    srcroot: Full path to the 'src' subdirectory in the source repository.
+    processes: Number of worker processes; defaults to the cpu count.
+
+  Returns:
+    A dictionary mapping source directories to (commit id, tree id), suitable
+    for EBuild.RevWorkOnEBuild.  Directories which could not be resolved are
+    left out.
+  """
+  repos = {}
+  for ebuild in ebuilds:
+    for srcdir in ebuild.GetSourcePath(srcroot)[1]:
+      repo = git.FindGitTopLevel(srcdir) or srcdir
+      repos.setdefault(repo, set()).add(srcdir)
+  if not repos:
+    return {}
+
+  repo_list = sorted(repos)
+  heads = _MapInProcessPool(_ResolveRepoHead, repo_list, processes)
+
+  source_ids = {}
+  for repo, head in zip(repo_list, heads):
+    if head is not None:
+      for srcdir in repos[repo]:
+        source_ids[srcdir] = head
+  return source_ids
+
+
+def _GetGitDir(tree):
+  git_dir = git.RunGit(tree, ['rev-parse', '--git-dir']).output.strip()
+  return os.path.join(tree, git_dir)
+
+
+def _GetRegenCacheStatePath(overlay):
+  return os.path.join(_GetGitDir(overlay), _REGEN_CACHE_STATE)
+
+
+def _GetWorkTreeId(tree):
+  """Returns the id of a git tree object holding the working tree of |tree|.
+
+  Modified and untracked (but not ignored) files are included.  This uses an
+  index of its own, so the real one is left alone; it is kept around so that
+  only files modified since the last call have to be hashed again.
+  """
+  git_dir = _GetGitDir(tree)
+  index = os.path.join(git_dir, _REGEN_CACHE_INDEX)
+  if not os.path.exists(index) and os.path.exists(
+      os.path.join(git_dir, 'index')):
+    shutil.copyfile(os.path.join(git_dir, 'index'), index)
+  extra_env = {'GIT_INDEX_FILE': index}
+  git.RunGit(tree, ['add', '-A', '--', '.'], extra_env=extra_env)
+  return git.RunGit(tree, ['write-tree'], extra_env=extra_env).output.strip()
+
+
+def _GetChangedFiles(tree, tree_id):
+  """Returns the files in |tree| changed since |tree_id|, or None on error.
+
+  |tree_id| is a working tree as recorded by _GetWorkTreeId.  Comparing
+  trees rather than commits means uncommitted changes are accounted for, and
+  that history being rewritten (e.g. unpushed commits being rebased by a
+  sync) doesn't matter.  If |tree_id| is no longer around, None is returned.
+  """
+  if not tree_id:
+    return None
+  result = git.RunGit(tree, ['diff', '--name-only', '--no-renames', tree_id,
+                             _GetWorkTreeId(tree), '--'], error_code_ok=True)
+  if result.returncode:
+    return None
+  return result.output.splitlines()
+
+
+def _FindEclassUsers(overlay, eclasses):
+  """Returns the packages whose md5-cache entry inherits any of |eclasses|.
+
+  The cache lists every eclass an ebuild inherits, directly or not.
+  """
+  users = set()
+  cache_dir = os.path.join(overlay, 'metadata', 'md5-cache')
+  for category in os.listdir(cache_dir) if os.path.isdir(cache_dir) else ():
+    category_dir = os.path.join(cache_dir, category)
+    for pv in os.listdir(category_dir):
+      with open(os.path.join(category_dir, pv)) as f:
+        for line in f:
+          if line.startswith('_eclasses_='):
+            inherited = line.rstrip('\n').split('=', 1)[1].split('\t')[::2]
+            pv_info = SplitPV(pv)
+            if pv_info and eclasses.intersection(inherited):
+              users.add('%s/%s' % (category, pv_info.package))
+            break
+  return users
+
+
+def _GetRegenCacheAtoms(overlay, eclass_overlays, state):
+  """Work out which packages need their md5-cache regenerated.
+
+  Args:
+    overlay: The overlay whose cache is being regenerated.
+    eclass_overlays: The overlays |overlay| may inherit eclasses from,
+      including itself.
+    state: The working trees the cache was last regenerated from, keyed by
+      overlay, as returned by _GetWorkTreeId.
+
+  Returns:
+    The set of packages to regenerate, or None if everything must be.
+  """
+  atoms = set()
+  eclasses = set()
+  for tree in eclass_overlays:
+    changed = _GetChangedFiles(tree, state.get(tree))
+    if changed is None:
+      return None
+    for path in changed:
+      parts = path.split('/')
+      if parts[0] == 'eclass':
+        if path.endswith('.eclass'):
+          eclasses.add(os.path.basename(path)[:-len('.eclass')])
+      elif tree != overlay:
+        continue
+      elif path in _REGEN_CACHE_GLOBAL_FILES:
+        # Masters or categories changed; nothing can be assumed.
+        return None
+      elif parts[:2] == ['metadata', 'md5-cache']:
+        # Someone else changed an entry since we generated it; regenerate it,
+        # or drop it if its ebuild is gone.
+        pv_info = SplitPV(parts[-1]) if len(parts) == 4 else None
+        if pv_info is None:
+          return None
+        if os.path.exists(os.path.join(overlay, parts[2], pv_info.package,
+                                       parts[3] + '.ebuild')):
+          atoms.add('%s/%s' % (parts[2], pv_info.package))
+        else:
+          osutils.SafeUnlink(os.path.join(overlay, path))
+      elif len(parts) == 3 and path.endswith('.ebuild'):
+        if os.path.exists(os.path.join(overlay, path)):
+          atoms.add('/'.join(parts[:2]))
+        else:
+          osutils.SafeUnlink(os.path.join(
+              overlay, 'metadata', 'md5-cache', parts[0],
+              parts[2][:-len('.ebuild')]))
+  if eclasses:
+    atoms.update(_FindEclassUsers(overlay, eclasses))
+  return atoms
+
+
+def RegenCache(overlay, incremental=False, overlays=()):
   """Regenerate the cache of the specified overlay.
 
   overlay: The tree to regenerate the cache for.
+  incremental: Only regenerate the packages whose ebuilds, or inherited
+    eclasses, changed since the last incremental run; the first run, or any
+    change to layout.conf or the categories, regenerates everything.
+  overlays: Other overlays known to the caller.  The ones listed as masters
+    in the layout.conf of |overlay| are checked for eclass changes too.
   """
   repo_name = GetOverlayName(overlay)
   if not repo_name:
@@ -687,19 +1172,39 @@ def RegenCache(overlay):
   if layout.get('cache-format') != 'md5-dict':
     return
 
-  # Regen for the whole repo.
-  cros_build_lib.RunCommand(['egencache', '--update', '--repo', repo_name,
-                             '--jobs', str(multiprocessing.cpu_count())])
+  atoms = None
+  if incremental:
+    state_path = _GetRegenCacheStatePath(overlay)
+    try:
+      state = json.loads(osutils.ReadFile(state_path))
+    except (IOError, ValueError):
+      state = {}
+    masters = GetOverlayMasters(overlay)
+    eclass_overlays = [overlay] + [x for x in overlays if x != overlay and
+                                   GetOverlayName(x) in masters]
+    atoms = _GetRegenCacheAtoms(overlay, eclass_overlays, state)
+
+  cmd = ['egencache', '--update', '--repo', repo_name,
+         '--jobs', str(multiprocessing.cpu_count())]
+  if atoms is None:
+    # Regen for the whole repo.
+    cros_build_lib.RunCommand(cmd)
+  elif atoms:
+    cros_build_lib.RunCommand(cmd + sorted(atoms))
+
   # If there was nothing new generated, then let's just bail.
   result = cros_build_lib.RunCommand(['git', 'status', '-s', 'metadata/'],
                                      cwd=overlay, redirect_stdout=True)
-  if not result.output:
-    return
-  # Explicitly add any new files to the index.
-  cros_build_lib.RunCommand(['git', 'add', 'metadata/'], cwd=overlay)
-  # Explicitly tell git to also include rm-ed files.
-  cros_build_lib.RunCommand(['git', 'commit', '-m', 'regen cache',
-                             'metadata/'], cwd=overlay)
+  if result.output:
+    # Explicitly add any new files to the index.
+    cros_build_lib.RunCommand(['git', 'add', 'metadata/'], cwd=overlay)
+    # Explicitly tell git to also include rm-ed files.
+    cros_build_lib.RunCommand(['git', 'commit', '-m', 'regen cache',
+                               'metadata/'], cwd=overlay)
+
+  if incremental:
+    state = dict((tree, _GetWorkTreeId(tree)) for tree in eclass_overlays)
+    osutils.WriteFile(state_path, json.dumps(state), atomic=True)
 
 
 def ParseBashArray(value):
@@ -710,7 +1215,7 @@ def ParseBashArray(value):
   # Because %s may contain bash comments (#), put a clever newline in the way.
   cmd = 'ARR=%s\nIFS=%s; echo -n "${ARR[*]}"' % (value, sep)
   return cros_build_lib.RunCommandCaptureOutput(
-      cmd, print_cmd=False, shell=True).output.split(sep)
+      cmd, print_cmd=False, shell=True, use_pipes=True).output.split(sep)
 
 
 def GetWorkonProjectMap(overlay, subdirectories):
@@ -728,7 +1233,7 @@ def GetWorkonProjectMap(overlay, subdirectories):
   cmd = ['grep', '^CROS_WORKON_PROJECT=', '--include', '*-9999.ebuild',
          '-Hsr'] + list(subdirectories)
   result = cros_build_lib.RunCommandCaptureOutput(
-      cmd, cwd=overlay, error_code_ok=True, print_cmd=False)
+      cmd, cwd=overlay, error_code_ok=True, print_cmd=False, use_pipes=True)
   for grep_line in result.output.splitlines():
     filename, _, line = grep_line.partition(':')
     value = line.partition('=')[2]
@@ -752,32 +1257,129 @@ def SplitEbuildPath(path):
   return os.path.splitext(path)[0].rsplit('/', 3)[-3:]
 
 
+def GetVersionKey(version):
+  """Returns a key for sorting |version| the way Portage compares versions.
+
+  Args:
+    version: A $PVR version, e.g. 1.2.3_rc1-r5.
+
+  Returns:
+    A tuple; comparing the tuples of two versions gives the same result as
+    portage.versions.vercmp.  None if |version| isn't valid.
+  """
+  key = _version_key_cache.get(version)
+  if key is None and version not in _version_key_cache:
+    m = _version_re.match(version)
+    if m is not None:
+      numbers, letter, suffixes, rev = m.groups()
+      numbers = numbers.split('.')
+      # Past the first, components with a leading zero compare as strings
+      # with trailing zeros stripped, and sort before those without.
+      components = [(1, int(numbers[0]), '')]
+      for number in numbers[1:]:
+        if number.startswith('0'):
+          components.append((0, 0, number.rstrip('0')))
+        else:
+          components.append((1, int(number), ''))
+      suffix_key = [(_SUFFIX_ORDER[name], int(num or 0))
+                    for name, num in _suffix_re.findall(suffixes)]
+      suffix_key.append((_SUFFIX_ORDER[''], 0))
+      key = (tuple(components), letter, tuple(suffix_key), int(rev or 0))
+    _version_key_cache[version] = key
+  return key
+
+
 def SplitPV(pv):
   """Takes a PV value and splits it into individual components.
 
+  The result is cached, so the same object is returned for the same |pv|.
+
   Returns:
     A collection with named members:
       pv, package, version, version_no_rev, rev
   """
-  m = _pvr_re.match(pv)
-  if m is None:
-    return None
-  return PV(**m.groupdict())
+  try:
+    return _pv_cache[pv]
+  except KeyError:
+    m = _pvr_re.match(pv)
+    result = _pv_cache[pv] = None if m is None else PV(**m.groupdict())
+    return result
 
 
 def SplitCPV(cpv):
   """Splits a CPV value into components.
 
+  The result is cached, so the same object is returned for the same |cpv|.
+
   Returns:
     A collection with named members:
       category, pv, package, version, version_no_rev, rev
   """
-  (category, pv) = cpv.split('/', 1)
-  m = SplitPV(pv)
-  if m is None:
-    return None
-  # pylint: disable=W0212
-  return CPV(category=category, **m._asdict())
+  try:
+    return _cpv_cache[cpv]
+  except KeyError:
+    (category, pv) = cpv.split('/', 1)
+    m = SplitPV(pv)
+    # pylint: disable=W0212
+    result = _cpv_cache[cpv] = (
+        None if m is None else CPV(category=category, **m._asdict()))
+    return result
+
+
+class CPVIndex(object):
+  """A set of CPVs, indexed by package.
+
+  Every CPV is parsed once; versions of a package are kept sorted with the
+  newest last.
+  """
+
+  __slots__ = ('_packages',)
+
+  def __init__(self, cpvs=()):
+    self._packages = {}
+    for cpv in cpvs:
+      self.Add(cpv)
+
+  def Add(self, cpv):
+    """Add the CPV string |cpv|.
+
+    Returns:
+      The CPV object for |cpv|, or None if it is not a valid CPV.
+    """
+    split_cpv = SplitCPV(cpv) if '/' in cpv else None
+    if split_cpv is not None:
+      versions = self._packages.setdefault(split_cpv.cp, [])
+      if split_cpv not in versions:
+        versions.append(split_cpv)
+        versions.sort(key=lambda x: x.version_key)
+    return split_cpv
+
+  def GetVersions(self, cp):
+    """Returns the CPVs of package |cp|, oldest first."""
+    return list(self._packages.get(cp, ()))
+
+  def GetBest(self, cp):
+    """Returns the newest CPV of package |cp|, or None."""
+    versions = self._packages.get(cp)
+    return versions[-1] if versions else None
+
+  def GetPackages(self, category=None):
+    """Returns the sorted packages in the index, optionally in |category|."""
+    return sorted(cp for cp in self._packages
+                  if category is None or cp.split('/', 1)[0] == category)
+
+  def __contains__(self, cpv):
+    split_cpv = SplitCPV(cpv) if '/' in cpv else None
+    return (split_cpv is not None and
+            split_cpv in self._packages.get(split_cpv.cp, ()))
+
+  def __iter__(self):
+    for cp in sorted(self._packages):
+      for cpv in self._packages[cp]:
+        yield cpv
+
+  def __len__(self):
+    return sum(len(x) for x in self._packages.itervalues())
 
 
 def FindWorkonProjects(packages):
@@ -819,20 +1421,155 @@ def ListInstalledPackages(sysroot):
   return packages
 
 
+# Fed to python on stdin by PortageResolver, with the atoms to resolve as
+# arguments; passing it via -c doesn't survive the re-quoting done when
+# entering the chroot.  All atoms are resolved in a single Portage session;
+# for each one, a line of the form "atom<TAB>cpv<TAB>ebuild path" is printed,
+# with empty fields if nothing visible matched.  Like equery, a bare cpv is
+# taken to mean that version.  Portage errors (e.g. invalid atoms, broken
+# configs) are not caught, failing the whole command.
+_RESOLVE_ATOMS_SCRIPT = r"""
+import sys
+import portage
+portdb = portage.db[portage.root]['porttree'].dbapi
+for atom in sys.argv[1:]:
+  query = atom
+  if not portage.isvalidatom(atom) and portage.isvalidatom('=' + atom):
+    query = '=' + atom
+  cpv = portdb.xmatch('bestmatch-visible', query)
+  path = cpv and portdb.findname(cpv) or ''
+  sys.stdout.write('%s\t%s\t%s\n' % (atom, cpv, path))
+"""
+
+
+class PortageResolver(object):
+  """Resolves atoms to their best visible ebuilds, many at a time.
+
+  Each batch of atoms costs one Portage startup rather than a portageq or
+  equery process per atom, and results are remembered for as long as the
+  overlays stay at the same commit with the same index.
+  """
+
+  _instance_cache = {}
+
+  def __init__(self, board=None, buildroot=constants.SOURCE_ROOT,
+               extra_env=None, overlays=None):
+    """Initialize.
+
+    Args:
+      board: Board to look at. By default, look in chroot.
+      buildroot: Source root to run from.
+      extra_env: Extra environment for Portage, e.g. ACCEPT_KEYWORDS.
+      overlays: The overlays whose changes invalidate remembered results.
+        Defaults to all overlays of |board|.
+    """
+    self.board = board
+    self.buildroot = buildroot
+    self.env = {}
+    if board is not None:
+      # These are normally set up by the portageq-${BOARD} wrappers.
+      sysroot = '/build/%s' % board
+      for var in ('ROOT', 'PORTAGE_CONFIGROOT', 'PORTAGE_SYSROOT', 'SYSROOT'):
+        self.env[var] = sysroot
+    if extra_env:
+      self.env.update(extra_env)
+    if overlays is None:
+      overlays = FindOverlays(constants.BOTH_OVERLAYS, board, buildroot)
+    self.overlays = list(overlays)
+    self._results = {}
+
+  @classmethod
+  def Cached(cls, board=None, buildroot=constants.SOURCE_ROOT,
+             extra_env=None, overlays=None):
+    """Return a resolver for these arguments, creating it if necessary."""
+    key = (board, buildroot, tuple(sorted((extra_env or {}).items())),
+           None if overlays is None else tuple(overlays))
+    obj = cls._instance_cache.get(key)
+    if obj is None:
+      obj = cls._instance_cache[key] = cls(board=board, buildroot=buildroot,
+                                           extra_env=extra_env,
+                                           overlays=overlays)
+    return obj
+
+  # Files git rewrites or appends to whenever HEAD moves or the index changes.
+  _GIT_STATE_FILES = ('HEAD', 'index', os.path.join('logs', 'HEAD'))
+
+  def _GetOverlayState(self):
+    """Returns a value that changes whenever an overlay is modified via git.
+
+    This is checked on every Resolve, so rather than running git, only the
+    files git updates when committing or checking out are stat'd.
+    """
+    state = []
+    for overlay in self.overlays:
+      for name in self._GIT_STATE_FILES:
+        try:
+          st = os.stat(os.path.join(overlay, '.git', name))
+        except OSError:
+          state.append(None)
+        else:
+          state.append((st.st_mtime, st.st_size, st.st_ino))
+    return tuple(state)
+
+  def Resolve(self, atoms):
+    """Resolve |atoms| to their best visible ebuilds.
+
+    Returns:
+      A dictionary mapping each atom to a (cpv, ebuild path) tuple; both are
+      None if no visible ebuild matches the atom.
+
+    Raises:
+      cros_build_lib.RunCommandError if Portage failed to resolve the atoms.
+    """
+    state = self._GetOverlayState()
+    results = {}
+    missing = []
+    for atom in atoms:
+      if (state, atom) in self._results:
+        results[atom] = self._results[(state, atom)]
+      elif atom not in missing:
+        missing.append(atom)
+
+    if missing:
+      cmd = ['python', '-'] + missing
+      result = cros_build_lib.RunCommandCaptureOutput(
+          cmd, input=_RESOLVE_ATOMS_SCRIPT, cwd=self.buildroot,
+          extra_env=self.env,
+          enter_chroot=not cros_build_lib.IsInsideChroot(),
+          debug_level=logging.DEBUG)
+      for line in result.output.splitlines():
+        fields = line.split('\t')
+        if len(fields) == 3 and fields[0] in missing:
+          atom, cpv, path = fields
+          self._results[(state, atom)] = (cpv or None, path or None)
+      for atom in missing:
+        results[atom] = self._results.setdefault((state, atom), (None, None))
+    return results
+
+
+def BestVisibleMany(atoms, board=None, buildroot=constants.SOURCE_ROOT):
+  """Get the best visible ebuild CPVs for many atoms at once.
+
+  See BestVisible; the atoms are all resolved in one Portage session.
+
+  Returns:
+    A dictionary mapping each atom to a CPV object, or None if nothing
+    visible matches it.
+  """
+  resolver = PortageResolver.Cached(board=board, buildroot=buildroot)
+  return dict((atom, SplitCPV(cpv) if cpv else None)
+              for atom, (cpv, _path) in resolver.Resolve(atoms).iteritems())
+
+
 def BestVisible(atom, board=None, buildroot=constants.SOURCE_ROOT):
   """Get the best visible ebuild CPV for the given atom.
 
   Args:
     atom: Portage atom.
     board: Board to look at. By default, look in chroot.
-    root: Directory
+    buildroot: Source root to run from.
 
   Returns:
-    A CPV object.
+    A CPV object, or None if nothing visible matches the atom.
   """
-  portageq = 'portageq' if board is None else 'portageq-%s' % board
-  root = '/' if board is None else '/build/%s' % board
-  cmd = [portageq, 'best_visible', root, 'ebuild', atom]
-  result = cros_build_lib.RunCommandCaptureOutput(
-      cmd, cwd=buildroot, enter_chroot=True, debug_level=logging.DEBUG)
-  return SplitCPV(result.output.strip())
+  return BestVisibleMany([atom], board=board, buildroot=buildroot)[atom]
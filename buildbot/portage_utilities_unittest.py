@@ -17,7 +17,9 @@ if __name__ == '__main__':
 
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
+from chromite.lib import git
 from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.buildbot import portage_utilities
 
 # pylint: disable=W0212,E1120
@@ -98,7 +100,8 @@ class EBuildTest(cros_test_lib.MoxTestCase):
     cros_build_lib.RunCommandCaptureOutput(
         mox.IgnoreArg(),
         cwd=mox.IgnoreArg(),
-        print_cmd=portage_utilities.EBuild.VERBOSE).AndReturn(result)
+        print_cmd=portage_utilities.EBuild.VERBOSE,
+        use_pipes=True).AndReturn(result)
 
     self.mox.ReplayAll()
     test_hash = fake_ebuild.GetCommitId(fake_sources)
@@ -413,6 +416,259 @@ class EBuildRevWorkonTest(cros_test_lib.MoxTempDirTestCase):
     self.assertTrue(portage_utilities.EBuild.GitRepoHasChanges(self.tempdir))
 
 
+class ResolveSourceIdsTest(cros_test_lib.MoxTempDirTestCase):
+
+  def _MakeRepo(self, name):
+    path = os.path.join(self.tempdir, name)
+    osutils.WriteFile(os.path.join(path, 'sub', 'file'), name, makedirs=True)
+    git.RunGit(self.tempdir, ['init', '-q', path])
+    git.RunGit(path, ['add', '-A'])
+    git.RunGit(path, ['commit', '-q', '-m', 'initial'])
+    return path
+
+  def _GetHead(self, path):
+    return tuple(git.RunGit(path, ['rev-parse', 'HEAD', 'HEAD^{tree}'])
+                 .output.split())
+
+  def testResolveSourceIds(self):
+    """Verify every source dir gets the HEAD ids of its checkout."""
+    repo1 = self._MakeRepo('repo1')
+    repo2 = self._MakeRepo('repo2')
+    sub1 = os.path.join(repo1, 'sub')
+    ebuild1 = StubEBuild('/overlay/cat/foo/foo-0.0.1-r1.ebuild')
+    ebuild2 = StubEBuild('/overlay/cat/bar/bar-0.0.1-r1.ebuild')
+    self.mox.StubOutWithMock(portage_utilities.EBuild, 'GetSourcePath')
+    portage_utilities.EBuild.GetSourcePath('/sources').AndReturn(
+        (['p1', 'p2'], [repo1, repo2]))
+    portage_utilities.EBuild.GetSourcePath('/sources').AndReturn(
+        (['p1'], [sub1]))
+    self.mox.ReplayAll()
+    source_ids = portage_utilities.ResolveSourceIds(
+        [ebuild1, ebuild2], '/sources', processes=2)
+    self.mox.VerifyAll()
+    self.assertEqual(source_ids, {
+        repo1: self._GetHead(repo1),
+        sub1: self._GetHead(repo1),
+        repo2: self._GetHead(repo2),
+    })
+
+
+class RegenCacheTest(cros_test_lib.TempDirTestCase):
+
+  def setUp(self):
+    self.overlay = os.path.join(self.tempdir, 'overlay')
+    self._Write('profiles/repo_name', 'test')
+    self._Write('metadata/layout.conf', 'cache-format = md5-dict\n')
+    self._Write('eclass/foo.eclass', '')
+    self._Write('cat/a/a-1.ebuild', 'inherit foo\n')
+    self._Write('cat/b/b-1.ebuild', '')
+    self._Write('metadata/md5-cache/cat/a-1', '_eclasses_=foo\tabc\n')
+    self._Write('metadata/md5-cache/cat/b-1', 'EAPI=4\n')
+    git.RunGit(self.tempdir, ['init', '-q', self.overlay])
+    self._Commit()
+    self._SaveState()
+
+  def _Write(self, path, content):
+    osutils.WriteFile(os.path.join(self.overlay, path), content,
+                      makedirs=True)
+
+  def _Commit(self, *args):
+    git.RunGit(self.overlay, ['add', '-A'])
+    git.RunGit(self.overlay, ['-c', 'user.name=a', '-c', 'user.email=a@b',
+                              'commit', '-q', '-m', 'update'] + list(args))
+
+  def _SaveState(self):
+    self.state = {
+        self.overlay: portage_utilities._GetWorkTreeId(self.overlay)}
+
+  def _GetAtoms(self):
+    return portage_utilities._GetRegenCacheAtoms(
+        self.overlay, [self.overlay], self.state)
+
+  def testNothingChanged(self):
+    self.assertEqual(self._GetAtoms(), set())
+
+  def testChangedEbuildsAndEclasses(self):
+    """Verify changed ebuilds and users of changed eclasses are regenerated."""
+    self._Write('eclass/foo.eclass', 'changed')
+    self._Write('cat/c/c-1.ebuild', '')
+    self._Commit()
+    os.unlink(os.path.join(self.overlay, 'cat/b/b-1.ebuild'))
+    self.assertEqual(self._GetAtoms(), set(['cat/a', 'cat/c']))
+    self.assertFalse(os.path.exists(
+        os.path.join(self.overlay, 'metadata/md5-cache/cat/b-1')))
+
+  def testFullRegen(self):
+    """Verify a full regeneration is done when nothing can be assumed."""
+    self.assertEqual(portage_utilities._GetRegenCacheAtoms(
+        self.overlay, [self.overlay], {}), None)
+    self.assertEqual(portage_utilities._GetRegenCacheAtoms(
+        self.overlay, [self.overlay], {self.overlay: '1' * 40}), None)
+    self._Write('metadata/layout.conf', 'cache-format = md5-dict\nfoo = 1\n')
+    self.assertEqual(self._GetAtoms(), None)
+
+  def testUntrackedEbuilds(self):
+    """Verify new ebuilds not yet known to git are regenerated."""
+    self._Write('cat/c/c-1.ebuild', '')
+    self.assertEqual(self._GetAtoms(), set(['cat/c']))
+
+  def testUncommittedChanges(self):
+    """Verify uncommitted changes are recorded as part of the state."""
+    self._Write('cat/b/b-1.ebuild', 'EAPI=5\n')
+    self._SaveState()
+    self.assertEqual(self._GetAtoms(), set())
+    git.RunGit(self.overlay, ['checkout', '--', 'cat/b/b-1.ebuild'])
+    self.assertEqual(self._GetAtoms(), set(['cat/b']))
+
+  def testRewrittenHistory(self):
+    """Verify rewritten commits only regenerate what actually changed."""
+    self._Write('metadata/md5-cache/cat/b-1', 'EAPI=5\n')
+    self._Commit()
+    self._SaveState()
+    self._Commit('--amend', '--allow-empty', '-m', 'reworded')
+    self.assertEqual(self._GetAtoms(), set())
+    git.RunGit(self.overlay, ['reset', '-q', '--hard', 'HEAD^'])
+    self.assertEqual(self._GetAtoms(), set(['cat/b']))
+
+  def testChangedCacheEntries(self):
+    """Verify cache entries changed by others are regenerated or dropped."""
+    self._Write('metadata/md5-cache/cat/b-1', 'EAPI=3\n')
+    self._Write('metadata/md5-cache/cat/d-1', 'EAPI=3\n')
+    self.assertEqual(self._GetAtoms(), set(['cat/b']))
+    self.assertFalse(os.path.exists(
+        os.path.join(self.overlay, 'metadata/md5-cache/cat/d-1')))
+
+
+class SortOverlaysTest(cros_test_lib.TempDirTestCase):
+
+  def _MakeOverlay(self, name, masters=()):
+    overlay = os.path.join(self.tempdir, name)
+    osutils.WriteFile(os.path.join(overlay, 'profiles', 'repo_name'), name,
+                      makedirs=True)
+    osutils.WriteFile(os.path.join(overlay, 'metadata', 'layout.conf'),
+                      'masters = %s\n' % ' '.join(masters), makedirs=True)
+    return overlay
+
+  def testDependencyOrder(self):
+    """Verify masters come first, with ties broken by the key."""
+    stable = self._MakeOverlay('portage-stable')
+    coreos = self._MakeOverlay('coreos', ['portage-stable'])
+    board = self._MakeOverlay('board', ['portage-stable', 'coreos', 'gone'])
+    other = self._MakeOverlay('other', ['portage-stable'])
+    overlays = [board, other, coreos, stable]
+    self.assertEqual(portage_utilities.SortOverlaysByDependency(overlays),
+                     [stable, coreos, board, other])
+    key = lambda x: (x != other, x)
+    self.assertEqual(
+        portage_utilities.SortOverlaysByDependency(overlays, key=key),
+        [stable, other, coreos, board])
+
+  def testCycle(self):
+    """Verify overlays in a cycle are still all returned."""
+    first = self._MakeOverlay('first', ['second'])
+    second = self._MakeOverlay('second', ['first'])
+    third = self._MakeOverlay('third')
+    self.assertEqual(
+        portage_utilities.SortOverlaysByDependency([second, first, third]),
+        [third, first, second])
+
+
+class PortageResolverTest(cros_test_lib.MoxTestCase):
+
+  def _ExpectResolve(self, atoms, output):
+    cros_build_lib.RunCommandCaptureOutput(
+        ['python', '-'] + atoms, input=portage_utilities._RESOLVE_ATOMS_SCRIPT,
+        cwd='/buildroot', extra_env=mox.IgnoreArg(), enter_chroot=True,
+        debug_level=mox.IgnoreArg()).AndReturn(
+            cros_build_lib.CommandResult(output=output))
+
+  def testBatchedAndMemoized(self):
+    """Verify atoms are resolved in one go, and only once."""
+    self.mox.StubOutWithMock(cros_build_lib, 'IsInsideChroot')
+    self.mox.StubOutWithMock(cros_build_lib, 'RunCommandCaptureOutput')
+    cros_build_lib.IsInsideChroot().MultipleTimes().AndReturn(False)
+    self._ExpectResolve(['cat/a', 'cat/b'],
+                        'some noise\n'
+                        'cat/a\tcat/a-1\t/o/cat/a/a-1.ebuild\n'
+                        'cat/b\t\t\n')
+    self._ExpectResolve(['cat/c'], 'cat/c\tcat/c-2\t/o/cat/c/c-2.ebuild\n')
+    self.mox.ReplayAll()
+    resolver = portage_utilities.PortageResolver(
+        board='board', buildroot='/buildroot', overlays=[])
+    self.assertEqual(resolver.env['ROOT'], '/build/board')
+    self.assertEqual(resolver.Resolve(['cat/a', 'cat/b', 'cat/a']), {
+        'cat/a': ('cat/a-1', '/o/cat/a/a-1.ebuild'),
+        'cat/b': (None, None),
+    })
+    self.assertEqual(resolver.Resolve(['cat/c', 'cat/a']), {
+        'cat/a': ('cat/a-1', '/o/cat/a/a-1.ebuild'),
+        'cat/c': ('cat/c-2', '/o/cat/c/c-2.ebuild'),
+    })
+    self.mox.VerifyAll()
+
+
+class PortageResolverStateTest(cros_test_lib.MoxTempDirTestCase):
+
+  def testOverlayCommit(self):
+    """Verify committing to an overlay forgets the remembered results."""
+    overlay = os.path.join(self.tempdir, 'overlay')
+    osutils.WriteFile(os.path.join(overlay, 'file'), 'a', makedirs=True)
+    git.RunGit(self.tempdir, ['init', '-q', overlay])
+    git.RunGit(overlay, ['add', 'file'])
+    git.RunGit(overlay, ['-c', 'user.name=a', '-c', 'user.email=a@b',
+                         'commit', '-q', '-m', 'initial'])
+    resolver = portage_utilities.PortageResolver(overlays=[overlay])
+    state = resolver._GetOverlayState()
+    self.assertEqual(resolver._GetOverlayState(), state)
+    osutils.WriteFile(os.path.join(overlay, 'file'), 'b')
+    git.RunGit(overlay, ['-c', 'user.name=a', '-c', 'user.email=a@b',
+                         'commit', '-q', '-a', '-m', 'update'])
+    self.assertNotEqual(resolver._GetOverlayState(), state)
+
+
+class PortageResolverScriptTest(cros_test_lib.MoxTempDirTestCase):
+  """Runs the resolver script itself, against a fake portage module."""
+
+  _FAKE_PORTAGE = """
+root = '/'
+class _PortDB(object):
+  def xmatch(self, level, query):
+    if query == 'bad/atom':
+      raise ValueError('broken overlay')
+    return {'cat/a': 'cat/a-1', '=cat/b-2': 'cat/b-2'}.get(query, '')
+  def findname(self, cpv):
+    return '/o/%s.ebuild' % cpv
+class _PortTree(object):
+  dbapi = _PortDB()
+db = {'/': {'porttree': _PortTree()}}
+def isvalidatom(atom):
+  return atom != 'cat/b-2'
+"""
+
+  def setUp(self):
+    osutils.WriteFile(os.path.join(self.tempdir, 'portage.py'),
+                      self._FAKE_PORTAGE)
+    self.mox.StubOutWithMock(cros_build_lib, 'IsInsideChroot')
+    cros_build_lib.IsInsideChroot().MultipleTimes().AndReturn(True)
+    self.mox.ReplayAll()
+    self.resolver = portage_utilities.PortageResolver(
+        buildroot=self.tempdir, extra_env={'PYTHONPATH': self.tempdir},
+        overlays=[])
+
+  def testResolve(self):
+    """Verify atoms and bare cpvs are resolved, and misses reported."""
+    self.assertEqual(self.resolver.Resolve(['cat/a', 'cat/b-2', 'cat/c']), {
+        'cat/a': ('cat/a-1', '/o/cat/a-1.ebuild'),
+        'cat/b-2': ('cat/b-2', '/o/cat/b-2.ebuild'),
+        'cat/c': (None, None),
+    })
+
+  def testPortageError(self):
+    """Verify a Portage failure isn't mistaken for a missing ebuild."""
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      self.resolver.Resolve, ['cat/a', 'bad/atom'])
+
+
 class FindOverlaysTest(cros_test_lib.MoxTestCase):
   FAKE, MARIO = 'fake-board', 'x86-mario'
   PRIVATE = constants.PRIVATE_OVERLAYS
@@ -534,6 +790,88 @@ class BuildEBuildDictionaryTest(cros_test_lib.MoxTestCase):
     self.mox.VerifyAll()
 
 
+class ParallelBuildEBuildDictionaryTest(cros_test_lib.TempDirTestCase):
+
+  _WORKON = 'inherit cros-workon\nKEYWORDS="%s"\n'
+
+  def setUp(self):
+    self.overlay = os.path.join(self.tempdir, 'overlay')
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+    pkg = os.path.join(self.overlay, 'chromeos-base', 'foo')
+    osutils.WriteFile(os.path.join(pkg, 'foo-9999.ebuild'),
+                      self._WORKON % '~*', makedirs=True)
+    osutils.WriteFile(os.path.join(pkg, 'foo-0.0.1-r3.ebuild'),
+                      self._WORKON % '*')
+    osutils.WriteFile(
+        os.path.join(self.overlay, 'sys-apps', 'bar', 'bar-1.0.ebuild'),
+        'KEYWORDS="*"\n', makedirs=True)
+    self._old_env = os.environ.get(constants.SHARED_CACHE_ENVVAR)
+    os.environ[constants.SHARED_CACHE_ENVVAR] = self.cache_dir
+
+  def tearDown(self):
+    if self._old_env is None:
+      os.environ.pop(constants.SHARED_CACHE_ENVVAR, None)
+    else:
+      os.environ[constants.SHARED_CACHE_ENVVAR] = self._old_env
+
+  def _Build(self):
+    overlays = {self.overlay: []}
+    portage_utilities.BuildEBuildDictionary(overlays, True, None, processes=2)
+    return [x.ebuild_path for x in overlays[self.overlay]]
+
+  def testParallelScan(self):
+    """Verify the parallel scan matches, and reuses cached metadata."""
+    expected = [os.path.join(self.overlay, 'chromeos-base', 'foo',
+                             'foo-0.0.1-r3.ebuild')]
+    overlays = {self.overlay: []}
+    portage_utilities.BuildEBuildDictionary(overlays, True, None)
+    self.assertEqual([x.ebuild_path for x in overlays[self.overlay]],
+                     expected)
+    self.assertEqual(self._Build(), expected)
+
+    # Nothing changed, so nothing should be read again.
+    original = portage_utilities._ReadEBuildMetadata
+    try:
+      portage_utilities._ReadEBuildMetadata = None
+      self.assertEqual(self._Build(), expected)
+    finally:
+      portage_utilities._ReadEBuildMetadata = original
+
+    # Changing an ebuild invalidates its entry; with the stable ebuild no
+    # longer being cros-workon, the unstable one is the candidate.
+    osutils.WriteFile(expected[0], 'KEYWORDS="*"\n')
+    self.assertEqual(self._Build(), [expected[0].replace('0.0.1-r3', '9999')])
+
+  def testReadFailure(self):
+    """Verify failures in the worker processes are propagated."""
+    def _Fail(path):
+      raise ValueError(path)
+    original = portage_utilities._ReadEBuildMetadata
+    try:
+      portage_utilities._ReadEBuildMetadata = _Fail
+      self.assertRaises(parallel.BackgroundFailure, self._Build)
+    finally:
+      portage_utilities._ReadEBuildMetadata = original
+
+  def testPruneCache(self):
+    """Verify entries of removed ebuilds are dropped from the cache."""
+    self._Build()
+    removed = os.path.join(self.overlay, 'sys-apps', 'bar', 'bar-1.0.ebuild')
+    elsewhere = os.path.join(self.tempdir, 'other', 'baz-1.0.ebuild')
+    gone = os.path.join(self.tempdir, 'gone', 'baz-1.0.ebuild')
+    osutils.WriteFile(elsewhere, '', makedirs=True)
+    cache = portage_utilities.EBuildMetadataCache()
+    cache.Set(elsewhere, 1, 1, {})
+    cache.Set(gone, 1, 1, {})
+    cache.Save()
+    os.unlink(removed)
+    self._Build()
+    cache = portage_utilities.EBuildMetadataCache()
+    self.assertEqual(sorted(cache._entries), sorted([
+        os.path.join(self.overlay, 'chromeos-base', 'foo', x)
+        for x in ('foo-0.0.1-r3.ebuild', 'foo-9999.ebuild')] + [elsewhere]))
+
+
 class ProjectMappingTest(cros_test_lib.TestCase):
 
   def testSplitEbuildPath(self):
@@ -564,6 +902,43 @@ class ProjectMappingTest(cros_test_lib.TestCase):
     for k, v in split_pv._asdict().iteritems():
       self.assertEquals(getattr(split_cpv, k), v)
 
+  def testSplitCached(self):
+    """Test that parsing the same string again returns the same object."""
+    cpv = 'foo/bar-1.0-r1'
+    self.assertTrue(portage_utilities.SplitCPV(cpv) is
+                    portage_utilities.SplitCPV(cpv))
+    self.assertTrue(portage_utilities.SplitPV('bar-1.0') is
+                    portage_utilities.SplitPV('bar-1.0'))
+    self.assertEquals(portage_utilities.SplitPV('bar'), None)
+    self.assertRaises(ValueError, portage_utilities.SplitCPV, 'bar-1.0')
+
+  def testVersionKey(self):
+    """Test that version keys sort the way Portage compares versions."""
+    versions = ['0.9', '1', '1.0_alpha', '1.0_alpha2', '1.0_beta',
+                '1.0_pre', '1.0_rc1', '1.0_rc1_p1', '1.0', '1.0-r1',
+                '1.0-r2', '1.0_p', '1.0_p1', '1.0a', '1.01', '1.010.1',
+                '1.02', '1.1', '1.2', '1.10', '2', '9999']
+    shuffled = list(reversed(versions))
+    shuffled.sort(key=portage_utilities.GetVersionKey)
+    self.assertEquals(shuffled, versions)
+    self.assertEquals(portage_utilities.GetVersionKey('1.0'),
+                      portage_utilities.GetVersionKey('1.00'))
+    self.assertEquals(portage_utilities.GetVersionKey('1.0_foo'), None)
+
+  def testCPVIndex(self):
+    """Test indexing CPVs by package."""
+    index = portage_utilities.CPVIndex(['foo/bar-1.10', 'foo/bar-1.9',
+                                        'foo/baz-1', 'cat/pkg-2', 'bad'])
+    index.Add('foo/bar-1.9')
+    self.assertEquals(len(index), 4)
+    self.assertTrue('foo/bar-1.9' in index)
+    self.assertFalse('foo/bar-1.8' in index)
+    self.assertEquals([x.pv for x in index.GetVersions('foo/bar')],
+                      ['bar-1.9', 'bar-1.10'])
+    self.assertEquals(index.GetBest('foo/bar').version, '1.10')
+    self.assertEquals(index.GetBest('foo/none'), None)
+    self.assertEquals(index.GetPackages('foo'), ['foo/bar', 'foo/baz'])
+
   def testFindWorkonProjects(self):
     """Test if we can find the list of workon projects."""
     power_manager = 'chromeos-base/power_manager'
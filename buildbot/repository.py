@@ -7,15 +7,20 @@ Repository module to handle different types of repositories the Builders use.
 """
 
 import constants
+import cStringIO
 import logging
+import multiprocessing
 import os
 import re
 import shutil
+import time
 
 from chromite.buildbot import configure_repo
 from chromite.lib import cros_build_lib
 from chromite.lib import git
+from chromite.lib import locking
 from chromite.lib import osutils
+from chromite.lib import parallel
 from chromite.lib import rewrite_git_alternates
 
 # File that marks a buildroot as being used by a trybot
@@ -135,6 +140,236 @@ def ClearBuildRoot(buildroot, preserve_paths=()):
     CreateTrybotMarker(buildroot)
 
 
+def GetMirrorRoot():
+  """Returns the directory holding the host's shared project mirrors.
+
+  Every buildroot on the host shares the same mirrors.  The directory can be
+  moved via $CROS_GIT_MIRROR_DIR; setting it to an empty value disables
+  mirroring, in which case None is returned.
+  """
+  mirror_root = os.environ.get(constants.GIT_MIRROR_ENVVAR)
+  if mirror_root is None:
+    return constants.GIT_MIRROR_DEFAULT_DIR
+  return mirror_root or None
+
+
+class ProjectMirrors(object):
+  """Host-local bare mirrors of manifest projects, shared by buildroots.
+
+  Each project is mirrored once into mirror_root/<project name>.git, holding
+  just the branches of the project.  A missing mirror is bootstrapped from
+  the checkout's git dir for the project if there is one, so creating it
+  doesn't refetch what the checkout already has.  Refreshes are serialized
+  via a lock per mirror; if a mirror was refreshed by someone else within
+  FRESHNESS seconds, it isn't fetched again.
+
+  Checkouts are then seeded from the mirrors so the subsequent network fetch
+  of repo sync only has to transfer what landed since.  The mirrored branches
+  are fetched into a namespace of their own, so the remote branches repo
+  manages are left alone.  Git dirs of projects the checkout doesn't have yet
+  are created by the seeding, the way repo would (minus repo's hooks).
+  """
+
+  # How long a refreshed mirror is considered up to date, in seconds.
+  FRESHNESS = 300
+  _STAMP = 'cros-mirror-refreshed'
+  # Only branches are mirrored; refs/changes/* et al. aren't needed to seed.
+  _REFSPEC = '+refs/heads/*:refs/heads/*'
+  # Where checkouts get the mirrored branches.
+  _SEED_REFSPEC = '+refs/heads/*:refs/cros-mirror/*'
+
+  def __init__(self, mirror_root, processes=None):
+    """Initialize this instance.
+
+    Args:
+      mirror_root: Directory to hold the mirrors in.
+      processes: Maximum number of mirrors to refresh/seed at once.  Defaults
+        to the cpu count.
+    """
+    self.mirror_root = os.path.abspath(mirror_root)
+    self.processes = processes
+
+  def GetMirrorPath(self, project):
+    """Returns the path of the bare mirror for a given project name."""
+    return os.path.join(self.mirror_root, '%s.git' % project)
+
+  def _GetLock(self, project):
+    path = self.GetMirrorPath(project)
+    osutils.SafeMakedirs(os.path.dirname(path))
+    return locking.FileLock('%s.lock' % path,
+                            description='mirror of %s' % project)
+
+  def _IsFresh(self, project):
+    stamp = os.path.join(self.GetMirrorPath(project), self._STAMP)
+    try:
+      return time.time() - os.stat(stamp).st_mtime < self.FRESHNESS
+    except EnvironmentError:
+      return False
+
+  def _RefreshMirror(self, project, url, git_dir, remote):
+    """Create or update the mirror of a project; failures are non fatal.
+
+    Args:
+      project: The name of the project.
+      url: The url to fetch the project from.
+      git_dir: The project's git dir in the checkout that will be seeded; if
+        it exists, a new mirror starts out with its objects.
+      remote: The name of the remote of the project in |git_dir|.
+    """
+    path = self.GetMirrorPath(project)
+    with self._GetLock(project) as lock:
+      lock.write_lock('refreshing the mirror')
+      if self._IsFresh(project):
+        return
+      try:
+        if not os.path.isdir(path):
+          tmp_path = '%s.tmp' % path
+          osutils.RmDir(tmp_path, ignore_missing=True)
+          git.RunGit(os.path.dirname(path), ['init', '-q', '--bare', tmp_path])
+          git.RunGit(tmp_path, ['remote', 'add', 'origin', url])
+          git.RunGit(tmp_path, ['config', 'remote.origin.fetch',
+                                self._REFSPEC])
+          if os.path.isdir(git_dir):
+            git.RunGit(tmp_path, ['fetch', '--no-tags', git_dir,
+                                  '+refs/remotes/%s/*:refs/heads/*' % remote])
+          os.rename(tmp_path, path)
+        git.RunGit(path, ['fetch', '--prune', '--no-tags', 'origin',
+                          self._REFSPEC])
+      except cros_build_lib.RunCommandError as e:
+        cros_build_lib.Warning('Failed refreshing the mirror of %s: %s',
+                               project, e.Stringify(error=False, output=False))
+        return
+      osutils.Touch(os.path.join(path, self._STAMP))
+
+  def _StartSeed(self, project, git_dir):
+    """Start fetching the mirrored branches of a project into a git dir.
+
+    A missing git dir is set up in a temporary dir like repo does, and only
+    put in place by _FinishSeed once it has been seeded.
+
+    Returns:
+      The BackgroundCommand of the fetch.
+    """
+    cmd = ['git', 'fetch', '--no-tags', self.GetMirrorPath(project),
+           self._SEED_REFSPEC]
+    if os.path.isdir(git_dir):
+      cmd.insert(2, '--prune')
+      cwd = git_dir
+    else:
+      cwd = '%s.tmp' % git_dir
+      osutils.RmDir(cwd, ignore_missing=True)
+      osutils.SafeMakedirs(os.path.dirname(cwd))
+      git.RunGit(os.path.dirname(cwd), ['init', '-q', '--bare', cwd])
+      git.RunGit(cwd, ['config', '--unset', 'core.bare'])
+    return cros_build_lib.StartCommand(
+        cmd, cwd=cwd, print_cmd=False, redirect_stdout=True,
+        combine_stdout_stderr=True, error_code_ok=True)
+
+  @staticmethod
+  def _FinishSeed(command, git_dir):
+    """Put a new git dir in place once seeded, or drop it if that failed."""
+    tmp_dir = '%s.tmp' % git_dir
+    if command.Result().returncode:
+      osutils.RmDir(tmp_dir)
+    else:
+      os.rename(tmp_dir, git_dir)
+
+  def _SeedProjects(self, checkouts):
+    """Fetch the mirrored branches of projects into checkouts' git dirs.
+
+    The fetches all run from this process, up to self.processes at a time.
+    Each mirror is read locked while fetches from it are running.
+
+    Args:
+      checkouts: A list of (project name, git dir) pairs.
+    """
+    limit = self.processes or multiprocessing.cpu_count()
+    pending = [x for x in reversed(checkouts)
+               if os.path.isdir(self.GetMirrorPath(x[0]))]
+    # Maps running fetches to their (project, git_dir, new git dir?), and
+    # projects to their [lock, number of running fetches].  Locks are per
+    # process, so fetches of the same project share one.
+    running, locks = {}, {}
+    try:
+      while pending or running:
+        while pending and len(running) < limit:
+          project, git_dir = pending.pop()
+          if project not in locks:
+            lock = self._GetLock(project)
+            lock.read_lock('seeding %s' % git_dir)
+            locks[project] = [lock, 0]
+          locks[project][1] += 1
+          new = not os.path.isdir(git_dir)
+          running[self._StartSeed(project, git_dir)] = (project, git_dir, new)
+        done, _ = cros_build_lib.WaitForCommands(
+            running.keys(), return_when=cros_build_lib.FIRST_COMPLETED)
+        for command in done:
+          project, git_dir, new = running.pop(command)
+          if new:
+            self._FinishSeed(command, git_dir)
+          locks[project][1] -= 1
+          if not locks[project][1]:
+            locks.pop(project)[0].close()
+    finally:
+      for command in running:
+        command.Kill()
+      for lock, _ in locks.itervalues():
+        lock.close()
+
+  @staticmethod
+  def _GetProjectUrl(manifest, attrs):
+    """Returns the fetch url for a project, or None if it can't be mirrored."""
+    fetch = manifest.remotes[attrs['remote']].get('fetch', '')
+    # Relative fetch urls depend on the manifest url; don't try to mirror
+    # those.
+    if '://' not in fetch:
+      return None
+    return '%s/%s' % (fetch.rstrip('/'), attrs['name'])
+
+  def _GetCheckouts(self, manifest, projects=()):
+    """Returns [name, url, git_dir, remote] for every checkout to mirror."""
+    inputs = []
+    for path, attrs in sorted(manifest.checkouts_by_path.iteritems()):
+      if projects and attrs['name'] not in projects:
+        continue
+      url = self._GetProjectUrl(manifest, attrs)
+      if url is not None:
+        git_dir = os.path.join(manifest.root, '.repo', 'projects',
+                               '%s.git' % path)
+        remote = manifest.remotes[attrs['remote']]['alias']
+        inputs.append([attrs['name'], url, git_dir, remote])
+    return inputs
+
+  def Refresh(self, manifest, projects=()):
+    """Bring the mirrors of the projects of a checkout up to date.
+
+    Args:
+      manifest: A git.ManifestCheckout instance for the checkout.
+      projects: If given, only refresh the mirrors of these project names.
+    """
+    # One mirror per project; bootstrap it from an existing git dir if any.
+    mirrors = {}
+    for checkout in self._GetCheckouts(manifest, projects):
+      name, git_dir = checkout[0], checkout[2]
+      if name not in mirrors or (not os.path.isdir(mirrors[name][2]) and
+                                 os.path.isdir(git_dir)):
+        mirrors[name] = checkout
+    if mirrors:
+      parallel.RunTasksInProcessPool(self._RefreshMirror,
+                                     sorted(mirrors.values()),
+                                     processes=self.processes)
+
+  def SeedCheckout(self, manifest, projects=()):
+    """Seed the project git dirs of a checkout, creating missing ones.
+
+    Args:
+      manifest: A git.ManifestCheckout instance for the checkout.
+      projects: If given, only seed these project names.
+    """
+    self._SeedProjects([(name, git_dir) for name, _, git_dir, _ in
+                        self._GetCheckouts(manifest, projects)])
+
+
 class RepoRepository(object):
   """ A Class that encapsulates a repo repository.
   Args:
@@ -146,6 +381,9 @@ class RepoRepository(object):
       default.xml if not given.
     depth: Mutually exclusive option to referenced_repo; this limits the
       checkout to a max commit history of the given integer.
+    mirror_root: If given, the directory holding the host's shared project
+      mirrors (see ProjectMirrors).  They're refreshed and used to seed the
+      checkout prior to every network sync.
   """
   DEFAULT_MANIFEST = 'default'
   # Use our own repo, in case android.kernel.org (the default location) is down.
@@ -155,7 +393,7 @@ class RepoRepository(object):
   LRU_THRESHOLD = 5
 
   def __init__(self, repo_url, directory, branch=None, referenced_repo=None,
-               manifest=None, depth=None):
+               manifest=None, depth=None, mirror_root=None):
     self.repo_url = repo_url
     self.directory = directory
     self.branch = branch
@@ -179,6 +417,9 @@ class RepoRepository(object):
                        % self.directory)
 
     self._depth = int(depth) if depth is not None else None
+    self._mirrors = None
+    if mirror_root is not None:
+      self._mirrors = ProjectMirrors(mirror_root)
 
   def _SwitchToLocalManifest(self, local_manifest):
     """Reinitializes the repository if the manifest has changed."""
@@ -297,8 +538,60 @@ class RepoRepository(object):
         ['git', 'config', '--file', self._ManifestConfig, 'repo.reference',
          self._referenced_repo])
 
+  def _SnapshotCheckout(self):
+    """Return the revision locked manifest of the current checkout.
+
+    Returns:
+      The manifest as a string, or None if the checkout doesn't exist or
+      couldn't be exported (in which case a full sync is required).
+    """
+    if not os.path.exists(os.path.join(self.directory, '.repo',
+                                       'manifest.xml')):
+      return None
+    try:
+      return self.ExportManifest()
+    except cros_build_lib.RunCommandError:
+      cros_build_lib.Warning('Failed exporting the manifest of %r; falling '
+                             'back to a full sync.', self.directory)
+      return None
+
+  def _GetChangedProjects(self, snapshot):
+    """Find the projects that must be synced to move to the new manifest.
+
+    Checkouts are matched up by path, so projects that are checked out more
+    than once are compared checkout by checkout.
+
+    Args:
+      snapshot: The revision locked manifest of the checkout as it was prior
+        to Initialize, as returned by _SnapshotCheckout.
+    Returns:
+      A sorted list of project names with a checkout whose pinned revision
+      or remote differs from what is checked out.  None if a full sync is
+      required.
+    """
+    current = git.Manifest(cStringIO.StringIO(snapshot)).checkouts_by_path
+    target = git.ManifestCheckout.Cached(
+        self.directory, search=False).checkouts_by_path
+
+    if set(current).difference(target):
+      # Checkouts were removed or moved; only a full sync cleans those up.
+      return None
+
+    changed = set()
+    for path, attrs in target.iteritems():
+      existing = current.get(path)
+      if existing is not None and existing['name'] != attrs['name']:
+        # A different project now lives at this path.
+        return None
+      # Floating revisions (branches, tags) can't be verified without going
+      # to the network, thus they always get synced.
+      if (existing is None or not git.IsSHA1(attrs['revision']) or
+          any(existing[key] != attrs[key] for key in ('revision', 'remote'))):
+        changed.add(attrs['name'])
+    return sorted(changed)
+
   def Sync(self, local_manifest=None, jobs=None, cleanup=True,
-           all_branches=False, network_only=False):
+           all_branches=False, network_only=False, incremental=False):
     """Sync/update the source.  Changes manifest if specified.
 
     Args:
@@ -317,8 +610,16 @@ class RepoRepository(object):
         if the manifest has bad copyfile statements, via skipping checkout
         the broken copyfile tag won't be spotted), or of use when the
         invoking code is fine w/ operating on bare repos, ie .repo/projects/*.
+      incremental: If true, only the projects whose pinned revision or remote
+        differs between the checkout and the new manifest are synced.  Falls
+        back to a full sync if the checkout can't be examined, or if projects
+        were removed from the manifest.
     """
     try:
+      snapshot = None
+      if incremental and not network_only:
+        snapshot = self._SnapshotCheckout()
+
       # Always re-initialize to the current branch.
       self.Initialize(local_manifest)
       # Fix existing broken mirroring configurations.
@@ -327,36 +628,23 @@ class RepoRepository(object):
       if cleanup:
         configure_repo.FixBrokenExistingRepos(self.directory)
 
-      cmd = ['repo', '--time', 'sync']
-      if jobs:
-        cmd += ['--jobs', str(jobs)]
-      if not all_branches:
-        cmd.append('-c')
-      # Do the network half of the sync; retry as necessary to get the content.
-      cros_build_lib.RunCommandWithRetries(constants.SYNC_RETRIES, cmd + ['-n'],
-                                           cwd=self.directory)
-
-      if network_only:
-        return
-
-      # Do the local sync; note that there is a couple of corner cases where
-      # the new manifest cannot transition from the old checkout cleanly-
-      # primarily involving git submodules.  Thus we intercept, and do
-      # a forced wipe, then a retry.
-      try:
-        cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
-      except cros_build_lib.RunCommandError:
-        manifest = git.ManifestCheckout.Cached(self.directory)
-        targets = set(project['path'].split('/', 1)[0]
-                      for project in manifest.projects.itervalues())
-        if not targets:
-          # No directories to wipe, thus nothing we can fix.
-          raise
-        cros_build_lib.SudoRunCommand(['rm', '-rf'] + sorted(targets),
-                                      cwd=self.directory)
-
-        # Retry the sync now; if it fails, let the exception propagate.
-        cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
+      projects = []
+      up_to_date = False
+      if snapshot is not None:
+        projects = self._GetChangedProjects(snapshot)
+        if projects is None:
+          projects = []
+        elif not projects:
+          cros_build_lib.Info('Checkout already matches the manifest; '
+                              'skipping sync.')
+          up_to_date = True
+        else:
+          cros_build_lib.Info('Incrementally syncing %i projects: %s',
+                              len(projects), ' '.join(projects))
+
+      if not up_to_date:
+        if self._RepoSync(projects, jobs, all_branches, network_only):
+          return
 
       # Setup gerrit remote for any new repositories.
       configure_repo.SetupGerritRemote(self.directory)
@@ -372,6 +660,65 @@ class RepoRepository(object):
       logging.error(err_msg)
       raise SrcCheckOutException(err_msg)
 
+  def _RepoSync(self, projects, jobs, all_branches, network_only):
+    """Run the network and local halves of repo sync.
+
+    Args:
+      projects: The projects to sync; all of them if empty.
+      jobs, all_branches, network_only: See Sync.
+
+    Returns:
+      True if only the network half was run, as requested by network_only.
+    """
+    if self._mirrors is not None:
+      self._SeedFromMirrors(projects)
+
+    cmd = ['repo', '--time', 'sync']
+    if jobs:
+      cmd += ['--jobs', str(jobs)]
+    if not all_branches:
+      cmd.append('-c')
+    # Do the network half of the sync; retry as necessary to get the content.
+    # When syncing incrementally, repo still fetches the given projects in
+    # parallel per --jobs.
+    cros_build_lib.RunCommandWithRetries(
+        constants.SYNC_RETRIES, cmd + ['-n'] + projects, cwd=self.directory)
+
+    if network_only:
+      return True
+
+    # Do the local sync; note that there is a couple of corner cases where
+    # the new manifest cannot transition from the old checkout cleanly-
+    # primarily involving git submodules.  Thus we intercept, and do
+    # a forced wipe, then a retry.
+    try:
+      cros_build_lib.RunCommand(cmd + ['-l'] + projects, cwd=self.directory)
+    except cros_build_lib.RunCommandError:
+      manifest = git.ManifestCheckout.Cached(self.directory)
+      targets = set(project['path'].split('/', 1)[0]
+                    for project in manifest.projects.itervalues())
+      if not targets:
+        # No directories to wipe, thus nothing we can fix.
+        raise
+      cros_build_lib.SudoRunCommand(['rm', '-rf'] + sorted(targets),
+                                    cwd=self.directory)
+
+      # Retry the sync now; if it fails, let the exception propagate.  Since
+      # every checkout was wiped, this has to cover all projects; the
+      # objects for the unchanged ones are already local.
+      cros_build_lib.RunCommand(cmd + ['-l'], cwd=self.directory)
+    return False
+
+  def _SeedFromMirrors(self, projects=()):
+    """Refresh the shared mirrors, and seed our projects from them.
+
+    Args:
+      projects: If given, limit the work to just these projects.
+    """
+    manifest = git.ManifestCheckout.Cached(self.directory, search=False)
+    self._mirrors.Refresh(manifest, projects=projects)
+    self._mirrors.SeedCheckout(manifest, projects=projects)
+
   def _DoCleanup(self):
     """Wipe unused repositories."""
 
@@ -4,6 +4,7 @@
 # Use of this source code is governed by a BSD-style license that can be
 # found in the LICENSE file.
 
+import cStringIO
 import functools
 import os
 import sys
@@ -13,6 +14,7 @@ sys.path.insert(0, constants.SOURCE_ROOT)
 from chromite.buildbot import repository
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
+from chromite.lib import git
 
 # pylint: disable=W0212,R0904,E1101,W0613
 class RepositoryTests(cros_test_lib.MoxTestCase):
@@ -52,6 +54,189 @@ class RepositoryTests(cros_test_lib.MoxTestCase):
       self.assertTrue(repository.IsInternalRepoCheckout('.'))
 
 
+class IncrementalSyncTests(cros_test_lib.MoxTestCase):
+  """Tests for detecting which projects an incremental sync has to touch."""
+
+  MANIFEST = """<?xml version="1.0" encoding="UTF-8"?>
+<manifest>
+  <remote name="cros" fetch="http://example.com" />
+  <default remote="cros" revision="refs/heads/master" />
+%s
+</manifest>"""
+
+  def _Manifest(self, *projects):
+    """Return a git.Manifest of the given (name, revision, path) projects."""
+    lines = ['<project name="%s" revision="%s" path="%s" />' % x
+             for x in projects]
+    return self.MANIFEST % '\n'.join(lines)
+
+  def _GetChangedProjects(self, current, target):
+    repo = repository.RepoRepository.__new__(repository.RepoRepository)
+    repo.directory = '/foon'
+    self.mox.StubOutWithMock(git.ManifestCheckout, 'Cached')
+    git.ManifestCheckout.Cached('/foon', search=False).AndReturn(
+        git.Manifest(cStringIO.StringIO(target)))
+    self.mox.ReplayAll()
+    result = repo._GetChangedProjects(current)
+    self.mox.VerifyAll()
+    self.mox.UnsetStubs()
+    self.mox.ResetAll()
+    return result
+
+  def testChangedProjects(self):
+    """Verify only changed, new, or floating projects are synced."""
+    current = self._Manifest(('a', '1' * 40, 'a'), ('b', '2' * 40, 'b'),
+                             ('d', '4' * 40, 'd'))
+    target = self._Manifest(('a', '1' * 40, 'a'), ('b', '5' * 40, 'b'),
+                            ('d', 'refs/heads/master', 'd'),
+                            ('e', '6' * 40, 'e'))
+    self.assertEqual(self._GetChangedProjects(current, target),
+                     ['b', 'd', 'e'])
+
+  def testMultipleCheckouts(self):
+    """Verify each checkout of a project is compared on its own."""
+    current = self._Manifest(('a', '1' * 40, 'a'), ('a', '2' * 40, 'a2'),
+                             ('b', '3' * 40, 'b'))
+    target = self._Manifest(('a', '1' * 40, 'a'), ('a', '4' * 40, 'a2'),
+                            ('b', '3' * 40, 'b'))
+    self.assertEqual(self._GetChangedProjects(current, target), ['a'])
+    self.assertEqual(self._GetChangedProjects(current, current), [])
+
+  def testMovedProject(self):
+    """Verify moving or replacing a checkout forces a full sync."""
+    current = self._Manifest(('a', '1' * 40, 'a'), ('c', '3' * 40, 'c'))
+    target = self._Manifest(('a', '1' * 40, 'a'), ('c', '3' * 40, 'src/c'))
+    self.assertEqual(self._GetChangedProjects(current, target), None)
+    target = self._Manifest(('a', '1' * 40, 'a'), ('d', '3' * 40, 'c'))
+    self.assertEqual(self._GetChangedProjects(current, target), None)
+
+  def testNoChanges(self):
+    """Verify an identical manifest results in nothing to sync."""
+    current = self._Manifest(('a', '1' * 40, 'a'))
+    self.assertEqual(self._GetChangedProjects(current, current), [])
+
+  def testRemovedProject(self):
+    """Verify removing a project forces a full sync."""
+    current = self._Manifest(('a', '1' * 40, 'a'), ('b', '2' * 40, 'b'))
+    target = self._Manifest(('a', '1' * 40, 'a'))
+    self.assertEqual(self._GetChangedProjects(current, target), None)
+
+  def testUpToDateStillCleansUp(self):
+    """Verify an up to date checkout skips repo sync, but not the cleanup."""
+    repo = repository.RepoRepository.__new__(repository.RepoRepository)
+    repo.directory = '/foon'
+    for method in ('_SnapshotCheckout', 'Initialize', '_EnsureMirroring',
+                   '_GetChangedProjects', '_RepoSync', '_DoCleanup'):
+      self.mox.StubOutWithMock(repository.RepoRepository, method)
+    self.mox.StubOutWithMock(repository.configure_repo,
+                             'FixBrokenExistingRepos')
+    self.mox.StubOutWithMock(repository.configure_repo, 'SetupGerritRemote')
+    repo._SnapshotCheckout().AndReturn('snapshot')
+    repo.Initialize(None)
+    repo._EnsureMirroring()
+    repository.configure_repo.FixBrokenExistingRepos('/foon')
+    repo._GetChangedProjects('snapshot').AndReturn([])
+    repository.configure_repo.SetupGerritRemote('/foon')
+    repo._EnsureMirroring(True)
+    repo._DoCleanup()
+    self.mox.ReplayAll()
+    repo.Sync(incremental=True)
+    self.mox.VerifyAll()
+
+
+class ProjectMirrorsTests(cros_test_lib.TempDirTestCase):
+  """Tests for the host-local project mirrors."""
+
+  def setUp(self):
+    self.upstream = os.path.join(self.tempdir, 'upstream', 'foo.git')
+    git.RunGit(self.tempdir, ['init', '-q', self.upstream])
+    git.RunGit(self.upstream, ['symbolic-ref', 'HEAD', 'refs/heads/master'])
+    self._Commit('first')
+    self.git_dir = os.path.join(self.tempdir, 'checkout.git')
+    git.RunGit(self.tempdir, ['init', '-q', '--bare', self.git_dir])
+    self.mirrors = repository.ProjectMirrors(
+        os.path.join(self.tempdir, 'mirrors'), processes=1)
+
+  def _Commit(self, msg):
+    git.RunGit(self.upstream, ['-c', 'user.name=a', '-c', 'user.email=a@b',
+                               'commit', '-q', '--allow-empty', '-m', msg])
+    return git.GetGitRepoRevision(self.upstream)
+
+  def _Refresh(self):
+    self.mirrors._RefreshMirror('foo', self.upstream, self.git_dir, 'cros')
+    return git.GetGitRepoRevision(self.mirrors.GetMirrorPath('foo'),
+                                  branch='refs/heads/master')
+
+  def testRefresh(self):
+    """Verify mirrors are created, and only refetched once stale."""
+    first = git.GetGitRepoRevision(self.upstream)
+    self.assertEqual(self._Refresh(), first)
+    second = self._Commit('second')
+    # Freshly refreshed; nothing is fetched.
+    self.assertEqual(self._Refresh(), first)
+    self.mirrors.FRESHNESS = 0
+    self.assertEqual(self._Refresh(), second)
+
+  def testOnlyBranches(self):
+    """Verify a mirror bootstrapped from a checkout holds only branches."""
+    first = git.GetGitRepoRevision(self.upstream)
+    git.RunGit(self.git_dir, ['fetch', '-q', self.upstream,
+                              '+refs/heads/*:refs/remotes/cros/*'])
+    git.RunGit(self.upstream, ['update-ref', 'refs/changes/01/1/1', first])
+    self._Refresh()
+    refs = git.RunGit(self.mirrors.GetMirrorPath('foo'),
+                      ['for-each-ref', '--format=%(refname)']).output.split()
+    self.assertEqual(refs, ['refs/heads/master'])
+
+  def testSeed(self):
+    """Verify a checkout's git dir is seeded, without touching its remote."""
+    rev = self._Refresh()
+    newer = self._Commit('second')
+    git.RunGit(self.git_dir, ['fetch', '-q', self.upstream,
+                              '+refs/heads/*:refs/remotes/cros/*'])
+    self.mirrors._SeedProjects([('foo', self.git_dir)])
+    self.assertEqual(git.GetGitRepoRevision(
+        self.git_dir, branch='refs/cros-mirror/master'), rev)
+    self.assertEqual(git.GetGitRepoRevision(
+        self.git_dir, branch='refs/remotes/cros/master'), newer)
+
+  def testSeedNewCheckout(self):
+    """Verify git dirs are created for projects not checked out yet."""
+    rev = self._Refresh()
+    git_dir = os.path.join(self.tempdir, 'projects', 'bar.git')
+    self.mirrors._SeedProjects([('foo', git_dir)])
+    self.assertEqual(git.GetGitRepoRevision(
+        git_dir, branch='refs/cros-mirror/master'), rev)
+    result = git.RunGit(git_dir, ['config', 'core.bare'], error_code_ok=True)
+    self.assertEqual(result.output, '')
+    self.assertFalse(os.path.exists('%s.tmp' % git_dir))
+
+  def testSeedMany(self):
+    """Verify many checkouts are seeded, more than processes at a time."""
+    rev = self._Refresh()
+    projects = os.path.join(self.tempdir, 'projects')
+    git_dirs = [os.path.join(projects, '%s.git' % x) for x in 'abc']
+    checkouts = [('foo', x) for x in git_dirs] + [
+        ('bar', os.path.join(projects, 'bar.git'))]
+    self.mirrors._SeedProjects(checkouts)
+    for git_dir in git_dirs:
+      self.assertEqual(git.GetGitRepoRevision(
+          git_dir, branch='refs/cros-mirror/master'), rev)
+    # There is no mirror of bar to seed from.
+    self.assertEqual(sorted(os.listdir(projects)),
+                     ['a.git', 'b.git', 'c.git'])
+
+  def testGetMirrorRoot(self):
+    """Verify mirroring is on by default, and can be moved or disabled."""
+    os.environ.pop(constants.GIT_MIRROR_ENVVAR, None)
+    self.assertEqual(repository.GetMirrorRoot(),
+                     constants.GIT_MIRROR_DEFAULT_DIR)
+    os.environ[constants.GIT_MIRROR_ENVVAR] = self.tempdir
+    self.assertEqual(repository.GetMirrorRoot(), self.tempdir)
+    os.environ[constants.GIT_MIRROR_ENVVAR] = ''
+    self.assertEqual(repository.GetMirrorRoot(), None)
+
+
 class RepoInitTests(cros_test_lib.MoxTempDirTestCase):
 
   def _Initialize(self, branch='master'):
@@ -11,10 +11,16 @@ Library containing utility functions used for Chrome-specific build tasks.
 
 import functools
 import glob
+import hashlib
+import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import shlex
 import shutil
+import tempfile
+import time
 
 from chromite.buildbot import cbuildbot_results as results_lib
 from chromite.lib import cros_build_lib
@@ -108,22 +114,121 @@ class MustNotBeDirError(results_lib.StepFailure):
   """The specified path should not be a directory, but is."""
 
 
+_STRIP_FLAGS = ['--strip-unneeded']
+
+
+class StripCache(object):
+  """Persistent cache of stripped binaries.
+
+  Entries are keyed by the content of the unstripped binary and the strip
+  settings, so restaging a build only restrips the binaries that changed.  An
+  entry keeps the mtime it was first staged with, which lets rsync's quick
+  check skip it on the device for as long as the binary is unchanged.
+  """
+
+  MANIFEST = 'manifest.json'
+  # Least recently used entries are evicted beyond this size.
+  MAX_SIZE = 4 * 1024 * 1024 * 1024
+
+  def __init__(self, cache_dir, max_size=MAX_SIZE):
+    """Initialization.
+
+    Arguments:
+      cache_dir: Directory to keep the stripped binaries in.
+      max_size: Maximum total size of the cached binaries in bytes.
+    """
+    self.cache_dir = cache_dir
+    self.max_size = max_size
+    self._manifest_path = os.path.join(cache_dir, self.MANIFEST)
+    self._manifest = {'sources': {}, 'entries': {}}
+    try:
+      self._manifest.update(json.loads(osutils.ReadFile(self._manifest_path)))
+    except (IOError, ValueError):
+      pass
+    osutils.SafeMakedirs(cache_dir)
+
+  def _HashFile(self, path):
+    """Returns the sha1 of |path|, reusing the last one if it is unmodified."""
+    st = os.stat(path)
+    stamp = [st.st_size, st.st_mtime]
+    path = os.path.abspath(path)
+    cached = self._manifest['sources'].get(path)
+    if cached and cached[:2] == stamp:
+      return cached[2]
+
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+      for data in iter(lambda: f.read(1024 * 1024), ''):
+        sha1.update(data)
+    self._manifest['sources'][path] = stamp + [sha1.hexdigest()]
+    return sha1.hexdigest()
+
+  def _Key(self, strip_bin, src):
+    """Returns the cache key for stripping |src| with |strip_bin|."""
+    key = [self._HashFile(src), os.path.basename(strip_bin)] + _STRIP_FLAGS
+    if os.path.exists(strip_bin):
+      key.append(self._HashFile(strip_bin))
+    return hashlib.sha1('\0'.join(key)).hexdigest()
+
+  def Strip(self, strip_bin, src, dest):
+    """Places a stripped copy of |src| at |dest|, stripping it if needed."""
+    key = self._Key(strip_bin, src)
+    entry = os.path.join(self.cache_dir, key)
+    if os.path.exists(entry):
+      logging.debug('Using cached stripped %s', src)
+    else:
+      fd, tmp_entry = tempfile.mkstemp(prefix=key, dir=self.cache_dir)
+      os.close(fd)
+      try:
+        cros_build_lib.DebugRunCommand(
+            [strip_bin] + _STRIP_FLAGS + ['-o', tmp_entry, src])
+        shutil.copystat(src, tmp_entry)
+        os.rename(tmp_entry, entry)
+      finally:
+        osutils.SafeUnlink(tmp_entry)
+    shutil.copy2(entry, dest)
+    self._manifest['entries'][key] = time.time()
+
+  def Save(self):
+    """Evicts old entries, and records the state of the cache."""
+    entries = self._manifest['entries']
+    total = 0
+    for key in sorted(entries, key=entries.get, reverse=True):
+      entry = os.path.join(self.cache_dir, key)
+      if not os.path.exists(entry):
+        del entries[key]
+        continue
+      total += os.path.getsize(entry)
+      if total > self.max_size:
+        osutils.SafeUnlink(entry)
+        del entries[key]
+
+    # Forget build outputs that no longer exist.
+    sources = self._manifest['sources']
+    for path in [x for x in sources if not os.path.exists(x)]:
+      del sources[path]
+    osutils.WriteFile(self._manifest_path, json.dumps(self._manifest),
+                      atomic=True)
+
+
 class Copier(object):
   """Single file/directory copier.
 
   Provides destination stripping and permission setting functionality.
   """
 
-  def __init__(self, strip_bin=None, exe_opts=None):
+  def __init__(self, strip_bin=None, exe_opts=None, strip_cache=None):
     """Initialization.
 
     Arguments:
       strip_bin: Path to the program used to strip binaries.  If set to None,
                  binaries will not be stripped.
       exe_opts: Permissions to set on executables.
+      strip_cache: A StripCache to reuse previously stripped binaries from.
     """
     self.strip_bin = strip_bin
     self.exe_opts = exe_opts
+    self.strip_cache = strip_cache
 
   def Copy(self, src, dest, exe):
     """Perform the copy.
@@ -148,9 +253,11 @@ class Copier(object):
         dest = os.path.join(dest, os.path.basename(src))
       shutil.copytree(src, dest)
     elif exe and os.path.getsize(src) > 0:
-      if self.strip_bin:
-        cros_build_lib.DebugRunCommand([self.strip_bin, '--strip-unneeded',
-                                        '-o', dest, src])
+      if self.strip_bin and self.strip_cache:
+        self.strip_cache.Strip(self.strip_bin, src, dest)
+      elif self.strip_bin:
+        cros_build_lib.DebugRunCommand(
+            [self.strip_bin] + _STRIP_FLAGS + ['-o', dest, src])
         shutil.copystat(src, dest)
       if self.exe_opts is not None:
         os.chmod(dest, self.exe_opts)
@@ -158,6 +265,57 @@ class Copier(object):
       shutil.copy2(src, dest)
 
 
+class ParallelCopier(Copier):
+  """Copier that queues up copies, and performs them concurrently.
+
+  Copy() only records what to do, so the whole list of artifacts can be
+  validated before anything is copied.  Run() then strips and copies all of
+  them on a pool of workers, starting with the largest binaries to strip.
+  """
+
+  def __init__(self, processes=None, **kwargs):
+    """Initialization.
+
+    Arguments:
+      processes: Number of copies to run at once.  Defaults to the number of
+                 CPUs.
+      kwargs: See Copier.
+    """
+    Copier.__init__(self, **kwargs)
+    self.processes = processes or multiprocessing.cpu_count()
+    self._queue = []
+
+  def Copy(self, src, dest, exe):
+    """Queues up a copy.  See Copier.Copy."""
+    self._queue.append((src, dest, exe))
+
+  def _Copy(self, args):
+    Copier.Copy(self, *args)
+
+  def _Cost(self, args):
+    src, _, exe = args
+    if exe and self.strip_bin and os.path.isfile(src):
+      return os.path.getsize(src)
+    return 0
+
+  def Run(self):
+    """Performs all the queued up copies."""
+    queue, self._queue = self._queue, []
+    if not queue:
+      return
+    # Creating the same parent directories from several threads races.
+    for _, dest, _ in queue:
+      osutils.SafeMakedirs(os.path.dirname(dest))
+    queue.sort(key=self._Cost, reverse=True)
+    # Strips run in subprocesses and copies release the GIL, so threads do.
+    pool = multiprocessing.pool.ThreadPool(min(self.processes, len(queue)))
+    try:
+      pool.map(self._Copy, queue, chunksize=1)
+    finally:
+      pool.terminate()
+      pool.join()
+
+
 class Path(object):
   """Represents an artifact to be copied from build dir to staging dir."""
 
@@ -325,7 +483,8 @@ class StagingError(results_lib.StepFailure):
 
 
 def StageChromeFromBuildDir(staging_dir, build_dir, strip_bin, strict=False,
-                            sloppy=False, gyp_defines=None, staging_flags=None):
+                            sloppy=False, gyp_defines=None, staging_flags=None,
+                            strip_cache_dir=None):
   """Populates a staging directory with necessary build artifacts.
 
   If |strict| is set, then we decide what to stage based on the |gyp_defines|
@@ -345,6 +504,8 @@ def StageChromeFromBuildDir(staging_dir, build_dir, strip_bin, strict=False,
       containing GYP_DEFINES Chrome was built with.
     staging_flags: A list of extra staging flags.  Valid flags are specified in
       STAGING_FLAGS.
+    strip_cache_dir: If set, directory to keep stripped binaries in so that
+      unchanged binaries need not be stripped again.  See StripCache.
   """
   if os.path.exists(staging_dir) and os.listdir(staging_dir):
     raise StagingError('Staging directory %s must be empty.' % staging_dir)
@@ -357,7 +518,11 @@ def StageChromeFromBuildDir(staging_dir, build_dir, strip_bin, strict=False,
   if staging_flags is None:
     staging_flags = []
 
-  copier = Copier(strip_bin=strip_bin, exe_opts=0755)
+  strip_cache = None
+  if strip_bin and strip_cache_dir:
+    strip_cache = StripCache(strip_cache_dir)
+  copier = ParallelCopier(strip_bin=strip_bin, exe_opts=0755,
+                          strip_cache=strip_cache)
   copied_paths = []
   for p in _COPY_PATHS:
     if not strict or p.ShouldProcess(gyp_defines, staging_flags):
@@ -368,4 +533,8 @@ def StageChromeFromBuildDir(staging_dir, build_dir, strip_bin, strict=False,
                            'Are you looking in the right directory?\n'
                            'Aborting copy...')
 
+  copier.Run()
+  if strip_cache:
+    strip_cache.Save()
+
   _FixPermissions(staging_dir)
@@ -5,12 +5,14 @@
 # found in the LICENSE file.
 
 import os
+import stat
 import sys
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                 '..', '..'))
 from chromite.lib import cros_test_lib
 from chromite.lib import chrome_util
+from chromite.lib import osutils
 
 # pylint: disable=W0212,W0233
 
@@ -212,5 +214,109 @@ class SloppyDirCopyTest(SloppyFileCopyTest, DirCopyTest):
   """Test directory copies with sloppy=True"""
 
 
+class ParallelFileCopyTest(FileCopyTest):
+  """Test file copies queued up on a ParallelCopier."""
+
+  def setUp(self):
+    self.copier = chrome_util.ParallelCopier(processes=2)
+
+  def _CopyAndVerify(self, path, src_struct, dest_struct, error=None,
+                     strict=False, sloppy=False):
+    cros_test_lib.CreateOnDiskHierarchy(self.src_base, src_struct)
+    if error:
+      self.assertRaises(error, path.Copy, self.src_base, self.dest_base,
+                        self.copier, strict, sloppy)
+      return
+
+    path.Copy(self.src_base, self.dest_base, self.copier, strict, sloppy)
+    self.copier.Run()
+    cros_test_lib.VerifyOnDiskHierarchy(self.dest_base, dest_struct)
+
+
+class ParallelDirCopyTest(ParallelFileCopyTest, DirCopyTest):
+  """Test directory copies queued up on a ParallelCopier."""
+
+
+class StripCacheTest(cros_test_lib.TempDirTestCase):
+  """Tests for reusing stripped binaries across stagings."""
+
+  def setUp(self):
+    self.strip_log = os.path.join(self.tempdir, 'strip.log')
+    self.strip_bin = os.path.join(self.tempdir, 'strip')
+    osutils.WriteFile(self.strip_bin,
+                      '#!/bin/sh\necho "$4" >> %s\ncp "$4" "$3"\n'
+                      % self.strip_log)
+    os.chmod(self.strip_bin, 0755)
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+    self.src = os.path.join(self.tempdir, 'chrome')
+    osutils.WriteFile(self.src, 'binary')
+
+  def _Stage(self, dest_name):
+    """Stages self.src through a fresh cache, like a new deploy would."""
+    cache = chrome_util.StripCache(self.cache_dir)
+    copier = chrome_util.Copier(strip_bin=self.strip_bin, exe_opts=0755,
+                                strip_cache=cache)
+    dest = os.path.join(self.tempdir, dest_name, 'chrome')
+    copier.Copy(self.src, dest, True)
+    cache.Save()
+    return dest
+
+  def _StripCount(self):
+    if not os.path.exists(self.strip_log):
+      return 0
+    return len(osutils.ReadFile(self.strip_log).splitlines())
+
+  def testReuse(self):
+    """Unchanged binaries are only stripped once, and keep their mtime."""
+    first = self._Stage('first')
+    self.assertEqual(self._StripCount(), 1)
+    # A rebuild that produces the same binary.
+    os.utime(self.src, (1, 1))
+    second = self._Stage('second')
+    self.assertEqual(self._StripCount(), 1)
+    self.assertEqual(osutils.ReadFile(second), 'binary')
+    self.assertEqual(os.stat(first).st_mtime, os.stat(second).st_mtime)
+    self.assertEqual(stat.S_IMODE(os.stat(second).st_mode), 0755)
+
+  def testChanged(self):
+    """Binaries are stripped again once their contents change."""
+    self._Stage('first')
+    osutils.WriteFile(self.src, 'binary2')
+    dest = self._Stage('second')
+    self.assertEqual(self._StripCount(), 2)
+    self.assertEqual(osutils.ReadFile(dest), 'binary2')
+
+  def testParallelStrip(self):
+    """Binaries queued up on a ParallelCopier are all stripped."""
+    cache = chrome_util.StripCache(self.cache_dir)
+    copier = chrome_util.ParallelCopier(strip_bin=self.strip_bin,
+                                        exe_opts=0755, strip_cache=cache)
+    for i in range(4):
+      src = os.path.join(self.tempdir, 'src', 'lib%i.so' % i)
+      osutils.WriteFile(src, 'library%i' % i, makedirs=True)
+      copier.Copy(src, os.path.join(self.tempdir, 'dest', 'lib%i.so' % i),
+                  True)
+    self.assertEqual(self._StripCount(), 0)
+    copier.Run()
+    self.assertEqual(self._StripCount(), 4)
+    for i in range(4):
+      dest = os.path.join(self.tempdir, 'dest', 'lib%i.so' % i)
+      self.assertEqual(osutils.ReadFile(dest), 'library%i' % i)
+
+  def testEviction(self):
+    """The least recently used entries are evicted beyond the size limit."""
+    cache = chrome_util.StripCache(self.cache_dir, max_size=10)
+    for i, content in enumerate(('binary1', 'binary2')):
+      osutils.WriteFile(self.src, content)
+      cache.Strip(self.strip_bin, self.src,
+                  os.path.join(self.tempdir, 'out%i' % i))
+    cache.Save()
+    entries = [x for x in os.listdir(self.cache_dir)
+               if x != chrome_util.StripCache.MANIFEST]
+    self.assertEqual(len(entries), 1)
+    self.assertEqual(
+        osutils.ReadFile(os.path.join(self.cache_dir, entries[0])), 'binary2')
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -4,22 +4,32 @@
 
 """Common python commands used by various build scripts."""
 
+import bz2
+import collections
 import contextlib
 from datetime import datetime
 from email.utils import formatdate
 import errno
+import fcntl
 import functools
+import hashlib
 import json
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import re
+import select
+import shutil
 import signal
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import urllib
+import zlib
 
 # TODO(build): Fix this.
 # This should be absolute import, but that requires fixing all
@@ -251,6 +261,71 @@ class _Popen(subprocess.Popen):
         raise
 
 
+def _CloseInheritedFds():
+  """Closes the fds a child would inherit; for use as a Popen preexec_fn.
+
+  This has the effect of close_fds=True, but only visits the fds that are
+  actually open rather than every fd up to the rlimit, which costs several
+  milliseconds per command when the limit is high.  Fds that are closed on
+  exec anyway are left alone, which notably keeps the pipe Popen uses to
+  report exec failures working.
+  """
+  for fd in os.listdir('/proc/self/fd'):
+    fd = int(fd)
+    if fd > 2:
+      try:
+        if not fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC:
+          os.close(fd)
+      except EnvironmentError:
+        # The fd listdir used to read the directory is already closed.
+        pass
+
+
+def _CanCloseFdsInChild():
+  """Returns True if _CloseInheritedFds can be used as a preexec_fn.
+
+  Running python between fork and exec is only safe while no other thread
+  could be holding a lock the child needs.
+  """
+  return threading.active_count() == 1 and os.path.isdir('/proc/self/fd')
+
+
+def _PrepareCommand(cmd, shell, enter_chroot, chroot_args, env, extra_env):
+  """Returns the (cmd, env) to run a RunCommand style command with.
+
+  See RunCommand for the meaning of the arguments.
+  """
+  if isinstance(cmd, basestring):
+    if not shell:
+      raise Exception('Cannot run a string command without a shell')
+    cmd = ['/bin/bash', '-c', cmd]
+  elif shell:
+    raise Exception('Cannot run an array command with a shell')
+
+  # If we are using enter_chroot we need to use enterchroot pass env through
+  # to the final command.
+  env = env.copy() if env is not None else os.environ.copy()
+  if enter_chroot:
+    wrapper = ['cros_sdk']
+
+    if chroot_args:
+      wrapper += chroot_args
+
+    if extra_env:
+      wrapper.extend('%s=%s' % (k, v) for k, v in extra_env.iteritems())
+
+    cmd = wrapper + ['--'] + cmd
+
+  elif extra_env:
+    env.update(extra_env)
+
+  for var in constants.ENV_PASSTHRU:
+    if var not in env and var in os.environ:
+      env[var] = os.environ[var]
+
+  return cmd, env
+
+
 #pylint: disable=W0622
 def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                redirect_stdout=False, redirect_stderr=False,
@@ -258,7 +333,8 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                env=None, extra_env=None, ignore_sigint=False,
                combine_stdout_stderr=False, log_stdout_to_file=None,
                chroot_args=None, debug_level=logging.INFO,
-               error_code_ok=False, kill_timeout=1, log_output=False):
+               error_code_ok=False, kill_timeout=1, log_output=False,
+               use_pipes=False):
   """Runs a command.
 
   Args:
@@ -302,6 +378,11 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
                   process to shutdown from a SIGTERM before we SIGKILL it.
                   Specified in seconds.
     log_output: Log the command and its output automatically.
+    use_pipes: Capture output through pipes rather than temporary files, and
+               close inherited fds without walking the whole fd table.  This
+               is cheaper for short commands, but output is read until the
+               pipes close, so only use it for commands that don't leave
+               background processes holding stdout/stderr open.
   Returns:
     A CommandResult object.
 
@@ -321,6 +402,8 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
   kill_timeout = float(kill_timeout)
 
   def _get_tempfile():
+    if use_pipes:
+      return subprocess.PIPE
     try:
       return tempfile.TemporaryFile(bufsize=0)
     except EnvironmentError as e:
@@ -355,34 +438,8 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
   if input:
     stdin = subprocess.PIPE
 
-  if isinstance(cmd, basestring):
-    if not shell:
-      raise Exception('Cannot run a string command without a shell')
-    cmd = ['/bin/bash', '-c', cmd]
-    shell = False
-  elif shell:
-    raise Exception('Cannot run an array command with a shell')
-
-  # If we are using enter_chroot we need to use enterchroot pass env through
-  # to the final command.
-  env = env.copy() if env is not None else os.environ.copy()
-  if enter_chroot:
-    wrapper = ['cros_sdk']
-
-    if chroot_args:
-      wrapper += chroot_args
-
-    if extra_env:
-      wrapper.extend('%s=%s' % (k, v) for k, v in extra_env.iteritems())
-
-    cmd = wrapper + ['--'] + cmd
-
-  elif extra_env:
-    env.update(extra_env)
-
-  for var in constants.ENV_PASSTHRU:
-    if var not in env and var in os.environ:
-      env[var] = os.environ[var]
+  cmd, env = _PrepareCommand(cmd, shell, enter_chroot, chroot_args, env,
+                             extra_env)
 
   # Print out the command before running.
   if print_cmd or log_output:
@@ -396,6 +453,10 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
 
   cmd_result.cmd = cmd
 
+  popen_kwds = {'close_fds': True}
+  if use_pipes and _CanCloseFdsInChild():
+    popen_kwds = {'preexec_fn': _CloseInheritedFds}
+
   proc = None
   # Verify that the signals modules is actually usable, and won't segfault
   # upon invocation of getsignal.  See signals.SignalModuleUsable for the
@@ -403,8 +464,7 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
   use_signals = signals.SignalModuleUsable()
   try:
     proc = _Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout,
-                  stderr=stderr, shell=False, env=env,
-                  close_fds=True)
+                  stderr=stderr, shell=False, env=env, **popen_kwds)
 
     if use_signals:
       if ignore_sigint:
@@ -427,12 +487,12 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
         signal.signal(signal.SIGINT, old_sigint)
         signal.signal(signal.SIGTERM, old_sigterm)
 
-      if stdout and not log_stdout_to_file:
+      if stdout and stdout != subprocess.PIPE and not log_stdout_to_file:
         stdout.seek(0)
         cmd_result.output = stdout.read()
         stdout.close()
 
-      if stderr and stderr != subprocess.STDOUT:
+      if stderr and stderr not in (subprocess.STDOUT, subprocess.PIPE):
         stderr.seek(0)
         cmd_result.error = stderr.read()
         stderr.close()
@@ -482,6 +542,299 @@ def RunCommand(cmd, print_cmd=True, error_ok=False, error_message=None,
 DebugRunCommand = functools.partial(RunCommand, debug_level=logging.DEBUG)
 
 
+# Values for the return_when argument of WaitForCommands.
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+# How often to check on commands whose output we aren't reading.
+_BACKGROUND_POLL_INTERVAL = 0.1
+
+
+class BackgroundCommand(object):
+  """A command started by StartCommand, running alongside the caller.
+
+  Captured output is read as it is produced by whichever of Wait,
+  WaitForCommands or StreamCommandOutput is waiting on the command, so
+  many commands can run at once without filling their pipes.
+  """
+
+  def __init__(self, cmd, proc, input=None, cwd=None, extra_env=None,
+               error_code_ok=False, error_message=None, kill_timeout=1):
+    self.cmd = cmd
+    self.proc = proc
+    self._cwd = cwd
+    self._extra_env = extra_env
+    self._error_code_ok = error_code_ok
+    self._error_message = error_message
+    self._kill_timeout = kill_timeout
+    self._input = input or ''
+    # Maps an open pipe's fd to the name of the stream it carries.
+    self._fds = {}
+    self._chunks = {'stdout': [], 'stderr': []}
+    for name in ('stdout', 'stderr'):
+      pipe = getattr(proc, name)
+      if pipe is not None:
+        self._fds[pipe.fileno()] = name
+    self._captured = set(self._fds.values())
+    if proc.stdin is not None:
+      self._fds[proc.stdin.fileno()] = 'stdin'
+    self._result = None
+
+  def _Read(self, fd):
+    """Reads what is available from |fd|.
+
+    Returns:
+      A (stream name, data) tuple; data is '' once the stream is closed.
+    """
+    name = self._fds[fd]
+    data = os.read(fd, 65536)
+    if data:
+      self._chunks[name].append(data)
+    else:
+      getattr(self.proc, name).close()
+      del self._fds[fd]
+    return name, data
+
+  def _Write(self, fd):
+    """Feeds the next part of the command's input to |fd|."""
+    # A pipe select reports as writable has room for PIPE_BUF bytes.
+    try:
+      written = os.write(fd, self._input[:select.PIPE_BUF])
+    except OSError as e:
+      if e.errno != errno.EPIPE:
+        raise
+      written = len(self._input)
+    self._input = self._input[written:]
+    if not self._input:
+      self.proc.stdin.close()
+      del self._fds[fd]
+
+  def _ReadFds(self):
+    return [fd for fd, name in self._fds.iteritems() if name != 'stdin']
+
+  def _WriteFds(self):
+    return [fd for fd, name in self._fds.iteritems() if name == 'stdin']
+
+  def Done(self):
+    """Returns True once the command has exited and its output is read."""
+    if self._result is None:
+      if self._fds or self.proc.poll() is None:
+        return False
+      self._Finish()
+    return True
+
+  def _Finish(self):
+    output, error = [''.join(self._chunks[name])
+                     if name in self._captured else None
+                     for name in ('stdout', 'stderr')]
+    self._result = CommandResult(cmd=self.cmd, output=output, error=error,
+                                 returncode=self.proc.returncode)
+
+  def Kill(self):
+    """Terminates the command if it is still running."""
+    _KillChildProcess(self.proc, self._kill_timeout, self.cmd, None, None, None)
+    for fd in self._fds.keys():
+      getattr(self.proc, self._fds.pop(fd)).close()
+
+  def Wait(self, timeout=None):
+    """Waits for the command to complete.
+
+    Args:
+      timeout: Seconds to wait for; by default, wait as long as it takes.
+
+    Returns:
+      The CommandResult of the command, or None if the timeout expired.
+
+    Raises:
+      RunCommandError if the command failed, unless error_code_ok was set.
+    """
+    done, _ = WaitForCommands([self], timeout=timeout)
+    if done:
+      return self.Result()
+
+  def Result(self):
+    """Returns the CommandResult of a completed command.
+
+    Raises:
+      RunCommandError if the command failed, unless error_code_ok was set.
+    """
+    assert self.Done(), 'Command %r is still running' % (self.cmd,)
+    if not self._error_code_ok and self._result.returncode:
+      msg = ('Failed command "%r", cwd=%s, extra env=%r' %
+             (self.cmd, self._cwd, self._extra_env))
+      if self._error_message:
+        msg += '\n%s' % self._error_message
+      raise RunCommandError(msg, self._result)
+    return self._result
+
+
+def StartCommand(cmd, print_cmd=True, error_message=None,
+                 redirect_stdout=False, redirect_stderr=False,
+                 cwd=None, input=None, enter_chroot=False, shell=False,
+                 env=None, extra_env=None, combine_stdout_stderr=False,
+                 chroot_args=None, debug_level=logging.INFO,
+                 error_code_ok=False, kill_timeout=1):
+  """Starts a command in the background.
+
+  Takes the same arguments as RunCommand, but rather than waiting for the
+  command, returns a BackgroundCommand to wait on later, alone or together
+  with other commands through WaitForCommands and StreamCommandOutput.
+
+  Returns:
+    A BackgroundCommand object.
+
+  Raises:
+    RunCommandError if the command could not be started.
+  """
+  mute_output = logger.getEffectiveLevel() > debug_level
+  stdout = stderr = stdin = None
+  if redirect_stdout or mute_output:
+    stdout = subprocess.PIPE
+  if combine_stdout_stderr:
+    stderr = subprocess.STDOUT
+  elif redirect_stderr or mute_output:
+    stderr = subprocess.PIPE
+  if input:
+    stdin = subprocess.PIPE
+
+  # Children writing directly to our stdout or stderr would bypass our
+  # buffers, so flush them to keep output in order.
+  if stdout is None or stderr is None:
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+  cmd, env = _PrepareCommand(cmd, shell, enter_chroot, chroot_args, env,
+                             extra_env)
+  if print_cmd:
+    if cwd:
+      logger.log(debug_level, 'StartCommand: %s in %s',
+                 ' '.join(map(repr, cmd)), cwd)
+    else:
+      logger.log(debug_level, 'StartCommand: %r', ' '.join(map(repr, cmd)))
+
+  try:
+    proc = _Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout, stderr=stderr,
+                  shell=False, env=env, close_fds=True)
+  except OSError as e:
+    estr = str(e)
+    if e.errno == errno.EACCES:
+      estr += '; does the program need `chmod a+x`?'
+    raise RunCommandError(estr, CommandResult(cmd=cmd), exception=e)
+
+  return BackgroundCommand(cmd, proc, input=input, cwd=cwd,
+                           extra_env=extra_env, error_code_ok=error_code_ok,
+                           error_message=error_message,
+                           kill_timeout=float(kill_timeout))
+
+
+def _PumpCommands(commands, timeout=None):
+  """Moves data through the pipes of |commands| once any is ready.
+
+  Args:
+    commands: BackgroundCommand objects that aren't done.
+    timeout: Longest time to wait for data, in seconds; None to block.
+
+  Returns:
+    A list of (command, stream name, data) tuples for what was read; data is
+    '' when a stream was closed.
+  """
+  readers, writers = {}, {}
+  for command in commands:
+    readers.update((fd, command) for fd in command._ReadFds())
+    writers.update((fd, command) for fd in command._WriteFds())
+
+  # A command with no pipes left can only be polled for its exit.
+  if any(not (c._ReadFds() or c._WriteFds()) for c in commands):
+    if timeout is None or timeout > _BACKGROUND_POLL_INTERVAL:
+      timeout = _BACKGROUND_POLL_INTERVAL
+
+  events = []
+  try:
+    readable, writable, _ = select.select(readers.keys(), writers.keys(), [],
+                                          timeout)
+  except select.error as e:
+    if e.args[0] != errno.EINTR:
+      raise
+    return events
+  for fd in writable:
+    writers[fd]._Write(fd)
+  for fd in readable:
+    command = readers[fd]
+    events.append((command,) + command._Read(fd))
+  return events
+
+
+def _IterCommandOutput(commands, return_when=ALL_COMPLETED, timeout=None):
+  """Yields the output of |commands| as it is read, until they are done.
+
+  See WaitForCommands for the arguments, and _PumpCommands for what is
+  yielded.  If the caller is interrupted, all the commands are killed.
+  """
+  deadline = None if timeout is None else time.time() + timeout
+  try:
+    while True:
+      pending = [c for c in commands if not c.Done()]
+      if not pending or (return_when == FIRST_COMPLETED and
+                         len(pending) < len(commands)):
+        return
+      remaining = None
+      if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          return
+      for event in _PumpCommands(pending, timeout=remaining):
+        yield event
+  except (Exception, KeyboardInterrupt):
+    for command in commands:
+      command.Kill()
+    raise
+
+
+def WaitForCommands(commands, return_when=ALL_COMPLETED, timeout=None):
+  """Waits for background commands to complete.
+
+  Args:
+    commands: BackgroundCommand objects to wait on.
+    return_when: ALL_COMPLETED to wait for all the commands, or
+      FIRST_COMPLETED to return as soon as any of them completes.
+    timeout: Seconds to wait for; by default, wait as long as it takes.
+
+  Returns:
+    A (done, pending) tuple of lists of the commands.
+  """
+  commands = list(commands)
+  for _ in _IterCommandOutput(commands, return_when=return_when,
+                              timeout=timeout):
+    pass
+  done = [c for c in commands if c.Done()]
+  return done, [c for c in commands if c not in done]
+
+
+def StreamCommandOutput(commands, timeout=None):
+  """Yields the captured output of background commands line by line.
+
+  Lines of different commands are yielded as they are produced, until all
+  the commands are done or the timeout expires.
+
+  Args:
+    commands: BackgroundCommand objects to read from.
+    timeout: Seconds to stream for; by default, until all commands are done.
+
+  Yields:
+    (command, stream name, line) tuples; stream name is 'stdout' or
+    'stderr', and the line includes its newline if it had one.
+  """
+  partial = {}
+  for command, name, data in _IterCommandOutput(list(commands),
+                                                timeout=timeout):
+    key = (command, name)
+    lines = (partial.pop(key, '') + data).splitlines(True)
+    if data and lines and not lines[-1].endswith('\n'):
+      partial[key] = lines.pop()
+    for line in lines:
+      yield command, name, line
+
+
 class DieSystemExit(SystemExit):
   """Custom Exception used so we can intercept this if necessary."""
 
@@ -806,7 +1159,7 @@ COMP_NONE = 0
 COMP_GZIP = 1
 COMP_BZIP2 = 2
 COMP_XZ = 3
-def FindCompressor(compression, chroot=None):
+def FindCompressor(compression, chroot=None, parallel=True):
   """Locate a compressor utility program (possibly in a chroot).
 
   Since we compress/decompress a lot, make it easy to locate a
@@ -817,6 +1170,7 @@ def FindCompressor(compression, chroot=None):
   Arguments:
     compression: The type of compression desired.
     chroot: Optional path to a chroot to search.
+    parallel: Whether to look for the parallel implementation at all.
   Returns:
     Path to a compressor.
   Raises:
@@ -830,7 +1184,7 @@ def FindCompressor(compression, chroot=None):
     para = 'pbzip2'
   elif compression == COMP_XZ:
     std = 'xz'
-    para = 'xz'
+    para = 'pixz'
   elif compression == COMP_NONE:
     return 'cat'
   else:
@@ -841,7 +1195,7 @@ def FindCompressor(compression, chroot=None):
     roots.append(chroot)
   roots.append('/')
 
-  for prog in [para, std]:
+  for prog in [para, std] if parallel else [std]:
     for root in roots:
       for subdir in ['', 'usr']:
         path = os.path.join(root, subdir, 'bin', prog)
@@ -851,8 +1205,69 @@ def FindCompressor(compression, chroot=None):
   return std
 
 
+# Compressors FindCompressor may return that use all CPUs by themselves.
+_PARALLEL_COMPRESSORS = frozenset(['pigz', 'pbzip2', 'pixz'])
+
+# Size of the blocks ParallelCompress compresses independently.
+_PARALLEL_COMPRESS_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def _CompressBlock(compression, comp, data):
+  """Compresses |data| into a complete gzip member or bzip2/xz stream."""
+  if compression == COMP_GZIP:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  elif compression == COMP_BZIP2:
+    compressor = bz2.BZ2Compressor(9)
+  else:
+    # Python has no xz support, so let the compressor handle the block.
+    return RunCommand([comp, '-c'], input=data, redirect_stdout=True,
+                      print_cmd=False, use_pipes=True).output
+  return compressor.compress(data) + compressor.flush()
+
+
+def ParallelCompress(compression, source, dest, processes=None, chroot=None):
+  """Compresses the |source| file object into |dest| using many CPUs.
+
+  The input is split into blocks that are compressed independently, and
+  written out as consecutive gzip members or bzip2/xz streams, which the
+  standard tools decompress as a single file.
+
+  Args:
+    compression: The type of compression desired; see FindCompressor.
+    source: File object to read the data to compress from.
+    dest: File object to write the compressed data to.
+    processes: Number of blocks to compress at once; defaults to the number
+      of CPUs.
+    chroot: See FindCompressor().
+  """
+  if compression == COMP_NONE:
+    shutil.copyfileobj(source, dest)
+    return
+
+  # Every block is compressed on a CPU of its own already.
+  comp = FindCompressor(compression, chroot=chroot, parallel=False)
+  processes = processes or multiprocessing.cpu_count()
+  # zlib and bz2 release the GIL while compressing, so threads are enough.
+  pool = multiprocessing.pool.ThreadPool(processes)
+  try:
+    pending = collections.deque()
+    while True:
+      data = source.read(_PARALLEL_COMPRESS_BLOCK_SIZE)
+      if data:
+        pending.append(pool.apply_async(_CompressBlock,
+                                        (compression, comp, data)))
+      # Keep a bounded number of blocks in memory.
+      while pending and (not data or len(pending) > 2 * processes):
+        dest.write(pending.popleft().get())
+      if not data:
+        break
+  finally:
+    pool.terminate()
+    pool.join()
+
+
 def CreateTarball(target, cwd, sudo=False, compression=COMP_XZ, chroot=None,
-                  inputs=None, extra_args=None, **kwds):
+                  inputs=None, extra_args=None, parallel=False, **kwds):
   """Create a tarball.  Executes 'tar' on the commandline.
 
   Arguments:
@@ -865,6 +1280,9 @@ def CreateTarball(target, cwd, sudo=False, compression=COMP_XZ, chroot=None,
     inputs: A list of files or directories to add to the tarball.  If unset,
       defaults to ".".
     extra_args: Extra args to pass to "tar".
+    parallel: Compress using all CPUs.  Uses pigz, pbzip2 or pixz when
+      available, and ParallelCompress otherwise.  May also be the number of
+      CPUs to use, in which case ParallelCompress is always used.
     kwds: Any RunCommand options/overrides to use.
 
   Returns:
@@ -877,9 +1295,49 @@ def CreateTarball(target, cwd, sudo=False, compression=COMP_XZ, chroot=None,
   kwds.setdefault('debug_level', logging.DEBUG)
 
   comp = FindCompressor(compression, chroot=chroot)
-  cmd = ['tar'] + extra_args + ['-I', comp, '-cf', target] + inputs
   rc_func = SudoRunCommand if sudo else RunCommand
-  return rc_func(cmd, cwd=cwd, **kwds)
+  if (not parallel or compression == COMP_NONE or
+      (parallel is True and
+       os.path.basename(comp) in _PARALLEL_COMPRESSORS)):
+    cmd = ['tar'] + extra_args + ['-I', comp, '-cf', target] + inputs
+    return rc_func(cmd, cwd=cwd, **kwds)
+
+  # Have tar write to a fifo, and compress what comes out of it ourselves.
+  tempdir = tempfile.mkdtemp(prefix='tarball')
+  fifo = os.path.join(tempdir, 'tar')
+  os.mkfifo(fifo)
+  # Holding the fifo open for writing lets the reader open it without
+  # waiting for tar, and keeps it from seeing EOF until tar is done.
+  writer_fd = os.open(fifo, os.O_RDWR)
+  errors = []
+
+  def _Compress():
+    try:
+      with open(fifo, 'rb') as source:
+        with open(target, 'wb') as dest:
+          ParallelCompress(compression, source, dest, chroot=chroot,
+                           processes=None if parallel is True else parallel)
+    except Exception as e:
+      errors.append(e)
+      # Drain the fifo so tar doesn't block on it.
+      with open(fifo, 'rb') as source:
+        while source.read(_PARALLEL_COMPRESS_BLOCK_SIZE):
+          pass
+
+  compressor = threading.Thread(target=_Compress)
+  compressor.start()
+  try:
+    cmd = ['tar'] + extra_args + ['-cf', fifo] + inputs
+    result = rc_func(cmd, cwd=cwd, **kwds)
+  finally:
+    os.close(writer_fd)
+    compressor.join()
+    os.unlink(fifo)
+    os.rmdir(tempdir)
+
+  if errors:
+    raise errors[0]
+  return result
 
 
 def GetInput(prompt):
@@ -1225,6 +1683,154 @@ def RunCurl(args, **kwargs):
         Die("Curl failed w/ exit code %i", code)
 
 
+# Size of the HTTP range requests FetchUrlInChunks splits downloads into.
+CURL_CHUNK_SIZE = 64 * 1024 * 1024
+
+# Number of ranges FetchUrlInChunks downloads at once.
+CURL_CHUNK_PROCESSES = 4
+
+# Name of the file recording the progress of a chunked download.
+_CHUNK_STATE = 'state.json'
+
+
+def _Sha1File(path):
+  """Returns the hex sha1 of the file at |path|."""
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for data in iter(lambda: f.read(1024 * 1024), ''):
+      sha1.update(data)
+  return sha1.hexdigest()
+
+
+def _FetchUrlChunk(args):
+  """Downloads bytes [start, end] of a url into a part file.
+
+  A part file left over from an interrupted run is resumed from where it
+  stopped rather than downloaded again.
+
+  Returns:
+    A tuple of the chunk index and the sha1 of the finished part, or None
+    for the sha1 if the download failed.
+  """
+  index, url, part, start, end = args
+  size = end - start + 1
+  current = os.path.getsize(part) if os.path.exists(part) else 0
+  if current > size:
+    os.unlink(part)
+    current = 0
+
+  if current < size:
+    resume = part + '.resume'
+    try:
+      RunCurl(['-f', '-L', '-s', '-S', '-y', '30',
+               '-r', '%d-%d' % (start + current, end), '--output', resume, url],
+              print_cmd=False)
+    except DieSystemExit:
+      # Exiting would take down the pool's worker thread along with us.
+      return index, None
+    with open(part, 'ab') as dest:
+      with open(resume, 'rb') as source:
+        shutil.copyfileobj(source, dest)
+    os.unlink(resume)
+
+  if os.path.getsize(part) != size:
+    # The server ignored the range; throw it away so a retry starts clean.
+    logger.error('Got %i bytes instead of %i for range %i-%i of %s',
+                 os.path.getsize(part), size, start, end, url)
+    os.unlink(part)
+    return index, None
+  return index, _Sha1File(part)
+
+
+def FetchUrlInChunks(url, dest, content_length, validator=None,
+                     chunk_size=CURL_CHUNK_SIZE,
+                     processes=CURL_CHUNK_PROCESSES):
+  """Downloads |url| to |dest| using concurrent HTTP range requests.
+
+  The file is split into chunks that are downloaded in parallel into
+  |dest|.parts/, and only renamed into place once all of them are complete.
+  The sha1 of every finished chunk is recorded, so an interrupted download
+  resumes with the chunks that are still intact, and partial chunks pick up
+  where they stopped.  The server must support byte ranges.
+
+  Args:
+    url: The http(s) url to download.
+    dest: Path to write the file to.
+    content_length: Size of the file in bytes.
+    validator: ETag or Last-Modified value of the file, if any.  Progress
+      saved for a different validator is discarded, since the file changed.
+    chunk_size: Size of the individual range requests.
+    processes: Number of chunks to download at once.
+
+  Returns:
+    |dest|
+  """
+  parts_dir = dest + '.parts'
+  state_file = os.path.join(parts_dir, _CHUNK_STATE)
+  params = {'url': url, 'content_length': content_length,
+            'chunk_size': chunk_size, 'validator': validator}
+  try:
+    with open(state_file) as f:
+      state = json.load(f)
+  except (IOError, ValueError):
+    state = {}
+  if state.get('params') != params:
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    state = {}
+  if not os.path.isdir(parts_dir):
+    os.makedirs(parts_dir)
+
+  def _Part(index):
+    return os.path.join(parts_dir, '%05i' % index)
+
+  # Only keep the finished chunks that are still intact.
+  checksums = {}
+  for index, checksum in state.get('checksums', {}).iteritems():
+    part = _Part(int(index))
+    if os.path.exists(part):
+      if _Sha1File(part) == checksum:
+        checksums[int(index)] = checksum
+      else:
+        os.unlink(part)
+
+  def _SaveState():
+    tmp_file = state_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+      json.dump({'params': params, 'checksums': checksums}, f)
+    os.rename(tmp_file, state_file)
+
+  starts = xrange(0, content_length, chunk_size)
+  chunks = [(index, url, _Part(index), start,
+             min(start + chunk_size, content_length) - 1)
+            for index, start in enumerate(starts)]
+  pending = [x for x in chunks if x[0] not in checksums]
+  if pending:
+    _SaveState()
+    pool = multiprocessing.pool.ThreadPool(min(processes, len(pending)))
+    try:
+      failed = []
+      for index, checksum in pool.imap_unordered(_FetchUrlChunk, pending):
+        if checksum is None:
+          failed.append(index)
+        else:
+          checksums[index] = checksum
+          _SaveState()
+    finally:
+      pool.terminate()
+      pool.join()
+    if failed:
+      Die('Failed to download %i chunks of %s', len(failed), url)
+
+  tmp_dest = dest + '.tmp'
+  with open(tmp_dest, 'wb') as f:
+    for chunk in chunks:
+      with open(chunk[2], 'rb') as part:
+        shutil.copyfileobj(part, f)
+  os.rename(tmp_dest, dest)
+  shutil.rmtree(parts_dir)
+  return dest
+
+
 def SetupBasicLogging():
   """Sets up basic logging to use format from constants."""
   logging_format = '%(asctime)s - %(filename)s - %(levelname)-8s: %(message)s'
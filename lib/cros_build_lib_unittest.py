@@ -9,14 +9,18 @@ import sys
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(
     os.path.abspath(__file__)))))
 
+import BaseHTTPServer
 import contextlib
 import errno
 import functools
+import hashlib
 import itertools
+import json
 import logging
 import mox
 import signal
 import StringIO
+import threading
 import time
 import urllib
 import __builtin__
@@ -105,6 +109,95 @@ class TestRunCommandNoMock(cros_test_lib.TestCase):
     self.assertRaises(cros_build_lib.RunCommandError, cros_build_lib.RunCommand,
                       ['/does/not/exist'])
 
+  def testUsePipes(self):
+    """Output captured through pipes matches the temporary file path."""
+    cmd = 'echo out; echo err >&2; exit 3'
+    results = [cros_build_lib.RunCommandCaptureOutput(
+        cmd, shell=True, error_code_ok=True, use_pipes=use_pipes)
+               for use_pipes in (False, True)]
+    for result in results:
+      self.assertEqual(result.output, 'out\n')
+      self.assertEqual(result.error, 'err\n')
+      self.assertEqual(result.returncode, 3)
+
+    self.assertRaises(cros_build_lib.RunCommandError, cros_build_lib.RunCommand,
+                      ['/does/not/exist'], use_pipes=True)
+
+  def testUsePipesClosesFds(self):
+    """Fds open in the parent are not inherited by the child."""
+    # Use a high fd so it can't be mistaken for one ls opens itself.
+    fd = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(fd, 99)
+    os.close(fd)
+    try:
+      result = cros_build_lib.RunCommandCaptureOutput(
+          ['ls', '/proc/self/fd'], use_pipes=True)
+      self.assertNotIn('99', result.output.split())
+    finally:
+      os.close(99)
+
+
+class TestStartCommand(cros_test_lib.TestCase):
+  """Tests for running commands in the background."""
+
+  def _Start(self, cmd, **kwds):
+    kwds.setdefault('print_cmd', False)
+    return cros_build_lib.StartCommand(cmd, shell=isinstance(cmd, basestring),
+                                       redirect_stdout=True,
+                                       redirect_stderr=True, **kwds)
+
+  def testWaitAll(self):
+    """Commands run concurrently and their output is captured."""
+    start = time.time()
+    commands = [self._Start('sleep 0.5; echo out%d; echo err >&2' % i)
+                for i in range(5)]
+    done, pending = cros_build_lib.WaitForCommands(commands)
+    self.assertTrue(time.time() - start < 2.5)
+    self.assertEqual((done, pending), (commands, []))
+    for i, command in enumerate(commands):
+      result = command.Result()
+      self.assertEqual(result.output, 'out%d\n' % i)
+      self.assertEqual(result.error, 'err\n')
+      self.assertEqual(result.returncode, 0)
+
+  def testWaitFirstAndTimeout(self):
+    """Waiting can stop at the first completion or after a timeout."""
+    fast = self._Start(['true'])
+    slow = self._Start(['sleep', '10'])
+    done, pending = cros_build_lib.WaitForCommands(
+        [fast, slow], return_when=cros_build_lib.FIRST_COMPLETED)
+    self.assertEqual((done, pending), ([fast], [slow]))
+    self.assertEqual(slow.Wait(timeout=0.1), None)
+    slow.Kill()
+    self.assertTrue(slow.Done())
+    self.assertRaises(cros_build_lib.RunCommandError, slow.Result)
+
+  def testInput(self):
+    """Input larger than a pipe buffer is fed to the command."""
+    data = 'line\n' * 100000
+    self.assertEqual(self._Start(['cat'], input=data).Wait().output, data)
+
+  def testErrors(self):
+    """Failures raise RunCommandError unless error_code_ok is set."""
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      self._Start('exit 2').Wait)
+    result = self._Start('exit 2', error_code_ok=True).Wait()
+    self.assertEqual(result.returncode, 2)
+    self.assertRaises(cros_build_lib.RunCommandError, self._Start,
+                      ['/does/not/exist'])
+
+  def testStreamOutput(self):
+    """Output is streamed line by line, including a final partial line."""
+    commands = [self._Start('echo a%d; sleep 0.1; printf b%d' % (i, i))
+                for i in range(2)]
+    lines = {}
+    for command, name, line in cros_build_lib.StreamCommandOutput(commands):
+      self.assertEqual(name, 'stdout')
+      lines.setdefault(command, []).append(line)
+    for i, command in enumerate(commands):
+      self.assertEqual(lines[command], ['a%d\n' % i, 'b%d' % i])
+      self.assertEqual(command.Result().output, 'a%d\nb%d' % (i, i))
+
 
 def _ForceLoggingLevel(functor):
   def inner(*args, **kwds):
@@ -575,6 +668,142 @@ class TestTimedCommand(cros_test_lib.MoxTestCase):
                                 timed_log_msg='msg! %s', shell=True)
 
 
+class TestCreateTarball(cros_test_lib.TempDirTestCase):
+  """Tests for CreateTarball and its parallel compression."""
+
+  def setUp(self):
+    self.src = os.path.join(self.tempdir, 'src')
+    self.data = ''.join('line %d\n' % i for i in range(100000))
+    osutils.WriteFile(os.path.join(self.src, 'file'), self.data, makedirs=True)
+    # Use small blocks so the data is compressed in several of them.
+    self._old_block_size = cros_build_lib._PARALLEL_COMPRESS_BLOCK_SIZE
+    cros_build_lib._PARALLEL_COMPRESS_BLOCK_SIZE = 64 * 1024
+
+  def tearDown(self):
+    cros_build_lib._PARALLEL_COMPRESS_BLOCK_SIZE = self._old_block_size
+
+  def _CheckTarball(self, compression, flag, parallel=True):
+    target = os.path.join(self.tempdir, 'out.tar')
+    result = cros_build_lib.CreateTarball(target, self.src,
+                                          compression=compression,
+                                          parallel=parallel, print_cmd=False)
+    self.assertEqual(result.returncode, 0)
+    output = cros_build_lib.RunCommandCaptureOutput(
+        ['tar', flag, '-xOf', target, './file'], print_cmd=False).output
+    self.assertEqual(output, self.data)
+
+  def testParallelGzip(self):
+    """Parallel gzip output decompresses with the standard tools."""
+    self._CheckTarball(cros_build_lib.COMP_GZIP, '-z')
+
+  def testParallelBzip2(self):
+    """Parallel bzip2 output decompresses with the standard tools."""
+    self._CheckTarball(cros_build_lib.COMP_BZIP2, '-j')
+
+  def testParallelProcessCount(self):
+    """A given number of CPUs can be used, even with parallel compressors."""
+    self._CheckTarball(cros_build_lib.COMP_XZ, '-J', parallel=2)
+
+  def testParallelTarFailure(self):
+    """Errors from tar are reported as usual."""
+    target = os.path.join(self.tempdir, 'out.tar.gz')
+    self.assertRaises(cros_build_lib.RunCommandError,
+                      cros_build_lib.CreateTarball, target, self.src,
+                      compression=cros_build_lib.COMP_GZIP, parallel=True,
+                      inputs=['missing'], print_cmd=False,
+                      redirect_stderr=True)
+    result = cros_build_lib.CreateTarball(
+        target, self.src, compression=cros_build_lib.COMP_GZIP, parallel=True,
+        inputs=['missing'], print_cmd=False, redirect_stderr=True,
+        error_code_ok=True)
+    self.assertEqual(result.returncode, 2)
+
+
+class _RangeRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  """Serves the server's |data| honoring single byte ranges."""
+
+  def do_GET(self):
+    data = self.server.data
+    start, end = 0, len(data) - 1
+    if 'Range' in self.headers:
+      first, last = self.headers['Range'].split('=', 1)[1].split('-')
+      start, end = int(first), min(int(last), end)
+      self.server.ranges.append((start, end))
+      self.send_response(206)
+    else:
+      self.send_response(200)
+    self.send_header('Content-Length', str(end - start + 1))
+    self.end_headers()
+    self.wfile.write(data[start:end + 1])
+
+  def log_message(self, *_args):
+    pass
+
+
+class TestFetchUrlInChunks(cros_test_lib.TempDirTestCase):
+  """Tests for FetchUrlInChunks against a local HTTP server."""
+
+  def setUp(self):
+    self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0),
+                                            _RangeRequestHandler)
+    self.server.data = ''.join(chr(i % 251) for i in xrange(10000))
+    self.server.ranges = []
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.daemon = True
+    self.thread.start()
+    self.url = 'http://127.0.0.1:%i/file' % self.server.server_port
+    self.dest = os.path.join(self.tempdir, 'file')
+    self.parts_dir = self.dest + '.parts'
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def _Fetch(self):
+    return cros_build_lib.FetchUrlInChunks(
+        self.url, self.dest, len(self.server.data), validator='"v1"',
+        chunk_size=3000)
+
+  def testFetch(self):
+    """The file is assembled from concurrent range requests."""
+    self.assertEqual(self._Fetch(), self.dest)
+    self.assertEqual(osutils.ReadFile(self.dest), self.server.data)
+    self.assertEqual(sorted(self.server.ranges),
+                     [(0, 2999), (3000, 5999), (6000, 8999), (9000, 9999)])
+    self.assertFalse(os.path.exists(self.parts_dir))
+
+  def testResume(self):
+    """Intact chunks are kept, and partial chunks are resumed."""
+    data = self.server.data
+    os.makedirs(self.parts_dir)
+    osutils.WriteFile(os.path.join(self.parts_dir, '00000'), data[:3000])
+    osutils.WriteFile(os.path.join(self.parts_dir, '00001'), 'x' * 3000)
+    osutils.WriteFile(os.path.join(self.parts_dir, '00002'), data[6000:7000])
+    checksums = {'0': hashlib.sha1(data[:3000]).hexdigest(),
+                 '1': hashlib.sha1(data[3000:6000]).hexdigest()}
+    params = {'url': self.url, 'content_length': len(data),
+              'chunk_size': 3000, 'validator': '"v1"'}
+    osutils.WriteFile(os.path.join(self.parts_dir, 'state.json'),
+                      json.dumps({'params': params, 'checksums': checksums}))
+    self._Fetch()
+    self.assertEqual(osutils.ReadFile(self.dest), data)
+    self.assertEqual(sorted(self.server.ranges),
+                     [(3000, 5999), (7000, 8999), (9000, 9999)])
+
+  def testChangedFile(self):
+    """Progress saved for another version of the file is thrown away."""
+    os.makedirs(self.parts_dir)
+    osutils.WriteFile(os.path.join(self.parts_dir, '00000'), 'x' * 3000)
+    params = {'url': self.url, 'content_length': len(self.server.data),
+              'chunk_size': 3000, 'validator': '"v0"'}
+    checksums = {'0': hashlib.sha1('x' * 3000).hexdigest()}
+    osutils.WriteFile(os.path.join(self.parts_dir, 'state.json'),
+                      json.dumps({'params': params, 'checksums': checksums}))
+    self._Fetch()
+    self.assertEqual(osutils.ReadFile(self.dest), self.server.data)
+    self.assertEqual(len(self.server.ranges), 4)
+
+
 class TestListFiles(cros_test_lib.TempDirTestCase):
 
   def _CreateNestedDir(self, dir_structure):
@@ -769,6 +998,202 @@ class TestContextManagerStack(cros_test_lib.TestCase):
     self.assertEqual(invoked, list(reversed(range(6))))
 
 
+class TestPersistentManifestCache(cros_test_lib.TempDirTestCase):
+
+  def setUp(self):
+    self.cache_dir = os.path.join(self.tempdir, 'cache')
+    self._old_env = os.environ.get(constants.SHARED_CACHE_ENVVAR)
+    os.environ[constants.SHARED_CACHE_ENVVAR] = self.cache_dir
+    self.manifest = os.path.join(self.tempdir, 'manifest.xml')
+    self.include = os.path.join(self.tempdir, 'include.xml')
+    osutils.WriteFile(self.manifest, """
+        <manifest>
+          <include name="include.xml" />
+          <project name="monkeys" remote="foon" revision="master" />
+        </manifest>""")
+    self._WriteInclude('http://localhost')
+
+  def tearDown(self):
+    if self._old_env is None:
+      os.environ.pop(constants.SHARED_CACHE_ENVVAR, None)
+    else:
+      os.environ[constants.SHARED_CACHE_ENVVAR] = self._old_env
+
+  def _WriteInclude(self, fetch):
+    osutils.WriteFile(self.include, """
+        <manifest>
+          <remote name="foon" fetch="%s" />
+        </manifest>""" % fetch)
+
+  def _Parse(self):
+    return git.Manifest(self.manifest, manifest_include_dir=self.tempdir)
+
+  def testCacheReuse(self):
+    """Verify parsed manifests are reused, and invalidated by includes."""
+    first = self._Parse()
+    self.assertEqual(len(os.listdir(os.path.join(self.cache_dir,
+                                                 'manifests'))), 1)
+
+    # Prove the cache is used by parsing being impossible.
+    original = git.Manifest._RunParser
+    try:
+      git.Manifest._RunParser = None
+      second = self._Parse()
+    finally:
+      git.Manifest._RunParser = original
+    self.assertEqual(first.projects, second.projects)
+    self.assertEqual(first.includes, second.includes)
+
+    # Changing an include invalidates the entry.
+    self._WriteInclude('http://otherhost')
+    self.assertEqual(self._Parse().remotes['foon']['fetch'],
+                     'http://otherhost')
+
+  def testCorruptAndPruned(self):
+    """Verify corrupt entries are reparsed, and stale ones are pruned."""
+    self._Parse()
+    manifests_dir = os.path.join(self.cache_dir, 'manifests')
+    entry = os.path.join(manifests_dir, os.listdir(manifests_dir)[0])
+    # Unpickling this fails with an AttributeError.
+    osutils.WriteFile(entry, 'cchromite.lib.git\nNoSuchThing\n.')
+    stale = os.path.join(manifests_dir, 'stale')
+    osutils.WriteFile(stale, '')
+    os.utime(stale, (0, 0))
+    self.assertEqual(self._Parse().remotes['foon']['fetch'],
+                     'http://localhost')
+    self.assertEqual(os.listdir(manifests_dir), [os.path.basename(entry)])
+
+  def testVersion(self):
+    """Verify the cache version is part of the key, and hits don't touch it."""
+    self._Parse()
+    manifests_dir = os.path.join(self.cache_dir, 'manifests')
+    entry = os.path.join(manifests_dir, os.listdir(manifests_dir)[0])
+    original = git.Manifest._PERSISTENT_VERSION
+    try:
+      git.Manifest._PERSISTENT_VERSION = original + 1
+      self._Parse()
+    finally:
+      git.Manifest._PERSISTENT_VERSION = original
+    self.assertEqual(len(os.listdir(manifests_dir)), 2)
+
+    os.utime(entry, (1000, 1000))
+    self._Parse()
+    self.assertEqual(os.stat(entry).st_mtime, 1000)
+
+  def testNoCacheDir(self):
+    """Verify nothing is persisted if no cache dir is configured."""
+    os.environ.pop(constants.SHARED_CACHE_ENVVAR)
+    self._Parse()
+    self.assertFalse(os.path.exists(self.cache_dir))
+
+
+class TestObjectReader(cros_test_lib.TempDirTestCase):
+
+  def setUp(self):
+    git.RunGit(self.tempdir, ['init', '-q'])
+    osutils.WriteFile(os.path.join(self.tempdir, 'foo'), 'foo')
+    git.RunGit(self.tempdir, ['add', 'foo'])
+    git.RunGit(self.tempdir, ['-c', 'user.name=a', '-c', 'user.email=a@b',
+                              'commit', '-q', '-m', 'subject\nline\n\nbody'])
+    self.reader = git.ObjectReader(self.tempdir)
+
+  def tearDown(self):
+    self.reader.Close()
+
+  def _Git(self, *args):
+    return git.RunGit(self.tempdir, list(args)).output.strip()
+
+  def testQueries(self):
+    head = self._Git('rev-parse', 'HEAD')
+    tree = self._Git('rev-parse', 'HEAD^{tree}')
+    self.assertEqual(self.reader.ResolveSha1('HEAD'), head)
+    self.assertEqual(self.reader.GetTree('HEAD'), tree)
+    self.assertEqual(self.reader.GetType(tree), 'tree')
+    self.assertTrue(self.reader.Exists(head))
+    self.assertFalse(self.reader.Exists('0' * 40))
+    self.assertEqual(self.reader.ResolveSha1('refs/heads/nonexistent'), None)
+    self.assertEqual(self.reader.GetCommit('nonexistent'), None)
+    # Misses of specs with spaces must not be mistaken for hits.
+    self.assertEqual(self.reader.ResolveSha1('HEAD:no such'), None)
+    self.assertEqual(self.reader.GetCommit('HEAD:no such'), None)
+    self.assertRaises(ValueError, self.reader.ResolveSha1, 'HEAD\nHEAD')
+
+    commit = self.reader.GetCommit('HEAD')
+    self.assertEqual(commit.sha1, head)
+    self.assertEqual(commit.tree, tree)
+    self.assertEqual(commit.parents, ())
+    self.assertEqual(commit.subject, self._Git('log', '-n1', '--format=%s'))
+    self.assertEqual(commit.message.strip(),
+                     self._Git('log', '-n1', '--format=%B'))
+
+  def testHelpers(self):
+    head = self._Git('rev-parse', 'HEAD')
+    self.assertEqual(git.GetGitRepoRevision(self.tempdir, batch=True), head)
+    self.assertTrue(git.DoesCommitExistInRepo(self.tempdir, head, batch=True))
+    self.assertFalse(git.DoesCommitExistInRepo(self.tempdir, '1' * 40,
+                                               batch=True))
+    self.assertRaises(cros_build_lib.RunCommandError, git.GetGitRepoRevision,
+                      self.tempdir, 'nonexistent', batch=True)
+
+  def testRestart(self):
+    """Verify a dead cat-file process is restarted."""
+    head = self.reader.ResolveSha1('HEAD')
+    self.reader.Close()
+    self.assertEqual(self.reader.ResolveSha1('HEAD'), head)
+
+  def testCloseCached(self):
+    """Verify shared readers are closed, even if a child holds the pipes."""
+    reader = git.ObjectReader.Cached(self.tempdir)
+    self.assertTrue(reader.Exists('HEAD'))
+    proc = reader._procs['--batch-check']
+    pid = os.fork()
+    if not pid:
+      time.sleep(30)
+      os._exit(0)
+    try:
+      start = time.time()
+      git.ObjectReader.CloseCached()
+      self.assertTrue(time.time() - start < 10)
+      self.assertNotEqual(proc.poll(), None)
+      self.assertFalse(git.ObjectReader._instance_cache)
+    finally:
+      os.kill(pid, signal.SIGKILL)
+      os.waitpid(pid, 0)
+
+
+class TestFindProjectFromPath(cros_test_lib.TempDirTestCase):
+
+  def setUp(self):
+    self.root = os.path.realpath(self.tempdir)
+    # Avoid needing a real repo checkout; only the project paths matter.
+    self.manifest = git.ManifestCheckout.__new__(git.ManifestCheckout)
+    self.manifest.root = self.root
+    self.manifest._path_trie = None
+    self.manifest.projects = {}
+    for name, path in (('chromite', 'chromite'), ('platform', 'src/platform'),
+                       ('dev', 'src/platform/dev'), ('third', 'src/third')):
+      self.manifest.projects[name] = {
+          'path': path, 'local_path': os.path.join(self.root, path)}
+
+  def testFind(self):
+    tests = {
+        'chromite': 'chromite',
+        'chromite/lib/git.py': 'chromite',
+        'src/platform/foo': 'platform',
+        'src/platform/dev': 'dev',
+        'src/platform/dev/host/x.py': 'dev',
+        'src/platform/devserver': 'platform',
+        'src/third_party': None,
+        'src': None,
+        os.path.join(self.root, 'src/third/x'): 'third',
+        '/some/other/path': None,
+    }
+    for path, expected in tests.iteritems():
+      self.assertEqual(self.manifest.FindProjectFromPath(path), expected,
+                       msg='path %s' % path)
+    self.assertEqual(self.manifest.FindProjectsFromPaths(tests.keys()), tests)
+
+
 class TestManifestCheckout(cros_test_lib.TempDirTestCase):
 
   def setUp(self):
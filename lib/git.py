@@ -4,6 +4,9 @@
 
 """Common functions for interacting with git and repo."""
 
+import atexit
+import collections
+import cPickle
 import errno
 import hashlib
 import logging
@@ -11,7 +14,9 @@ import os
 import re
 # pylint: disable=W0402
 import string
+import subprocess
 import sys
+import tempfile
 import time
 from xml import sax
 
@@ -50,6 +55,14 @@ def FindRepoCheckoutRoot(path):
     return None
 
 
+def FindGitTopLevel(path):
+  """Returns the top level of the git checkout |path| is in, or None."""
+  git_dir = osutils.FindInPathParents('.git', path)
+  if git_dir:
+    return os.path.dirname(git_dir)
+  return None
+
+
 def FindGitSubmoduleCheckoutRoot(path, remote, url):
   """Get the root of your git submodule checkout, looking up from |path|.
 
@@ -133,21 +146,36 @@ def IsRefsTags(value):
   return value.startswith("refs/tags/")
 
 
-def GetGitRepoRevision(cwd, branch='HEAD'):
+def GetGitRepoRevision(cwd, branch='HEAD', batch=False):
   """Find the revision of a branch.
 
   Defaults to current branch.
+
+  Args:
+    cwd: A directory within the project repo.
+    branch: The revision to resolve.
+    batch: If True, resolve it via the repo's shared ObjectReader rather
+      than spawning git.
   """
+  if batch:
+    sha1 = ObjectReader.Cached(cwd).ResolveSha1(branch)
+    if sha1 is not None:
+      return sha1
+    # Fall through so failures are reported the usual way.
   return RunGit(cwd, ['rev-parse', branch]).output.strip()
 
 
-def DoesCommitExistInRepo(cwd, commit_hash):
+def DoesCommitExistInRepo(cwd, commit_hash, batch=False):
   """Determine if commit object exists in a repo.
 
   Args:
     cwd: A directory within the project repo.
     commit_hash: The hash of the commit object to look for.
+    batch: If True, check via the repo's shared ObjectReader rather than
+      spawning git.
   """
+  if batch:
+    return ObjectReader.Cached(cwd).Exists('%s^{commit}' % commit_hash)
   return 0 == RunGit(cwd, ['rev-list', '-n1', commit_hash],
                      error_code_ok=True).returncode
 
@@ -202,10 +230,22 @@ class Manifest(object):
     default: the attributes of the <default> tag.
     projects: a dictionary keyed by project name containing the attributes of
               each <project> tag.
+    checkouts_by_path: a dictionary keyed by project path containing the
+              attributes of each <project> tag.  Unlike |projects|, this
+              includes every checkout of projects listed more than once.
   """
 
   _instance_cache = {}
 
+  # The attributes persisted to the on-disk cache of parsed manifests.
+  _PERSISTENT_ATTRS = ('default', 'projects', 'checkouts_by_path', 'remotes',
+                       'includes', 'revision')
+  # Bump this whenever the format or meaning of the persisted state changes.
+  _PERSISTENT_VERSION = 1
+  # Persisted manifests older than this many seconds are deleted; those still
+  # in use are then just parsed and persisted again.
+  _PERSISTENT_MAX_AGE = 7 * 24 * 60 * 60
+
   def __init__(self, source, manifest_include_dir=None):
     """Initialize this instance.
 
@@ -217,12 +257,16 @@ class Manifest(object):
 
     self.default = {}
     self.projects = {}
+    self.checkouts_by_path = {}
+    self._checkouts = []
     self.remotes = {}
     self.includes = []
     self.revision = None
     self.manifest_include_dir = manifest_include_dir
-    self._RunParser(source)
-    self.includes = tuple(self.includes)
+    if not self._LoadPersistent(source):
+      self._RunParser(source)
+      self.includes = tuple(self.includes)
+      self._SavePersistent(source)
 
   def _RunParser(self, source, finalize=True):
     parser = sax.make_parser()
@@ -232,8 +276,9 @@ class Manifest(object):
     parser.parse(source)
     if finalize:
       # Rewrite projects mixing defaults in and adding our attributes.
-      for data in self.projects.itervalues():
+      for data in self._checkouts:
         self._FinalizeProjectData(data)
+      self.checkouts_by_path = dict((x['path'], x) for x in self._checkouts)
 
   def _ProcessElement(self, name, attrs):
     """Stores the default manifest properties and per-project overrides."""
@@ -245,6 +290,7 @@ class Manifest(object):
       self.remotes[attrs['name']] = attrs
     elif name == 'project':
       self.projects[attrs['name']] = attrs
+      self._checkouts.append(attrs)
     elif name == 'manifest':
       self.revision = attrs.get('revision')
     elif name == 'include':
@@ -350,6 +396,86 @@ class Manifest(object):
     source.seek(0)
     return md5
 
+  def _GetPersistentPath(self, source):
+    """Returns the on-disk cache path for this manifest, or None.
+
+    The cache lives beneath the shared cache dir; if none is configured,
+    parsed manifests aren't persisted.
+    """
+    cache_dir = os.environ.get(constants.SHARED_CACHE_ENVVAR)
+    if not cache_dir:
+      return None
+    # Project data depends on where includes are resolved from, and for
+    # checkouts, on the root of the checkout.
+    key = (self._PERSISTENT_VERSION, self.__class__.__name__,
+           self._GetManifestHash(source), self.manifest_include_dir,
+           getattr(self, 'root', None))
+    # pylint: disable=E1101
+    key = hashlib.md5(repr(key)).hexdigest()
+    return os.path.join(cache_dir, 'manifests', key)
+
+  def _LoadPersistent(self, source):
+    """Load our parsed state from the on-disk cache if it's still valid.
+
+    Returns:
+      True if the state was loaded, False if the manifest must be parsed.
+    """
+    path = self._GetPersistentPath(source)
+    if path is None:
+      return False
+    try:
+      with open(path, 'rb') as f:
+        sources, state = cPickle.load(f)
+      for include_path, md5 in sources:
+        if self._GetManifestHash(include_path) != md5:
+          return False
+      state = [(attr, state[attr]) for attr in self._PERSISTENT_ATTRS]
+    # A truncated or outdated pickle may fail in just about any way.
+    # pylint: disable=W0703
+    except Exception:
+      return False
+    for attr, value in state:
+      setattr(self, attr, value)
+    return True
+
+  def _SavePersistent(self, source):
+    """Store our parsed state in the on-disk cache; failures are ignored."""
+    path = self._GetPersistentPath(source)
+    if path is None:
+      return
+    cache_dir = os.path.dirname(path)
+    try:
+      sources = tuple((abspath, self._GetManifestHash(abspath))
+                      for (_target, abspath) in self.includes)
+      state = dict((attr, getattr(self, attr))
+                   for attr in self._PERSISTENT_ATTRS)
+      osutils.SafeMakedirs(cache_dir)
+      # Concurrent writers each need their own temporary file.
+      fd, tmp_path = tempfile.mkstemp(prefix='.tmp', dir=cache_dir)
+      try:
+        with os.fdopen(fd, 'wb') as f:
+          cPickle.dump((sources, state), f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+      except:
+        osutils.SafeUnlink(tmp_path)
+        raise
+    except (EnvironmentError, cPickle.PicklingError) as e:
+      logging.debug('Failed caching the parsed manifest to %s: %s', path, e)
+      return
+    self._PrunePersistent(cache_dir)
+
+  @classmethod
+  def _PrunePersistent(cls, cache_dir):
+    """Delete the persisted manifests that were written a while ago."""
+    cutoff = time.time() - cls._PERSISTENT_MAX_AGE
+    for name in os.listdir(cache_dir):
+      path = os.path.join(cache_dir, name)
+      try:
+        if os.stat(path).st_mtime < cutoff:
+          os.unlink(path)
+      except EnvironmentError:
+        pass
+
   @classmethod
   def Cached(cls, source, manifest_include_dir=None):
     """Return an instance, reusing an existing one if possible.
@@ -405,6 +531,7 @@ class ManifestCheckout(Manifest):
     self.manifest_branch = self._GetManifestsBranch(self.root)
     self.default_branch = 'refs/remotes/m/%s' % self.manifest_branch
     self._content_merging = {}
+    self._path_trie = None
     self.configured_groups = self._GetManifestGroups(self.root)
     Manifest.__init__(self, self.manifest_path,
                       manifest_include_dir=manifest_include_dir)
@@ -459,6 +586,42 @@ class ManifestCheckout(Manifest):
           data['local_path'], data['push_remote'])
     return result
 
+  def _GetPathTrie(self):
+    """Returns a trie of path components mapping to the owning projects.
+
+    Each node is a dict keyed by path component; a node that is the root of
+    a project additionally holds the project name under the None key.
+    """
+    if self._path_trie is None:
+      self._path_trie = {}
+      for name, attrs in self.projects.iteritems():
+        node = self._path_trie
+        for component in attrs['path'].split('/'):
+          node = node.setdefault(component, {})
+        node[None] = name
+    return self._path_trie
+
+  def _NormalizeProjectPath(self, path, realpath=os.path.realpath):
+    """Returns |path| made absolute against the root, and normalized."""
+    # Realpath everything sans the target to keep people happy about
+    # how symlinks are handled; exempt the final node since following
+    # through that is unlikely even remotely desired.
+    tmp = realpath(os.path.join(self.root, os.path.dirname(path)))
+    return os.path.normpath(os.path.join(tmp, os.path.basename(path)))
+
+  def _LookupProject(self, path):
+    """Find the owning project of a normalized absolute path via the trie."""
+    if not path.startswith(self.root + '/'):
+      return None
+    node = self._GetPathTrie()
+    project = None
+    for component in path[len(self.root) + 1:].split('/'):
+      node = node.get(component)
+      if node is None:
+        break
+      project = node.get(None, project)
+    return project
+
   def FindProjectFromPath(self, path):
     """Find the associated projects for a given pathway.
 
@@ -470,19 +633,26 @@ class ManifestCheckout(Manifest):
 
     Returns:
       None if no project is found, else the project."""
-    # Realpath everything sans the target to keep people happy about
-    # how symlinks are handled; exempt the final node since following
-    # through that is unlikely even remotely desired.
-    tmp = os.path.join(self.root, os.path.dirname(path))
-    path = os.path.join(os.path.realpath(tmp), os.path.basename(path))
-    path = os.path.normpath(path) + '/'
-    candidates = [(x['path'], name) for name, x in self.projects.iteritems()
-                  if path.startswith(x['local_path'] + '/')]
-    if not candidates:
-      return None
-    # That which has the greatest common path prefix is the owner of
-    # the given pathway, thus we return that.
-    return sorted(candidates)[-1][1]
+    return self._LookupProject(self._NormalizeProjectPath(path))
+
+  def FindProjectsFromPaths(self, paths):
+    """Find the associated projects for many pathways at once.
+
+    See FindProjectFromPath for how pathways are interpreted; resolution of
+    their parent directories is shared across the whole batch.
+
+    Returns:
+      A dictionary mapping each given path to its project, or None.
+    """
+    realpaths = {}
+    def _CachedRealpath(path):
+      if path not in realpaths:
+        realpaths[path] = os.path.realpath(path)
+      return realpaths[path]
+
+    return dict((path, self._LookupProject(
+        self._NormalizeProjectPath(path, realpath=_CachedRealpath)))
+                for path in paths)
 
   def _FinalizeProjectData(self, attrs):
     Manifest._FinalizeProjectData(self, attrs)
@@ -623,6 +793,11 @@ def _GitRepoIsContentMerging(git_repo, remote):
   return False
 
 
+# Git subcommands that may connect to a remote.
+_GIT_REMOTE_COMMANDS = frozenset(['clone', 'fetch', 'ls-remote', 'pull', 'push',
+                                  'remote', 'submodule'])
+
+
 def RunGit(git_repo, cmd, **kwds):
   """RunCommandCaptureOutput wrapper for git commands.
 
@@ -640,11 +815,182 @@ def RunGit(git_repo, cmd, **kwds):
   Returns:
     A CommandResult object."""
   kwds.setdefault('print_cmd', False)
+  # Talking to a remote can leave an ssh process holding our output open.
+  kwds.setdefault('use_pipes', not _GIT_REMOTE_COMMANDS.intersection(cmd))
   cros_build_lib.Debug("RunGit(%r, %r, **%r)", git_repo, cmd, kwds)
   return cros_build_lib.RunCommandCaptureOutput(['git'] + cmd, cwd=git_repo,
                                                 **kwds)
 
 
+CommitInfo = collections.namedtuple(
+    'CommitInfo', ['sha1', 'tree', 'parents', 'subject', 'message'])
+
+
+class ObjectReader(object):
+  """Answers object queries for a git repo over long lived cat-file pipes.
+
+  Spawning git for every rev-parse/log adds up when examining many objects.
+  Instead, this keeps a `git cat-file --batch-check` (for existence, type
+  and sha1 queries) and a `git cat-file --batch` (for object content)
+  running per repository, each started on first use.
+
+  Use Cached() to share readers; they're only shared within a process since
+  interleaved queries from forked children would corrupt the pipes.  Shared
+  readers are closed at exit; others must be closed via Close().
+  """
+
+  _instance_cache = {}
+
+  def __init__(self, git_repo):
+    """Initialize this instance.
+
+    Args:
+      git_repo: Pathway to the git repo (or a directory within it).
+    """
+    self.git_repo = git_repo
+    self._procs = {}
+
+  @classmethod
+  def Cached(cls, git_repo):
+    """Return the reader for |git_repo|, creating it if necessary."""
+    pid = os.getpid()
+    # Readers inherited from the process we were forked from aren't usable.
+    for key in [x for x in cls._instance_cache if x[0] != pid]:
+      cls._instance_cache.pop(key)._Detach()
+    key = (pid, os.path.realpath(git_repo))
+    obj = cls._instance_cache.get(key)
+    if obj is None:
+      obj = cls._instance_cache[key] = cls(git_repo)
+    return obj
+
+  @classmethod
+  def CloseCached(cls):
+    """Close all readers handed out by Cached()."""
+    pid = os.getpid()
+    for key in cls._instance_cache.keys():
+      reader = cls._instance_cache.pop(key)
+      if key[0] == pid:
+        reader.Close()
+      else:
+        reader._Detach()
+
+  def _GetProc(self, mode):
+    proc = self._procs.get(mode)
+    if proc is None or proc.poll() is not None:
+      cmd = ['git', 'cat-file', mode]
+      cros_build_lib.Debug('ObjectReader: starting %r in %s', cmd,
+                           self.git_repo)
+      # pylint: disable=W0212
+      proc = self._procs[mode] = cros_build_lib._Popen(
+          cmd, cwd=self.git_repo, close_fds=True,
+          stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    return proc
+
+  def _Query(self, mode, spec):
+    """Send a single query to the given cat-file mode.
+
+    Returns:
+      (sha1, type, content) for the object, with content being None for
+      --batch-check queries.  None if the object couldn't be found.
+    """
+    if '\n' in spec:
+      raise ValueError('Invalid object spec: %r' % (spec,))
+    proc = self._GetProc(mode)
+    try:
+      proc.stdin.write('%s\n' % spec)
+      proc.stdin.flush()
+      header = proc.stdout.readline()
+    except EnvironmentError as e:
+      if e.errno != errno.EPIPE:
+        raise
+      header = ''
+    if not header:
+      logging.warning('git cat-file %s in %s exited unexpectedly.',
+                      mode, self.git_repo)
+      self.Close()
+      return None
+
+    # Misses are reported as "<spec> missing" (or "ambiguous"); |spec| may
+    # itself contain spaces, so check for those before splitting up a hit.
+    header = header.rstrip('\n')
+    if header.endswith((' missing', ' ambiguous')):
+      return None
+    fields = header.rsplit(' ', 2)
+    if len(fields) != 3:
+      return None
+    sha1, obj_type, size = fields
+    content = None
+    if mode == '--batch':
+      content = proc.stdout.read(int(size))
+      # Each object is followed by a newline.
+      proc.stdout.read(1)
+    return sha1, obj_type, content
+
+  def ResolveSha1(self, spec):
+    """Returns the sha1 |spec| resolves to, or None if it doesn't exist."""
+    result = self._Query('--batch-check', spec)
+    return None if result is None else result[0]
+
+  def GetType(self, spec):
+    """Returns the object type of |spec|, or None if it doesn't exist."""
+    result = self._Query('--batch-check', spec)
+    return None if result is None else result[1]
+
+  def Exists(self, spec):
+    """Returns True if |spec| resolves to an object in the repo."""
+    return self._Query('--batch-check', spec) is not None
+
+  def GetTree(self, spec):
+    """Returns the tree sha1 of the commit |spec|, or None."""
+    return self.ResolveSha1('%s^{tree}' % spec)
+
+  def GetCommit(self, spec):
+    """Returns a CommitInfo for the commit |spec|, or None.
+
+    Tags are peeled to the commit they point at.  The subject is derived
+    the same way as `git log --format=%s` does.
+    """
+    result = self._Query('--batch', '%s^{commit}' % spec)
+    if result is None:
+      return None
+    sha1, _obj_type, content = result
+    headers, _, message = content.partition('\n\n')
+    tree, parents = None, []
+    for line in headers.splitlines():
+      if line.startswith('tree '):
+        tree = line[5:]
+      elif line.startswith('parent '):
+        parents.append(line[7:])
+    subject = ' '.join(x.strip() for x in
+                       message.split('\n\n', 1)[0].splitlines())
+    return CommitInfo(sha1, tree, tuple(parents), subject, message)
+
+  def Close(self):
+    """Shut down any running cat-file processes."""
+    for proc in self._procs.itervalues():
+      proc.stdin.close()
+      proc.stdout.close()
+      # Forked children may still hold stdin open, so cat-file can't be
+      # relied upon to see EOF.
+      proc.terminate()
+      proc.wait()
+    self._procs.clear()
+
+  def _Detach(self):
+    """Drop the cat-file processes of the process we were forked from.
+
+    Only our copies of the pipes are closed; the processes are left alone
+    for their owner to shut down.
+    """
+    for proc in self._procs.itervalues():
+      proc.stdin.close()
+      proc.stdout.close()
+    self._procs.clear()
+
+
+atexit.register(ObjectReader.CloseCached)
+
+
 def GetProjectUserEmail(git_repo):
   """Get the email configured for the project ."""
   output = RunGit(git_repo, ['var', 'GIT_COMMITTER_IDENT']).output
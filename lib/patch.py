@@ -488,15 +488,10 @@ class GitRepoPatch(object):
       return self.sha1
 
     def _PullData(rev):
-      ret = git.RunGit(
-          git_repo, ['log', '--pretty=format:%H%x00%s%x00%B', '-n1', rev],
-          error_code_ok=True)
-      if ret.returncode != 0:
+      commit = git.ObjectReader.Cached(git_repo).GetCommit(rev)
+      if commit is None:
         return None, None, None
-      output = ret.output.split('\0')
-      if len(output) != 3:
-        return None, None, None
-      return [x.strip() for x in output]
+      return commit.sha1, commit.subject.strip(), commit.message.strip()
 
     if self.sha1 is not None:
       # See if we've already got the object.
@@ -5,13 +5,17 @@
 
 """Library containing functions to access a remote test device."""
 
+import binascii
 import logging
 import os
+import pipes
+import re
 import shutil
 import stat
 import time
 
 from chromite.lib import cros_build_lib
+from chromite.lib import locking
 
 
 _path = os.path.dirname(os.path.realpath(__file__))
@@ -26,6 +30,8 @@ REBOOT_SSH_CONNECT_ATTEMPTS = 2
 CHECK_INTERVAL = 5
 DEFAULT_SSH_PORT = 22
 SSH_ERROR_CODE = 255
+# Seconds an idle shared ssh connection is kept around for.
+SSH_CONTROL_PERSIST = 60
 
 
 def CompileSSHConnectSettings(ConnectTimeout=30, ConnectionAttempts=4):
@@ -43,7 +49,7 @@ class RemoteAccess(object):
   """Provides access to a remote test machine."""
 
   def __init__(self, remote_host, tempdir, port=DEFAULT_SSH_PORT,
-               debug_level=logging.DEBUG):
+               debug_level=logging.DEBUG, multiplex=True):
     """Construct the object.
 
     Arguments:
@@ -53,6 +59,9 @@ class RemoteAccess(object):
                It's the responsibility of the caller to remove it.
       port: The ssh port of the test machine to connect to.
       debug_level: Logging level to use for all RunCommand invocations.
+      multiplex: Whether to share a single ssh connection between all the
+                 remote commands, rather than connecting for each of them.
+                 Call Close() when done with the device.
     """
     self.tempdir = tempdir
     self.remote_host = remote_host
@@ -61,18 +70,63 @@ class RemoteAccess(object):
     self.private_key = os.path.join(tempdir, os.path.basename(TEST_PRIVATE_KEY))
     shutil.copyfile(TEST_PRIVATE_KEY, self.private_key)
     os.chmod(self.private_key, stat.S_IRUSR)
+    self.control_path = None
+    if multiplex:
+      self.control_path = os.path.join(tempdir, 'ssh-master')
 
   @property
   def target_ssh_url(self):
     return 'root@%s' % self.remote_host
 
-  def _GetSSHCmd(self, connect_settings=None):
+  def _GetSSHCmd(self, connect_settings=None, master=False):
     if connect_settings is None:
       connect_settings = CompileSSHConnectSettings()
 
-    return (['ssh', '-p', str(self.port)] +
-             connect_settings +
-             ['-i', self.private_key, ])
+    cmd = ['ssh', '-p', str(self.port)]
+    if self.control_path:
+      # ssh uses the first value given for an option, so these go first.  If
+      # the master connection is gone, ssh falls back to connecting directly.
+      cmd += ['-o', 'ControlPath=%s' % self.control_path]
+      if master:
+        cmd += ['-o', 'ControlMaster=yes',
+                '-o', 'ControlPersist=%i' % SSH_CONTROL_PERSIST]
+      else:
+        cmd += ['-o', 'ControlMaster=no']
+    return cmd + connect_settings + ['-i', self.private_key, ]
+
+  def _StartMaster(self, connect_settings=None, debug_level=None):
+    """Starts the connection that the other ssh invocations share.
+
+    Noop if multiplexing is disabled, or the connection is already up.  The
+    connection is closed by Close(), or after SSH_CONTROL_PERSIST seconds
+    without any users.
+
+    Raises:
+      RunCommandError if ssh could not connect to the device.
+    """
+    if not self.control_path:
+      return
+
+    # deploy_chrome talks to the device from several processes at once.
+    with locking.FileLock('%s.lock' % self.control_path, verbose=False) as lock:
+      lock.write_lock()
+      if os.path.exists(self.control_path):
+        return
+      ssh_cmd = self._GetSSHCmd(connect_settings, master=True)
+      # Let ssh go to the background once connected.  Its output is not read
+      # through pipes, since the backgrounded ssh would hold them open.
+      ssh_cmd += ['-N', '-f', self.target_ssh_url]
+      cros_build_lib.RunCommand(
+          ssh_cmd, debug_level=debug_level or self.debug_level,
+          redirect_stdout=True, redirect_stderr=True)
+
+  def Close(self):
+    """Closes the connection shared between the remote commands, if any."""
+    if self.control_path and os.path.exists(self.control_path):
+      cros_build_lib.RunCommand(
+          ['ssh', '-o', 'ControlPath=%s' % self.control_path, '-O', 'exit',
+           self.target_ssh_url], debug_level=self.debug_level,
+          redirect_stdout=True, redirect_stderr=True, error_code_ok=True)
 
   def RemoteSh(self, cmd, connect_settings=None, error_code_ok=False,
                ssh_error_ok=False, debug_level=None):
@@ -102,8 +156,9 @@ class RemoteAccess(object):
     ssh_cmd = self._GetSSHCmd(connect_settings)
     ssh_cmd += [self.target_ssh_url, cmd]
     try:
+      self._StartMaster(connect_settings, debug_level)
       result = cros_build_lib.RunCommandCaptureOutput(
-          ssh_cmd, debug_level=debug_level)
+          ssh_cmd, debug_level=debug_level, use_pipes=True)
     except cros_build_lib.RunCommandError as e:
       if ((e.result.returncode == SSH_ERROR_CODE and ssh_error_ok) or
           (e.result.returncode and e.result.returncode != SSH_ERROR_CODE
@@ -114,6 +169,65 @@ class RemoteAccess(object):
 
     return result
 
+  def BatchRemoteSh(self, cmds, connect_settings=None, error_code_ok=False,
+                    ssh_error_ok=False, debug_level=None):
+    """Run several sh commands on the remote device in a single round trip.
+
+    The commands run one after the other, each in its own subshell, whether
+    or not the previous ones succeeded.
+
+    Arguments:
+      cmds: A list of command strings to run.
+      connect_settings, error_code_ok, ssh_error_ok, debug_level: See
+        RemoteSh.  Errors are checked for each command.
+
+    Returns:
+      A list of CommandResult objects, one for each command.  If ssh failed
+      partway through, the commands that did not finish get a returncode of
+      255.
+
+    Raises:  RunCommandError for the first command with an error that is not
+             ignored through the error_code_ok and ssh_error_ok flags.
+    """
+    # A marker that the output of the commands is unlikely to contain.
+    marker = 'REMOTE_SH_%s' % binascii.hexlify(os.urandom(8))
+    script = []
+    for i, cmd in enumerate(cmds):
+      # Newlines let commands end in comments or without a semicolon.
+      script.append("(\n%s\n)\nprintf '\\n%s %i %%i\\n' $?\n"
+                    "printf '\\n%s %i\\n' >&2\n" % (cmd, marker, i, marker, i))
+    result = self.RemoteSh(''.join(script), connect_settings=connect_settings,
+                           error_code_ok=True, ssh_error_ok=True,
+                           debug_level=debug_level)
+
+    results = []
+    output, error = result.output, result.error
+    for i, cmd in enumerate(cmds):
+      out_match = re.search(r'\n%s %i (\d+)\n' % (marker, i), output)
+      err_match = re.search(r'\n%s %i\n' % (marker, i), error)
+      if out_match and err_match:
+        returncode = int(out_match.group(1))
+        cmd_output = output[:out_match.start()]
+        output = output[out_match.end():]
+        cmd_error = error[:err_match.start()]
+        error = error[err_match.end():]
+      else:
+        # ssh died before this command completed.
+        returncode, cmd_output, cmd_error = result.returncode, output, error
+        output = error = ''
+      results.append(cros_build_lib.CommandResult(
+          cmd=cmd, output=cmd_output, error=cmd_error, returncode=returncode))
+
+    for cmd_result in results:
+      if ((cmd_result.returncode == SSH_ERROR_CODE and not ssh_error_ok) or
+          (cmd_result.returncode and cmd_result.returncode != SSH_ERROR_CODE
+           and not error_code_ok)):
+        raise cros_build_lib.RunCommandError(
+            'Command %r failed on %s' % (cmd_result.cmd, self.remote_host),
+            cmd_result)
+
+    return results
+
   def LearnBoard(self):
     """Grab the board reported by the remote device.
 
@@ -185,6 +299,7 @@ class RemoteAccess(object):
     if not debug_level:
       debug_level = self.debug_level
 
+    self._StartMaster(debug_level=debug_level)
     ssh_cmd = ' '.join(self._GetSSHCmd())
     rsync_cmd = ['rsync', '--recursive', '--links', '--perms', '--verbose',
                  '--times', '--compress', '--omit-dir-times',
@@ -203,3 +318,34 @@ class RemoteAccess(object):
     if sudo:
       rc_func = cros_build_lib.SudoRunCommand
     return rc_func(rsync_cmd, debug_level=debug_level, print_cmd=verbose)
+
+  def TarCopy(self, src, dest, verbose=False, debug_level=None, sudo=False):
+    """Copy a directory to the remote device as a single tar stream.
+
+    Unlike Rsync, this does not compare anything with what is already on the
+    device; everything is sent, gzip compressed, through one ssh pipe.  That
+    is faster when most of |src| is missing or different on the device.
+
+    Arguments:
+      src: The local src directory.
+      dest: The remote dest directory.  Created if missing.
+      verbose: If set, print the command used for the transfer.
+      debug_level: See cros_build_lib.RunCommand documentation.
+      sudo: If set, read |src| via sudo.
+    """
+    if not debug_level:
+      debug_level = self.debug_level
+
+    self._StartMaster(debug_level=debug_level)
+    comp = cros_build_lib.FindCompressor(cros_build_lib.COMP_GZIP)
+    extract_cmd = 'mkdir -p %(dest)s && tar -C %(dest)s -xzpf -' % {
+        'dest': pipes.quote(dest)}
+    ssh_cmd = self._GetSSHCmd() + [self.target_ssh_url, extract_cmd]
+    cmd = ('set -o pipefail; tar -C %s --exclude=.svn -cf - . | %s -1 | %s'
+           % (pipes.quote(src), pipes.quote(comp),
+              ' '.join(pipes.quote(x) for x in ssh_cmd)))
+    if sudo:
+      return cros_build_lib.SudoRunCommand(cmd, debug_level=debug_level,
+                                           print_cmd=verbose)
+    return cros_build_lib.RunCommand(cmd, shell=True, debug_level=debug_level,
+                                     print_cmd=verbose)
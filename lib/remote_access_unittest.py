@@ -13,6 +13,7 @@ sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
 from chromite.lib import cros_build_lib
 from chromite.lib import cros_build_lib_unittest
 from chromite.lib import cros_test_lib
+from chromite.lib import osutils
 from chromite.lib import partial_mock
 from chromite.lib import remote_access
 
@@ -116,5 +117,99 @@ class CheckIfRebootedTest(RemoteAccessTest):
     self.assertRaises(Exception, self.host._CheckIfRebooted)
 
 
+class MultiplexTest(cros_build_lib_unittest.RunCommandTempDirTestCase):
+  """Tests for sharing one ssh connection between the remote commands."""
+
+  def setUp(self):
+    self.host = remote_access.RemoteAccess('foon', self.tempdir)
+
+  def testStartMaster(self):
+    """Commands go through the master connection, which is started once."""
+    self.host.RemoteSh('true')
+    self.assertCommandContains(['-o', 'ControlMaster=yes', '-N', '-f'])
+    self.assertCommandContains(['-o', 'ControlMaster=no', 'root@foon', 'true'])
+
+    # Pretend the master came up.
+    osutils.Touch(self.host.control_path)
+    calls = self.rc.patched['RunCommand'].call_args_list
+    count = len(calls)
+    self.host.RemoteSh('true')
+    self.assertEqual(len(calls), count + 1)
+
+  def testMasterFailure(self):
+    """Failing to connect is reported like any ssh failure."""
+    self.rc.AddCmdResult(partial_mock.In('-N'),
+                         returncode=remote_access.SSH_ERROR_CODE)
+    self.assertRaises(cros_build_lib.RunCommandError, self.host.RemoteSh,
+                      'true')
+    result = self.host.RemoteSh('true', ssh_error_ok=True)
+    self.assertEqual(result.returncode, remote_access.SSH_ERROR_CODE)
+
+  def testClose(self):
+    """Close() shuts down the master connection."""
+    self.host.Close()
+    self.assertCommandContains(['-O', 'exit'], expected=False)
+    osutils.Touch(self.host.control_path)
+    self.host.Close()
+    self.assertCommandContains(['-O', 'exit'])
+
+  def testNoMultiplex(self):
+    """No master connection is used if multiplexing is turned off."""
+    host = remote_access.RemoteAccess('foon', self.tempdir, multiplex=False)
+    host.RemoteSh('true')
+    self.assertCommandContains(['-N'], expected=False)
+    self.assertCommandContains(['ControlMaster=no'], expected=False)
+
+
+class BatchRemoteShTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for running several commands in one round trip."""
+
+  def setUp(self):
+    self.host = remote_access.RemoteAccess('foon', self.tempdir)
+    # Run the generated script locally instead of over ssh.
+    self.PatchObject(
+        remote_access.RemoteAccess, 'RemoteSh', autospec=True,
+        side_effect=lambda _inst, cmd, **_kwargs:
+            cros_build_lib.RunCommandCaptureOutput(
+                ['sh', '-c', cmd], print_cmd=False))
+
+  def testResults(self):
+    """Each command gets its own output, error and returncode."""
+    results = self.host.BatchRemoteSh(
+        ['echo foo', 'printf bar; echo baz >&2; exit 3', 'echo done # comment'],
+        error_code_ok=True)
+    self.assertEqual([x.output for x in results], ['foo\n', 'bar', 'done\n'])
+    self.assertEqual([x.error for x in results], ['', 'baz\n', ''])
+    self.assertEqual([x.returncode for x in results], [0, 3, 0])
+
+  def testError(self):
+    """Failing commands raise unless error_code_ok is set."""
+    self.assertRaises(cros_build_lib.RunCommandError, self.host.BatchRemoteSh,
+                      ['true', 'false'])
+
+
+class TarCopyTest(cros_test_lib.MockTempDirTestCase):
+  """Tests for streaming a directory to the device with tar."""
+
+  def testTarCopy(self):
+    """The directory is recreated on the other end of the ssh pipe."""
+    host = remote_access.RemoteAccess('foon', self.tempdir, multiplex=False)
+    # Stand in for ssh by running the remote command locally.
+    self.PatchObject(host, '_GetSSHCmd',
+                     return_value=['sh', '-c', 'sh -c "$2"', 'ssh'])
+    src = os.path.join(self.tempdir, 'src')
+    dest = os.path.join(self.tempdir, 'dest dir')
+    osutils.WriteFile(os.path.join(src, 'lib', 'libfoo.so'), 'foo',
+                      makedirs=True)
+    osutils.WriteFile(os.path.join(src, '.svn', 'entries'), '', makedirs=True)
+    os.chmod(os.path.join(src, 'lib', 'libfoo.so'), 0755)
+    host.TarCopy(src, dest)
+    self.assertEqual(
+        osutils.ReadFile(os.path.join(dest, 'lib', 'libfoo.so')), 'foo')
+    self.assertEqual(
+        os.stat(os.path.join(dest, 'lib', 'libfoo.so')).st_mode & 0777, 0755)
+    self.assertFalse(os.path.exists(os.path.join(dest, '.svn')))
+
+
 if __name__ == '__main__':
   cros_test_lib.main()
@@ -6,13 +6,13 @@
 import json
 import os
 import parallel_emerge
-import portage
 import re
 import shutil
 import sys
 import tempfile
 import functools
 
+from chromite.buildbot import portage_utilities
 from chromite.lib import cros_build_lib
 from chromite.lib import osutils
 
@@ -85,8 +85,7 @@ class PatchReporter(object):
 
   def _ObservePatches(self, temp_space, deps_map):
     for cpv in deps_map:
-      cat, name, _, _ = portage.versions.catpkgsplit(cpv)
-      if self.Ignored("%s/%s" % (cat, name)):
+      if self.Ignored(portage_utilities.SplitCPV(cpv).cp):
         continue
       cmd = self.equery_cmd[:]
       cmd.extend(['which', cpv])
@@ -123,7 +122,7 @@ class PatchReporter(object):
     for line in lines:
       cat, pkg, _, patchmsg = line.split(':')
       cat = os.path.basename(cat)
-      _, pkg, _, _ = portage.versions.catpkgsplit('x-x/%s' % pkg)
+      pkg = portage_utilities.SplitPV(pkg).package
       patch_name = re.sub(patch_regex, r'\1', patchmsg)
       patches.append("%s/%s %s" % (cat, pkg, patch_name))
 
@@ -4,10 +4,11 @@
 # found in the LICENSE file.
 
 import json
-import portage
 import sys
 from parallel_emerge import DepGraphGenerator
 
+from chromite.buildbot import portage_utilities
+
 def FlattenDepTree(deptree, pkgtable=None, parentcpv=None):
   """
   Turn something like this (the parallel_emerge DepsTree format):
@@ -50,12 +51,13 @@ def FlattenDepTree(deptree, pkgtable=None, parentcpv=None):
     pkgtable = {}
   for cpv, record in deptree.items():
     if cpv not in pkgtable:
-      cat, nam, ver, rev = portage.versions.catpkgsplit(cpv)
+      split = portage_utilities.SplitCPV(cpv)
       pkgtable[cpv] = {"deps": [],
                        "rev_deps": [],
-                       "name": nam,
-                       "category": cat,
-                       "version": "%s-%s" % (ver, rev),
+                       "name": split.package,
+                       "category": split.category,
+                       "version": "%s-%s" % (split.version_no_rev,
+                                             split.rev or "r0"),
                        "full_name": cpv,
                        "action": record["action"]}
     # If we have a parent, that is a rev_dep for the current package.
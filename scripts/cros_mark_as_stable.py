@@ -6,6 +6,7 @@
 
 """This module uprevs a given package's ebuild to the next revision."""
 
+import multiprocessing
 import optparse
 import os
 import sys
@@ -229,9 +230,16 @@ def main(_argv):
       '%s/third_party/coreos-overlay' % options.srcroot: []
     }
 
+  source_ids = {}
   if command == 'commit':
     portage_utilities.BuildEBuildDictionary(
-      overlays, options.all, package_list)
+      overlays, options.all, package_list,
+      processes=multiprocessing.cpu_count())
+    # Resolve the source commits of every package up front, one git query
+    # per source checkout, rather than several per package while uprevving.
+    source_ids = portage_utilities.ResolveSourceIds(
+        [e for ebuilds in overlays.itervalues() for e in ebuilds],
+        options.srcroot, processes=multiprocessing.cpu_count())
 
   manifest = git.ManifestCheckout.Cached(options.srcroot)
 
@@ -239,25 +247,14 @@ def main(_argv):
   revved_packages = []
   new_package_atoms = []
 
-  # Slight optimization hack: process the chromiumos overlay before any other
-  # cros-workon overlay first so we can do background cache generation in it.
-  # A perfect solution would walk all the overlays, figure out any dependencies
-  # between them (with layout.conf), and then process them in dependency order.
-  # However, this operation isn't slow enough to warrant that level of
-  # complexity, so we'll just special case the main overlay.
-  #
-  # Similarly, generate the cache in the portage-stable tree asap.  We know
-  # we won't have any cros-workon packages in there, so generating the cache
-  # is the only thing it'll be doing.  The chromiumos overlay instead might
-  # have revbumping to do before it can generate the cache.
-  keys = overlays.keys()
-  for overlay in ('/third_party/coreos-overlay',
-                  '/third_party/portage-stable'):
-    for k in keys:
-      if k.endswith(overlay):
-        keys.remove(k)
-        keys.insert(0, k)
-        break
+  # Walk the overlays in dependency order (masters from layout.conf first),
+  # queueing the cache generation of each one as soon as its uprevs are
+  # committed, so that it runs in the background while the next overlay is
+  # being uprevved.  Overlays with nothing to uprev, like portage-stable, go
+  # as early as their masters allow since generating the cache is the only
+  # thing they'll be doing.
+  keys = portage_utilities.SortOverlaysByDependency(
+      overlays.keys(), key=lambda x: (bool(overlays[x]), x))
 
   with parallel.BackgroundTaskRunner(portage_utilities.RegenCache) as queue:
     for overlay in keys:
@@ -295,7 +292,8 @@ def main(_argv):
           if options.verbose:
             cros_build_lib.Info('Working on %s', ebuild.package)
           try:
-            new_package = ebuild.RevWorkOnEBuild(options.srcroot)
+            new_package = ebuild.RevWorkOnEBuild(options.srcroot,
+                                                 source_ids=source_ids)
             if new_package:
               revved_packages.append(ebuild.package)
               new_package_atoms.append('=%s' % new_package)
@@ -308,7 +306,8 @@ def main(_argv):
         if cros_build_lib.IsInsideChroot():
           # Regenerate caches if need be.  We do this all the time to
           # catch when users make changes without updating cache files.
-          queue.put([overlay])
+          # Only packages changed since the last regeneration are redone.
+          queue.put([overlay, True, keys])
 
   if command == 'commit':
     if cros_build_lib.IsInsideChroot():
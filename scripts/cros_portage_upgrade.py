@@ -17,6 +17,7 @@ import shutil
 import tempfile
 
 from chromite.buildbot import constants
+from chromite.buildbot import portage_utilities
 from chromite.lib import cros_build_lib
 from chromite.lib import osutils
 from chromite.lib import operation
@@ -447,19 +448,45 @@ class Upgrader(object):
                                       portdir=self._upstream_repo,
                                       portage_configroot=self._emptydir)
 
-    # Point equery to the upstream source to get latest version for keywords.
-    equery = ['equery', 'which', pkg]
-    cmd_result = cros_build_lib.RunCommand(
-        equery, extra_env=envvars, print_cmd=self._verbose,
-        error_code_ok=True, redirect_stdout=True, combine_stdout_stderr=True)
+    # Point Portage to the upstream source to get latest version for keywords.
+    resolver = portage_utilities.PortageResolver.Cached(
+        extra_env=envvars, overlays=[self._upstream_repo])
+    try:
+      ebuild_path = resolver.Resolve([pkg])[pkg][1]
+    except cros_build_lib.RunCommandError as e:
+      logging.warning('Failed to resolve %s upstream: %s', pkg, e)
+      return None
 
-    if cmd_result.returncode == 0:
-      ebuild_path = cmd_result.output.strip()
+    if ebuild_path:
       (_overlay, cat, _pn, pv) = self._SplitEBuildPath(ebuild_path)
       return os.path.join(cat, pv)
     else:
       return None
 
+  def _PrefetchUpstreamCPVs(self, pinfolist):
+    """Resolve the upstream cpvs _UpgradePackage needs for all of |pinfolist|.
+
+    This takes one Portage session per keyword setting; the results are
+    remembered, so the _FindUpstreamCPV calls for each package are then free.
+    If Portage fails on the batch, the packages are left to be looked up one
+    by one, so the error is reported for the package that caused it.
+    """
+    pkgs = [pinfo.package for pinfo in pinfolist
+            if pinfo.package and pinfo.package != WORLD_TARGET]
+    cpvs = [pinfo.cpv for pinfo in pinfolist
+            if pinfo.cpv and pinfo.cpv != WORLD_TARGET]
+    for unstable_ok, atoms in ((False, pkgs), (True, pkgs + cpvs)):
+      if atoms:
+        envvars = self._GenPortageEnvvars(self._curr_arch, unstable_ok,
+                                          portdir=self._upstream_repo,
+                                          portage_configroot=self._emptydir)
+        resolver = portage_utilities.PortageResolver.Cached(
+            extra_env=envvars, overlays=[self._upstream_repo])
+        try:
+          resolver.Resolve(atoms)
+        except cros_build_lib.RunCommandError:
+          pass
+
   def _GetBoardCmd(self, cmd):
     """Return the board-specific version of |cmd|, if applicable."""
     if cmd in self.BOARD_CMDS:
@@ -492,14 +519,19 @@ class Upgrader(object):
     """Returns current cpv on |_curr_board| that matches |pkg|, or None."""
     envvars = self._GenPortageEnvvars(self._curr_arch, unstable_ok=False)
 
-    equery = self._GetBoardCmd(self.EQUERY_CMD)
-    cmd = [equery, 'which', pkg]
-    cmd_result = cros_build_lib.RunCommand(
-        cmd, error_code_ok=True, extra_env=envvars, print_cmd=False,
-        redirect_stdout=True, combine_stdout_stderr=True)
+    board = self._curr_board
+    if board == self.HOST_BOARD:
+      board = None
+    overlays = [self._stable_repo] if self._stable_repo else []
+    resolver = portage_utilities.PortageResolver.Cached(
+        board=board, extra_env=envvars, overlays=overlays)
+    try:
+      ebuild_path = resolver.Resolve([pkg])[pkg][1]
+    except cros_build_lib.RunCommandError as e:
+      logging.warning('Failed to resolve %s: %s', pkg, e)
+      return None
 
-    if cmd_result.returncode == 0:
-      ebuild_path = cmd_result.output.strip()
+    if ebuild_path:
       (_overlay, cat, _pn, pv) = self._SplitEBuildPath(ebuild_path)
       return os.path.join(cat, pv)
     else:
@@ -1199,6 +1231,7 @@ class Upgrader(object):
 
     try:
       upgrades_this_run = False
+      self._PrefetchUpstreamCPVs(pinfolist)
       for pinfo in pinfolist:
         if self._UpgradePackage(pinfo):
           self._upgrade_cnt += 1
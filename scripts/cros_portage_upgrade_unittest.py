@@ -1837,7 +1837,6 @@ class TreeInspectTest(CpuTestBase):
                                               unstable_ok=False)
     mocked_upgrader._GenPortageEnvvars(mocked_upgrader._curr_arch,
                                        unstable_ok=False).AndReturn(envvars)
-    mocked_upgrader._GetBoardCmd('equery').AndReturn('equery')
 
     if ebuild_expect:
       ebuild_path = eroot + ebuild_expect
@@ -1884,6 +1883,37 @@ class TreeInspectTest(CpuTestBase):
     result = self._TestFindCurrentCPV(cp, ebuild)
     self.assertEquals(result, cpv)
 
+  def testFindCPVResolveError(self):
+    """Should find None when Portage fails to resolve the package."""
+    mocked_upgrader = self._MockUpgrader(_curr_board=None,
+                                         _upstream_repo='/upstream',
+                                         _emptydir='empty-dir')
+
+    # Add test-specific mocks/stubs
+    self.mox.StubOutWithMock(cpu.portage_utilities.PortageResolver, 'Resolve')
+
+    # Replay script
+    error = cros_build_lib.RunCommandError('failed', None)
+    mocked_upgrader._GenPortageEnvvars(mocked_upgrader._curr_arch, False,
+                                       portdir='/upstream',
+                                       portage_configroot='empty-dir',
+                                       ).AndReturn({'ACCEPT_KEYWORDS': 'x'})
+    cpu.portage_utilities.PortageResolver.Resolve(['dev-libs/A']).AndRaise(
+        error)
+    mocked_upgrader._GenPortageEnvvars(mocked_upgrader._curr_arch,
+                                       unstable_ok=False).AndReturn(
+                                           {'ACCEPT_KEYWORDS': 'y'})
+    cpu.portage_utilities.PortageResolver.Resolve(['dev-libs/A']).AndRaise(
+        error)
+    self.mox.ReplayAll()
+
+    # Verify
+    self.assertEquals(
+        cpu.Upgrader._FindUpstreamCPV(mocked_upgrader, 'dev-libs/A'), None)
+    self.assertEquals(
+        cpu.Upgrader._FindCurrentCPV(mocked_upgrader, 'dev-libs/A'), None)
+    self.mox.VerifyAll()
+
 ####################
 ### RunBoardTest ###
 ####################
@@ -2333,6 +2363,7 @@ class UpgradePackagesTest(CpuTestBase):
 
     # Replay script
     upgrades_this_run = False
+    mocked_upgrader._PrefetchUpstreamCPVs(pinfolist)
     for pinfo in pinfolist:
       pkg_result = bool(pinfo.upgraded_cpv)
       mocked_upgrader._UpgradePackage(pinfo).InAnyOrder('up'
@@ -67,6 +67,8 @@ def FetchRemoteTarballs(storage_dir, urls):
         return parsed.path
       continue
     content_length = 0
+    accept_ranges = False
+    validator = None
     print 'Attempting download: %s' % url
     result = cros_build_lib.RunCurl(
           ['-I', url], redirect_stdout=True, redirect_stderr=True,
@@ -75,12 +77,20 @@ def FetchRemoteTarballs(storage_dir, urls):
     for header in result.output.splitlines():
       # We must walk the output to find the string '200 OK' for use cases where
       # a proxy is involved and may have pushed down the actual header.
-      if header.find('200') != -1:
-        successful = True
-      elif header.lower().startswith("content-length:"):
-        content_length = int(header.split(":", 1)[-1].strip())
-        if successful:
-          break
+      if ':' not in header:
+        if header.find('200') != -1:
+          successful = True
+        continue
+      elif not successful:
+        continue
+      name, value = [x.strip() for x in header.split(':', 1)]
+      name = name.lower()
+      if name == 'content-length':
+        content_length = int(value)
+      elif name == 'accept-ranges':
+        accept_ranges = (value.lower() == 'bytes')
+      elif name == 'etag' or (name == 'last-modified' and not validator):
+        validator = value
     if successful:
       break
   else:
@@ -95,9 +105,14 @@ def FetchRemoteTarballs(storage_dir, urls):
       current_size = 0
 
   if current_size < content_length:
-    cros_build_lib.RunCurl(
-        ['-f', '-L', '-y', '30', '-C', '-', '--output', tarball_dest, url],
-        print_cmd=False)
+    if accept_ranges and not current_size:
+      # Multi-GB tarballs download much faster over several connections.
+      cros_build_lib.FetchUrlInChunks(url, tarball_dest, content_length,
+                                      validator=validator)
+    else:
+      cros_build_lib.RunCurl(
+          ['-f', '-L', '-y', '30', '-C', '-', '--output', tarball_dest, url],
+          print_cmd=False)
 
   # Cleanup old tarballs now since we've successfull fetched; only cleanup
   # the tarballs for our prefix, or unknown ones.
@@ -108,7 +123,12 @@ def FetchRemoteTarballs(storage_dir, urls):
       continue
 
     print 'Cleaning up old tarball: %s' % (filename,)
-    osutils.SafeUnlink(os.path.join(storage_dir, filename))
+    path = os.path.join(storage_dir, filename)
+    if os.path.isdir(path):
+      # Progress of an abandoned chunked download.
+      osutils.RmDir(path, ignore_missing=True)
+    else:
+      osutils.SafeUnlink(path)
 
   return tarball_dest
 
@@ -7,8 +7,10 @@
 """
 
 import copy
+import functools
 import glob
 import json
+import multiprocessing
 import os
 
 from chromite.buildbot import constants
@@ -151,6 +153,9 @@ class Crossdev(object):
 
       configured_targets.append(target)
 
+    # Crossdev (re)generated ebuilds and maybe merged packages.
+    PackageVersions.Reset()
+
 
 def GetPackageMap(target):
   """Compiles a package map for the given target from the constants.
@@ -211,6 +216,63 @@ def IsPackageDisabled(target, package):
   return GetDesiredPackageVersions(target, package) == [PACKAGE_NONE]
 
 
+class PackageVersions(object):
+  """Class for answering version queries from one load of the portage dbs.
+
+  Looking up every target/package pair with a fresh dbapi.match() walks the
+  vardb and the overlays again for each query.  Instead the installed
+  packages are indexed once and porttree matches are remembered, until
+  Reset() is called after something (crossdev, emerge) changed them.
+  """
+
+  _INSTALLED = None
+  _AVAILABLE = {}
+
+  @classmethod
+  def Reset(cls):
+    """Forget everything, the portage dbs have changed."""
+    cls._INSTALLED = None
+    cls._AVAILABLE = {}
+
+  @classmethod
+  def _LoadInstalled(cls):
+    """Index all installed packages by their category/package name."""
+    cls._INSTALLED = {}
+    # pylint: disable=E1101
+    for cpv in portage.db['/']['vartree'].dbapi.cpv_all(use_cache=0):
+      cls._INSTALLED.setdefault(portage.versions.cpv_getkey(cpv),
+                                []).append(cpv)
+
+  @classmethod
+  def Match(cls, atom, installed):
+    """Returns the list of cpvs matching |atom|.
+
+    args:
+      atom - the atom to operate on (e.g. sys-devel/gcc)
+      installed - Whether we want installed packages or ebuilds
+    """
+    # pylint: disable=E1101
+    if installed:
+      if portage.dep.Atom(atom).cp != atom:
+        # Versioned atoms are rare enough not to bother indexing them.
+        return portage.db['/']['vartree'].dbapi.match(atom, use_cache=0)
+      if cls._INSTALLED is None:
+        cls._LoadInstalled()
+      return cls._INSTALLED.get(atom, [])
+
+    if atom not in cls._AVAILABLE:
+      cls._AVAILABLE[atom] = portage.db['/']['porttree'].dbapi.match(
+          atom, use_cache=0)
+    return cls._AVAILABLE[atom]
+
+  @classmethod
+  def Prime(cls, atoms):
+    """Resolves all of |atoms| up front in a single pass over the dbs."""
+    for atom in set(atoms):
+      cls.Match(atom, True)
+      cls.Match(atom, False)
+
+
 def GetInstalledPackageVersions(atom):
   """Extracts the list of current versions of a target, package pair.
 
@@ -219,12 +281,8 @@ def GetInstalledPackageVersions(atom):
 
   returns the list of versions of the package currently installed.
   """
-  versions = []
-  # pylint: disable=E1101
-  for pkg in portage.db['/']['vartree'].dbapi.match(atom, use_cache=0):
-    version = portage.versions.cpv_getversion(pkg)
-    versions.append(version)
-  return versions
+  return [portage.versions.cpv_getversion(pkg)
+          for pkg in PackageVersions.Match(atom, True)]
 
 
 def GetStablePackageVersion(atom, installed):
@@ -236,9 +294,8 @@ def GetStablePackageVersion(atom, installed):
 
   returns a string containing the latest version.
   """
-  pkgtype = 'vartree' if installed else 'porttree'
   # pylint: disable=E1101
-  cpv = portage.best(portage.db['/'][pkgtype].dbapi.match(atom, use_cache=0))
+  cpv = portage.best(PackageVersions.Match(atom, installed))
   return portage.versions.cpv_getversion(cpv) if cpv else None
 
 
@@ -344,7 +401,7 @@ def UpdateTargets(targets, usepkg, getbinpkg=True):
   # and figure out the appropriate keywords/masks. Crossdev will initialize
   # these, but they need to be regenerated on every update.
   print 'Determining required toolchain updates...'
-  mergemap = {}
+  queries = []
   for target in targets:
     # Record the highest needed version for each target, for masking purposes.
     RemovePackageMask(target)
@@ -352,11 +409,17 @@ def UpdateTargets(targets, usepkg, getbinpkg=True):
       # Portage name for the package
       if IsPackageDisabled(target, package):
         continue
-      pkg = GetPortagePackage(target, package)
-      current = GetInstalledPackageVersions(pkg)
-      desired = GetDesiredPackageVersions(target, package)
-      desired_num = VersionListToNumeric(target, package, desired, False)
-      mergemap[pkg] = set(desired_num).difference(current)
+      queries.append((target, package, GetPortagePackage(target, package)))
+
+  # Resolve every version up front so the dbs are only loaded once.
+  PackageVersions.Prime(pkg for _, _, pkg in queries)
+
+  mergemap = {}
+  for target, package, pkg in queries:
+    current = GetInstalledPackageVersions(pkg)
+    desired = GetDesiredPackageVersions(target, package)
+    desired_num = VersionListToNumeric(target, package, desired, False)
+    mergemap[pkg] = set(desired_num).difference(current)
 
   packages = []
   for pkg in mergemap:
@@ -379,6 +442,7 @@ def UpdateTargets(targets, usepkg, getbinpkg=True):
 
   cmd.extend(packages)
   cros_build_lib.RunCommand(cmd)
+  PackageVersions.Reset()
   return True
 
 
@@ -409,6 +473,7 @@ def CleanTargets(targets):
     cmd = [EMERGE_CMD, '--unmerge']
     cmd.extend(packages)
     cros_build_lib.RunCommand(cmd)
+    PackageVersions.Reset()
   else:
     print 'Nothing to clean!'
 
@@ -710,7 +775,8 @@ def _GetFilesForTarget(target, root='/'):
 
 
 def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
-                             path_rewrite_func=lambda x:x, root='/'):
+                             path_rewrite_func=lambda x:x, root='/',
+                             processes=None):
   """Link in all packable files and their runtime dependencies
 
   This also wraps up executable ELFs with helper scripts.
@@ -722,6 +788,7 @@ def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
     ldpaths: A dict of static ldpath information
     path_rewrite_func: User callback to rewrite paths in output_dir
     root: The root path to pull all packages/files from
+    processes: Number of processes to parse the ELFs with
   """
   # Link in all the files.
   sym_paths = []
@@ -759,8 +826,10 @@ def _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
   libdir = os.path.join(output_dir, 'lib')
   osutils.SafeMakedirs(libdir)
   donelibs = set()
-  for elf in elfs:
-    e = lddtree.ParseELF(elf, root, ldpaths)
+  # Sorting keeps ELFs from the same package, with the same deps, together.
+  elfs = sorted(elfs)
+  for elf, e in zip(elfs, lddtree.ParseELFs(elfs, root, ldpaths,
+                                                   processes=processes)):
     interp = e['interp']
     if interp:
       # Generate a wrapper if it is executable.
@@ -872,7 +941,8 @@ def _ProcessDistroCleanups(target, output_dir):
   osutils.RmDir(os.path.join(output_dir, 'etc'))
 
 
-def CreatePackagableRoot(target, output_dir, ldpaths, root='/'):
+def CreatePackagableRoot(target, output_dir, ldpaths, root='/',
+                         processes=None):
   """Setup a tree from the packages for the specified target
 
   This populates a path with all the files from toolchain packages so that
@@ -883,6 +953,7 @@ def CreatePackagableRoot(target, output_dir, ldpaths, root='/'):
     output_dir: The output directory to place all the files
     ldpaths: A dict of static ldpath information
     root: The root path to pull all packages/files from
+    processes: Number of processes to parse the ELFs with
   """
   # Find all the files owned by the packages for this target.
   paths, elfs = _GetFilesForTarget(target, root=root)
@@ -893,7 +964,8 @@ def CreatePackagableRoot(target, output_dir, ldpaths, root='/'):
     """Move /usr/bin to /bin so people can just use that toplevel dir"""
     return path[4:] if path.startswith('/usr/bin/') else path
   _BuildInitialPackageRoot(output_dir, paths, elfs, ldpaths,
-                           path_rewrite_func=MoveUsrBinToBin, root=root)
+                           path_rewrite_func=MoveUsrBinToBin, root=root,
+                           processes=processes)
 
   # The packages, when part of the normal distro, have helper scripts
   # that setup paths and such.  Since we are making this standalone, we
@@ -901,7 +973,7 @@ def CreatePackagableRoot(target, output_dir, ldpaths, root='/'):
   _ProcessDistroCleanups(target, output_dir)
 
 
-def CreatePackages(targets_wanted, output_dir, root='/'):
+def CreatePackages(targets_wanted, output_dir, root='/', processes=None):
   """Create redistributable cross-compiler packages for the specified targets
 
   This creates toolchain packages that should be usable in conjunction with
@@ -909,26 +981,43 @@ def CreatePackages(targets_wanted, output_dir, root='/'):
 
   Tarballs (one per target) will be created in $PWD.
 
+  The targets are packaged concurrently.  When there are fewer targets than
+  processes, the remaining CPUs are shared out between the targets for
+  parsing their ELFs and compressing their tarballs.
+
   Args:
     targets_wanted: The targets to package up
     root: The root path to pull all packages/files from
+    processes: The most processes to use at once; defaults to the CPU count
   """
   osutils.SafeMakedirs(output_dir)
   ldpaths = lddtree.LoadLdpaths(root)
   targets = ExpandTargets(targets_wanted)
+  if not targets:
+    return
+
+  processes = processes or multiprocessing.cpu_count()
+  jobs = min(processes, len(targets))
+  processes_per_target = max(1, processes // len(targets))
 
   with osutils.TempDirContextManager() as tempdir:
     # We have to split the root generation from the compression stages.  This is
     # because we hardlink in all the files (to avoid overhead of reading/writing
     # the copies multiple times).  But tar gets angry if a file's hardlink count
     # changes from when it starts reading a file to when it finishes.
-    with parallel.BackgroundTaskRunner(CreatePackagableRoot) as queue:
+    with parallel.BackgroundTaskRunner(CreatePackagableRoot,
+                                       processes=jobs) as queue:
       for target in targets:
         output_target_dir = os.path.join(tempdir, target)
-        queue.put([target, output_target_dir, ldpaths, root])
+        queue.put([target, output_target_dir, ldpaths, root,
+                   processes_per_target])
 
     # Build the tarball.
-    with parallel.BackgroundTaskRunner(cros_build_lib.CreateTarball) as queue:
+    create_tarball = functools.partial(
+        cros_build_lib.CreateTarball,
+        parallel=processes_per_target if processes_per_target > 1 else False)
+    with parallel.BackgroundTaskRunner(create_tarball,
+                                       processes=jobs) as queue:
       for target in targets:
         tar_file = os.path.join(output_dir, target + '.tar.xz')
         queue.put([tar_file, os.path.join(tempdir, target)])
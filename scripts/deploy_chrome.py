@@ -22,6 +22,7 @@ import logging
 import multiprocessing
 import os
 import optparse
+import stat
 import time
 
 
@@ -47,9 +48,19 @@ POST_KILL_WAIT = 2
 
 MOUNT_RW_COMMAND = 'mount -o remount,rw /'
 LSOF_COMMAND = 'lsof %s/chrome'
+# Lists the size, mtime and path of the files in a directory.
+LIST_FILES_COMMAND = "find %s -type f -printf '%%s %%T@ %%P\\n'"
+
+# Fraction of the staged bytes that must be missing or out of date on the
+# device for the staging dir to be sent as a single tar stream, rather than
+# rsynced.
+TAR_DEPLOY_THRESHOLD = 0.5
 
 _CHROME_DIR = '/opt/google/chrome'
 
+# Subdirectory of the cache dir that stripped binaries are kept in.
+_STRIP_CACHE_DIR = 'chrome-strip'
+
 
 def _UrlBaseName(url):
   """Return the last component of the URL."""
@@ -101,8 +112,9 @@ class DeployChrome(object):
     # Use --force to bypass the checks.
     cmd = ('/usr/share/vboot/bin/make_dev_ssd.sh --partitions %d '
            '--remove_rootfs_verification --force')
-    for partition in (KERNEL_A_PARTITION, KERNEL_B_PARTITION):
-      self.host.RemoteSh(cmd % partition, error_code_ok=True)
+    self.host.BatchRemoteSh(
+        [cmd % partition for partition in
+         (KERNEL_A_PARTITION, KERNEL_B_PARTITION)], error_code_ok=True)
 
     # A reboot in developer mode takes a while (and has delays), so the user
     # will have time to read and act on the USB boot instructions below.
@@ -165,13 +177,45 @@ class DeployChrome(object):
     if result.returncode:
       self._rootfs_is_still_readonly.set()
 
+  def _GetOutdatedFraction(self):
+    """Returns the fraction of staged bytes that rsync would have to send.
+
+    Like rsync, files are considered up to date on the device when their size
+    and mtime match.
+    """
+    result = self.host.RemoteSh(LIST_FILES_COMMAND % self.options.target_dir,
+                                error_code_ok=True)
+    remote_files = {}
+    for line in result.output.splitlines():
+      size, mtime, path = line.split(' ', 2)
+      remote_files[path] = (int(size), int(float(mtime)))
+
+    total = outdated = 0
+    for root, _dirs, files in os.walk(self.staging_dir):
+      for name in files:
+        path = os.path.join(root, name)
+        st = os.lstat(path)
+        if not stat.S_ISREG(st.st_mode):
+          continue
+        total += st.st_size
+        rel_path = os.path.relpath(path, self.staging_dir)
+        if remote_files.get(rel_path) != (st.st_size, int(st.st_mtime)):
+          outdated += st.st_size
+    return float(outdated) / total if total else 0.0
+
   def _Deploy(self):
     logging.info('Copying Chrome to %s on device...', self.options.target_dir)
-    # Show the output (status) for this command.
-    self.host.Rsync('%s/' % os.path.abspath(self.staging_dir),
-                    self.options.target_dir,
-                    inplace=True, debug_level=logging.INFO,
-                    verbose=self.options.verbose)
+    if self._GetOutdatedFraction() >= TAR_DEPLOY_THRESHOLD:
+      # Most of it has to be sent anyway, so skip rsync's per-file overhead.
+      self.host.TarCopy(os.path.abspath(self.staging_dir),
+                        self.options.target_dir, debug_level=logging.INFO,
+                        verbose=self.options.verbose)
+    else:
+      # Show the output (status) for this command.
+      self.host.Rsync('%s/' % os.path.abspath(self.staging_dir),
+                      self.options.target_dir,
+                      inplace=True, debug_level=logging.INFO,
+                      verbose=self.options.verbose)
     if self.options.startui:
       logging.info('Starting Chrome...')
       self.host.RemoteSh('start ui')
@@ -384,7 +428,8 @@ def _PrepareStagingDir(options, tempdir, staging_dir):
       chrome_util.StageChromeFromBuildDir(
           staging_dir, options.build_dir, strip_bin, strict=options.strict,
           sloppy=options.sloppy, gyp_defines=options.gyp_defines,
-          staging_flags=options.staging_flags)
+          staging_flags=options.staging_flags,
+          strip_cache_dir=os.path.join(options.cache_dir, _STRIP_CACHE_DIR))
   else:
     pkg_path = options.local_pkg_path
     if options.gs_path:
@@ -417,3 +462,5 @@ def main(argv):
       deploy.Perform()
     except results_lib.StepFailure as ex:
       raise SystemExit(str(ex).strip())
+    finally:
+      deploy.host.Close()
@@ -17,6 +17,7 @@ from chromite.lib import cros_build_lib
 from chromite.lib import cros_test_lib
 from chromite.lib import osutils
 from chromite.lib import partial_mock
+from chromite.lib import remote_access
 from chromite.lib import remote_access_unittest
 from chromite.scripts import deploy_chrome
 
@@ -189,6 +190,37 @@ class TestUiJobStarted(DeployTest):
     self.assertTrue(self.deploy._CheckUiJobStarted())
 
 
+class TestDeployTransport(DeployTest):
+  """Testing the choice between rsync and a tar stream."""
+
+  def setUp(self):
+    self.chrome = os.path.join(self.deploy.staging_dir, 'chrome')
+    osutils.WriteFile(self.chrome, 'x' * 100, makedirs=True)
+    osutils.WriteFile(os.path.join(self.deploy.staging_dir, 'resources.pak'),
+                      'x' * 10)
+    self.rsync = self.PatchObject(remote_access.RemoteAccess, 'Rsync')
+    self.tar_copy = self.PatchObject(remote_access.RemoteAccess, 'TarCopy')
+
+  def MockListFiles(self, output, returncode=0):
+    self.deploy_mock.rsh_mock.AddCmdResult(
+        deploy_chrome.LIST_FILES_COMMAND % (deploy_chrome._CHROME_DIR,),
+        returncode, output=output)
+
+  def testEmptyTarget(self):
+    """A missing target dir gets a tar stream."""
+    self.MockListFiles('', returncode=1)
+    self.deploy._Deploy()
+    self.assertTrue(self.tar_copy.called)
+    self.assertFalse(self.rsync.called)
+
+  def testMostlyUpToDate(self):
+    """Rsync is used when most of the files are already on the device."""
+    self.MockListFiles('100 %i.5 chrome\n' % os.stat(self.chrome).st_mtime)
+    self.deploy._Deploy()
+    self.assertTrue(self.rsync.called)
+    self.assertFalse(self.tar_copy.called)
+
+
 class StagingTest(cros_test_lib.MockTempDirTestCase):
   """Test user-mode and ebuild-mode staging functionality."""
 
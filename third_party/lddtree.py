@@ -14,10 +14,12 @@ from __future__ import print_function
 
 import glob
 import errno
+import multiprocessing
 import optparse
 import os
 import shutil
 import sys
+import threading
 
 from elftools.elf.elffile import ELFFile
 from elftools.common import exceptions
@@ -151,6 +153,22 @@ def LoadLdpaths(root='/'):
 	return ldpaths
 
 
+def _CompatKey(elf):
+	"""Return the aspects of an ELFFile that CompatibleELFs compares"""
+	return (elf.header['e_ident']['EI_OSABI'], elf.elfclass, elf.little_endian,
+		elf.header['e_machine'])
+
+
+def _CompatibleKeys(key1, key2):
+	"""See if the _CompatKey() of two ELFs are compatible"""
+	osabis = frozenset([key1[0], key2[0]])
+	compat_sets = (
+		frozenset(['ELFOSABI_NONE', 'ELFOSABI_SYSV', 'ELFOSABI_LINUX']),
+	)
+	return ((len(osabis) == 1 or any(osabis.issubset(x) for x in compat_sets)) and
+		key1[1:] == key2[1:])
+
+
 def CompatibleELFs(elf1, elf2):
 	"""See if two ELFs are compatible
 
@@ -163,14 +181,87 @@ def CompatibleELFs(elf1, elf2):
 	Returns:
 	  True if compatible, False otherwise
 	"""
-	osabis = frozenset([e.header['e_ident']['EI_OSABI'] for e in (elf1, elf2)])
-	compat_sets = (
-		frozenset(['ELFOSABI_NONE', 'ELFOSABI_SYSV', 'ELFOSABI_LINUX']),
-	)
-	return ((len(osabis) == 1 or any(osabis.issubset(x) for x in compat_sets)) and
-		elf1.elfclass == elf2.elfclass and
-		elf1.little_endian == elf2.little_endian and
-		elf1.header['e_machine'] == elf2.header['e_machine'])
+	return _CompatibleKeys(_CompatKey(elf1), _CompatKey(elf2))
+
+
+class ELFCache(object):
+	"""Remember what ParseELF has read from ELFs and found in ldpaths
+
+	ELFs are keyed by their path, size and mtime, so a cache may be shared by
+	any number of ParseELF calls; the libraries most ELFs depend on are then
+	only read once.
+	"""
+
+	def __init__(self):
+		self._elfs = {}
+		self._libs = {}
+		self._lock = threading.Lock()
+
+	def GetELF(self, path):
+		"""Return the parts of the ELF at |path| that ParseELF uses
+
+		Returns:
+		  a dict with the keys compat (see _CompatKey), interp, rpath, runpath
+		  and needed; interp/rpath/runpath are None when not set
+		"""
+		with open(path) as f:
+			st = os.fstat(f.fileno())
+			key = (path, st.st_size, st.st_mtime)
+			with self._lock:
+				info = self._elfs.get(key)
+			if info is not None:
+				return info
+
+			info = {
+				'interp': None,
+				'rpath': None,
+				'runpath': None,
+				'needed': [],
+			}
+			elf = ELFFile(f)
+			info['compat'] = _CompatKey(elf)
+			for segment in elf.iter_segments():
+				if segment.header.p_type == 'PT_INTERP':
+					info['interp'] = segment.get_interp_name()
+					break
+			for segment in elf.iter_segments():
+				if segment.header.p_type != 'PT_DYNAMIC':
+					continue
+
+				for t in segment.iter_tags():
+					if t.entry.d_tag == 'DT_RPATH':
+						info['rpath'] = t.rpath
+					elif t.entry.d_tag == 'DT_RUNPATH':
+						info['runpath'] = t.runpath
+					elif t.entry.d_tag == 'DT_NEEDED':
+						info['needed'].append(t.needed)
+
+				# XXX: We assume there is only one PT_DYNAMIC.  This is
+				# probably fine since the runtime ldso does the same.
+				break
+
+		with self._lock:
+			self._elfs[key] = info
+		return info
+
+	def FindLib(self, compat, lib, ldpaths):
+		"""Like FindLib(), but for an ELF with the given _CompatKey()"""
+		key = (compat, lib, tuple(ldpaths))
+		with self._lock:
+			if key in self._libs:
+				return self._libs[key]
+
+		found = None
+		for ldpath in ldpaths:
+			path = os.path.join(ldpath, lib)
+			if os.path.exists(path):
+				if _CompatibleKeys(compat, self.GetELF(path)['compat']):
+					found = path
+					break
+
+		with self._lock:
+			self._libs[key] = found
+		return found
 
 
 def FindLib(elf, lib, ldpaths):
@@ -194,7 +285,7 @@ def FindLib(elf, lib, ldpaths):
 
 
 def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
-             _first=True, _all_libs={}):
+             _first=True, _all_libs={}, cache=None):
 	"""Parse the ELF dependency tree of the specified file
 
 	Args:
@@ -205,6 +296,7 @@ def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
 	           conf, env, interp
 	  _first: Recursive use only; is this the first ELF ?
 	  _all_libs: Recursive use only; dict of all libs we've seen
+	  cache: An ELFCache to share between calls; a new one is used if None
 	Returns:
 	  a dict containing information about all the ELFs; e.g.
 		{
@@ -225,6 +317,8 @@ def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
 	if _first:
 		_all_libs = {}
 		ldpaths = ldpaths.copy()
+	if cache is None:
+		cache = ELFCache()
 	ret = {
 		'interp': None,
 		'path': path,
@@ -234,78 +328,102 @@ def ParseELF(path, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
 		'libs': _all_libs,
 	}
 
-	with open(path) as f:
-		elf = ELFFile(f)
+	elf = cache.GetELF(path)
 
-		# If this is the first ELF, extract the interpreter.
-		if _first:
-			for segment in elf.iter_segments():
-				if segment.header.p_type != 'PT_INTERP':
-					continue
+	# If this is the first ELF, extract the interpreter.
+	if _first and elf['interp'] is not None:
+		interp = elf['interp']
+		ret['interp'] = normpath(root + interp)
+		ret['libs'][os.path.basename(interp)] = {
+			'path': ret['interp'],
+			'needed': [],
+		}
+		# XXX: Should read it and scan for /lib paths.
+		ldpaths['interp'] = [
+			normpath(root + os.path.dirname(interp)),
+			normpath(root + '/usr' + os.path.dirname(interp)),
+		]
+
+	# Parse the ELF's dynamic tags.  The cached list is shared, so hand out
+	# a copy of it.
+	libs = list(elf['needed'])
+	rpaths = []
+	runpaths = []
+	if elf['runpath'] is not None:
+		# If both RPATH and RUNPATH are set, only the latter is used.
+		runpaths = ParseLdPaths(elf['runpath'], root=root, path=path)
+	elif elf['rpath'] is not None:
+		rpaths = ParseLdPaths(elf['rpath'], root=root, path=path)
+	if _first:
+		# Propagate the rpaths used by the main ELF since those will be
+		# used at runtime to locate things.
+		ldpaths['rpath'] = rpaths
+		ldpaths['runpath'] = runpaths
+	ret['rpath'] = rpaths
+	ret['runpath'] = runpaths
+	ret['needed'] = libs
+
+	# Search for the libs this ELF uses.
+	all_ldpaths = None
+	for lib in libs:
+		if lib in _all_libs:
+			continue
+		if all_ldpaths is None:
+			all_ldpaths = rpaths + ldpaths['rpath'] + ldpaths['env'] + runpaths + ldpaths['runpath'] + ldpaths['conf'] + ldpaths['interp']
+		fullpath = cache.FindLib(elf['compat'], lib, all_ldpaths)
+		_all_libs[lib] = {
+			'path': fullpath,
+			'needed': [],
+		}
+		if fullpath:
+			lret = ParseELF(fullpath, root, ldpaths, False, _all_libs, cache)
+			_all_libs[lib]['needed'] = lret['needed']
 
-				interp = segment.get_interp_name()
-				ret['interp'] = normpath(root + interp)
-				ret['libs'][os.path.basename(interp)] = {
-					'path': ret['interp'],
-					'needed': [],
-				}
-				# XXX: Should read it and scan for /lib paths.
-				ldpaths['interp'] = [
-					normpath(root + os.path.dirname(interp)),
-					normpath(root + '/usr' + os.path.dirname(interp)),
-				]
-				break
+	return ret
 
-		# Parse the ELF's dynamic tags.
-		libs = []
-		rpaths = []
-		runpaths = []
-		for segment in elf.iter_segments():
-			if segment.header.p_type != 'PT_DYNAMIC':
-				continue
 
-			for t in segment.iter_tags():
-				if t.entry.d_tag == 'DT_RPATH':
-					rpaths = ParseLdPaths(t.rpath, root=root, path=path)
-				elif t.entry.d_tag == 'DT_RUNPATH':
-					runpaths = ParseLdPaths(t.runpath, root=root, path=path)
-				elif t.entry.d_tag == 'DT_NEEDED':
-					libs.append(t.needed)
-			if runpaths:
-				# If both RPATH and RUNPATH are set, only the latter is used.
-				rpaths = []
-
-			# XXX: We assume there is only one PT_DYNAMIC.  This is
-			# probably fine since the runtime ldso does the same.
-			break
-		if _first:
-			# Propagate the rpaths used by the main ELF since those will be
-			# used at runtime to locate things.
-			ldpaths['rpath'] = rpaths
-			ldpaths['runpath'] = runpaths
-		ret['rpath'] = rpaths
-		ret['runpath'] = runpaths
-		ret['needed'] = libs
-
-		# Search for the libs this ELF uses.
-		all_ldpaths = None
-		for lib in libs:
-			if lib in _all_libs:
-				continue
-			if all_ldpaths is None:
-				all_ldpaths = rpaths + ldpaths['rpath'] + ldpaths['env'] + runpaths + ldpaths['runpath'] + ldpaths['conf'] + ldpaths['interp']
-			fullpath = FindLib(elf, lib, all_ldpaths)
-			_all_libs[lib] = {
-				'path': fullpath,
-				'needed': [],
-			}
-			if fullpath:
-				lret = ParseELF(fullpath, root, ldpaths, False, _all_libs)
-				_all_libs[lib]['needed'] = lret['needed']
+# The ELFCache of the ParseELFs worker processes.
+_worker_cache = None
 
-		del elf
 
-	return ret
+def _ParseELFWorker(args):
+	"""ParseELF() the given (path, root, ldpaths) in a ParseELFs worker"""
+	global _worker_cache
+	if _worker_cache is None:
+		_worker_cache = ELFCache()
+	path, root, ldpaths = args
+	return ParseELF(path, root, ldpaths, cache=_worker_cache)
+
+
+def ParseELFs(paths, root='/', ldpaths={'conf':[], 'env':[], 'interp':[]},
+              processes=None):
+	"""ParseELF() many ELFs in parallel
+
+	The ELFs are split between worker processes in contiguous runs, and each
+	worker shares an ELFCache between all the ELFs it parses, so list ELFs
+	that likely depend on the same libraries next to each other.
+
+	Args:
+	  paths: The ELFs to scan
+	  root: See ParseELF()
+	  ldpaths: See ParseELF()
+	  processes: How many ELFs to parse at once; defaults to the CPU count
+	Returns:
+	  a list of the ParseELF() results, in the same order as |paths|
+	"""
+	args = [(path, root, ldpaths) for path in paths]
+	processes = min(processes or multiprocessing.cpu_count(), len(args))
+	if processes <= 1:
+		cache = ELFCache()
+		return [ParseELF(path, root, ldpaths, cache=cache) for path in paths]
+
+	pool = multiprocessing.Pool(processes)
+	try:
+		chunksize = (len(args) + processes * 4 - 1) // (processes * 4)
+		return pool.map(_ParseELFWorker, args, chunksize=chunksize)
+	finally:
+		pool.terminate()
+		pool.join()
 
 
 def _NormalizePath(option, _opt, value, parser):
@@ -444,9 +562,10 @@ Display ELF dependencies as a tree""")
 
 	# Process all the files specified.
 	ret = 0
+	cache = ELFCache()
 	for path in paths:
 		try:
-			elf = ParseELF(path, options.root, ldpaths)
+			elf = ParseELF(path, options.root, ldpaths, cache=cache)
 		except (exceptions.ELFError, IOError) as e:
 			ret = 1
 			warn('%s: %s' % (path, e))